@@ -1,5 +1,11 @@
 #!/bin/bash
 
+# Uso: run_script.sh [comando] [argumentos]   (padrão: leitos)
+# Comandos: leitos | exames | backfill | reconcile | replay | bench — ver scripts/epimed_sync.py
 source /var/www/html/epimed/venv/bin/activate
 
-python /var/www/html/epimed/scripts/verificar_leitos.py
+if [ $# -eq 0 ]; then
+    set -- leitos
+fi
+
+exec python /var/www/html/epimed/scripts/epimed_sync.py "$@"
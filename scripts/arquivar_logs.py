@@ -0,0 +1,266 @@
+"""Arquivamento noturno dos logs e limpeza das sessões (substitui o tar + rm -rf).
+
+* logs/: cada arquivo fechado — sem processo com ele aberto e modificado
+  antes de hoje, ou já compactado na rotação — é compactado
+  individualmente (zstd com várias threads; gzip sem o pacote zstandard)
+  em backup/logs/AAAA-MM/ e só então removido. Arquivos em uso nunca são
+  tocados, então o job não disputa arquivos com as rotinas em execução;
+  arquivos e diretórios ocultos (estado das rotinas) ficam de fora;
+* o manifesto (backup/manifesto.json) guarda mtime, tamanho e sha256 de
+  cada arquivo arquivado: um arquivo com o mesmo mtime e tamanho, ou com o
+  mesmo conteúdo, não é arquivado de novo;
+* backup/: remove os arquivos mais antigos que DIAS_BACKUP e, em seguida,
+  os mais antigos até o total caber em MAX_BACKUP_MB;
+* session/: remove as sessões sem uso há SESSAO_HORAS, em lotes com pausa
+  entre eles, sem varrer o diretório inteiro de uma vez.
+
+Uso: python arquivar_logs.py [--simular]
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+BASE_DIR = os.getenv("EPIMED_BASE_DIR", "/var/www/html/epimed")
+LOG_DIR = os.path.join(BASE_DIR, "logs")
+SESSION_DIR = os.path.join(BASE_DIR, "session")
+BACKUP_DIR = os.path.join(BASE_DIR, "backup")
+MANIFESTO = os.path.join(BACKUP_DIR, "manifesto.json")
+
+DIAS_BACKUP = int(os.getenv("EPIMED_BACKUP_DIAS", "180"))
+MAX_BACKUP_MB = int(os.getenv("EPIMED_BACKUP_MAX_MB", "5120"))
+SESSAO_HORAS = int(os.getenv("EPIMED_SESSAO_HORAS", "24"))
+LOTE_SESSOES = int(os.getenv("EPIMED_SESSAO_LOTE", "500"))
+PAUSA_LOTE = float(os.getenv("EPIMED_SESSAO_PAUSA", "0.05"))
+NIVEL_ZSTD = int(os.getenv("EPIMED_ARQUIVO_NIVEL_ZSTD", "10"))
+PARALELO = int(os.getenv("EPIMED_ARQUIVO_PARALELO", str(min(4, os.cpu_count() or 1))))
+THREADS_ZSTD = max(1, (os.cpu_count() or 1) // PARALELO)
+
+# Arquivos já compactados (rotação): copiados para o backup sem recompactar
+JA_COMPACTADOS = (".gz", ".zst", ".bz2", ".xz")
+BLOCO = 1024 * 1024
+
+def registrar_log(mensagem):
+    linha = f"{datetime.now():%Y-%m-%d %H:%M:%S} - {mensagem}"
+    print(linha)
+    with open(os.path.join(BACKUP_DIR, f"log_backup_{datetime.now():%Y-%m-%d}.txt"), "a", encoding="utf-8") as f:
+        f.write(linha + "\n")
+
+def arquivos_abertos():
+    """Caminhos abertos por algum processo visível em /proc (os de outros usuários ficam de fora)."""
+    abertos = set()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            descritores = os.listdir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+        for fd in descritores:
+            try:
+                abertos.add(os.readlink(f"/proc/{pid}/fd/{fd}"))
+            except OSError:
+                pass
+    return abertos
+
+def arquivos_fechados():
+    """[(caminho, stat)] dos logs prontos para arquivar."""
+    inicio_hoje = datetime.combine(datetime.now().date(), datetime.min.time()).timestamp()
+    abertos = arquivos_abertos()
+    prontos = []
+    for raiz, diretorios, nomes in os.walk(LOG_DIR):
+        # Diretórios e arquivos ocultos são estado das rotinas (marcas de
+        # consultas/planos/.capturados, travas .<log>.lock), não logs
+        diretorios[:] = [d for d in diretorios if not d.startswith(".")]
+        for nome in nomes:
+            if nome.startswith("."):
+                continue
+            caminho = os.path.join(raiz, nome)
+            try:
+                info = os.stat(caminho)
+            except FileNotFoundError:
+                continue
+            if os.path.realpath(caminho) in abertos:
+                continue
+            if info.st_mtime < inicio_hoje or nome.endswith(JA_COMPACTADOS):
+                prontos.append((caminho, info))
+    return prontos
+
+def carregar_manifesto():
+    try:
+        with open(MANIFESTO, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def salvar_manifesto(manifesto):
+    temporario = f"{MANIFESTO}.tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump(manifesto, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporario, MANIFESTO)
+
+def sha256(caminho):
+    h = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        while bloco := f.read(BLOCO):
+            h.update(bloco)
+    return h.hexdigest()
+
+def _destino(relativo, info, extensao):
+    pasta = os.path.join(BACKUP_DIR, "logs", datetime.fromtimestamp(info.st_mtime).strftime("%Y-%m"))
+    destino = os.path.join(pasta, relativo + extensao)
+    if os.path.exists(destino):
+        base, ext = os.path.splitext(relativo)
+        destino = os.path.join(pasta, f"{base}_{datetime.fromtimestamp(info.st_mtime):%Y%m%d%H%M%S}{ext}{extensao}")
+    return destino
+
+def compactar(origem, destino):
+    """Compacta (ou copia, se já compactado) origem em destino, gravando num temporário."""
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporario = f"{destino}.tmp"
+    with open(origem, "rb") as entrada, open(temporario, "wb") as saida:
+        if origem.endswith(JA_COMPACTADOS):
+            shutil.copyfileobj(entrada, saida, BLOCO)
+        elif zstandard is not None:
+            compressor = zstandard.ZstdCompressor(level=NIVEL_ZSTD, threads=THREADS_ZSTD)
+            compressor.copy_stream(entrada, saida, size=os.fstat(entrada.fileno()).st_size)
+        else:
+            with gzip.GzipFile(fileobj=saida, mode="wb", compresslevel=6) as comprimido:
+                shutil.copyfileobj(entrada, comprimido, BLOCO)
+        saida.flush()
+        os.fsync(saida.fileno())
+    shutil.copystat(origem, temporario)
+    os.replace(temporario, destino)
+
+def arquivar_logs(simular=False):
+    """Arquiva e remove os logs fechados; retorna (arquivados, já arquivados, erros)."""
+    manifesto = carregar_manifesto()
+    por_origem = {(e["origem"], e["mtime"], e["tamanho"]) for e in manifesto.values()}
+    por_hash = {e["sha256"] for e in manifesto.values()}
+    extensao = ".zst" if zstandard is not None else ".gz"
+    arquivados = repetidos = erros = 0
+
+    def arquivar(item):
+        caminho, info = item
+        relativo = os.path.relpath(caminho, LOG_DIR)
+        if (relativo, info.st_mtime, info.st_size) in por_origem:
+            return "repetido", caminho, None
+        digest = sha256(caminho)
+        if digest in por_hash:
+            return "repetido", caminho, None
+        destino = _destino(relativo, info, "" if caminho.endswith(JA_COMPACTADOS) else extensao)
+        if not simular:
+            compactar(caminho, destino)
+        return "arquivado", caminho, (os.path.relpath(destino, BACKUP_DIR), {
+            "origem": relativo, "mtime": info.st_mtime, "tamanho": info.st_size,
+            "sha256": digest, "arquivado_em": datetime.now().isoformat(timespec="seconds"),
+        })
+
+    fechados = arquivos_fechados()
+    with ThreadPoolExecutor(max_workers=PARALELO) as executor:
+        futuros = [(item[0], executor.submit(arquivar, item)) for item in fechados]
+        for caminho, futuro in futuros:
+            try:
+                resultado, caminho, entrada = futuro.result()
+            except Exception as erro:
+                erros += 1
+                registrar_log(f"Erro ao arquivar {caminho}: {erro}")
+                continue
+            if resultado == "arquivado":
+                arquivados += 1
+                manifesto[entrada[0]] = entrada[1]
+            else:
+                repetidos += 1
+            if not simular:
+                os.remove(caminho)
+    if not simular and (arquivados or repetidos):
+        salvar_manifesto(manifesto)
+    registrar_log(f"{'[simulação] ' if simular else ''}{len(fechados)} log(s) fechado(s): "
+                  f"{arquivados} arquivado(s), {repetidos} já arquivado(s), {erros} erro(s).")
+    return arquivados, repetidos, erros
+
+def aplicar_retencao(simular=False):
+    """Remove do backup os arquivos mais velhos que DIAS_BACKUP e depois os mais antigos além de MAX_BACKUP_MB."""
+    protegidos = {MANIFESTO, os.path.join(BACKUP_DIR, f"log_backup_{datetime.now():%Y-%m-%d}.txt")}
+    arquivos = []
+    for raiz, _, nomes in os.walk(BACKUP_DIR):
+        for nome in nomes:
+            caminho = os.path.join(raiz, nome)
+            if caminho not in protegidos and not nome.endswith(".tmp"):
+                info = os.stat(caminho)
+                arquivos.append((info.st_mtime, info.st_size, caminho))
+    arquivos.sort()
+
+    limite_idade = time.time() - DIAS_BACKUP * 86400
+    total = sum(tamanho for _, tamanho, _ in arquivos)
+    removidos = []
+    for mtime, tamanho, caminho in arquivos:
+        if mtime >= limite_idade and total <= MAX_BACKUP_MB * 1024 * 1024:
+            break
+        removidos.append(caminho)
+        total -= tamanho
+        if not simular:
+            os.remove(caminho)
+
+    if removidos and not simular:
+        manifesto = carregar_manifesto()
+        for caminho in removidos:
+            manifesto.pop(os.path.relpath(caminho, BACKUP_DIR), None)
+        salvar_manifesto(manifesto)
+    registrar_log(f"{'[simulação] ' if simular else ''}Retenção do backup: {len(removidos)} arquivo(s) "
+                  f"removido(s), {total / 1024 / 1024:.0f} MB mantidos.")
+    return len(removidos)
+
+def limpar_sessoes(simular=False):
+    """Remove, em lotes, as sessões sem modificação há SESSAO_HORAS; retorna a quantidade."""
+    limite = time.time() - SESSAO_HORAS * 3600
+    removidas = 0
+    lote = 0
+    for raiz, diretorios, nomes in os.walk(SESSION_DIR, topdown=False):
+        for nome in nomes:
+            caminho = os.path.join(raiz, nome)
+            try:
+                if os.lstat(caminho).st_mtime >= limite:
+                    continue
+                if not simular:
+                    os.remove(caminho)
+            except FileNotFoundError:
+                continue
+            removidas += 1
+            lote += 1
+            if lote >= LOTE_SESSOES:
+                lote = 0
+                time.sleep(PAUSA_LOTE)
+        if raiz != SESSION_DIR and not simular:
+            try:
+                os.rmdir(raiz)  # só se ficou vazio
+            except OSError:
+                pass
+    registrar_log(f"{'[simulação] ' if simular else ''}{removidas} arquivo(s) de sessão removido(s).")
+    return removidas
+
+def executar(simular=False):
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    inicio = time.monotonic()
+    registrar_log("==== Início do arquivamento de logs ====")
+    _, _, erros = arquivar_logs(simular)
+    aplicar_retencao(simular)
+    if os.path.isdir(SESSION_DIR):
+        limpar_sessoes(simular)
+    registrar_log(f"==== Fim do arquivamento de logs ({time.monotonic() - inicio:.1f} s) ====")
+    return erros == 0
+
+if __name__ == "__main__":
+    sys.exit(0 if executar(simular="--simular" in sys.argv[1:]) else 1)
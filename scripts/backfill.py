@@ -0,0 +1,260 @@
+"""Carga histórica de exames em blocos de datas, processados em paralelo.
+
+O período é dividido em blocos (exa.backfill_blocos); N processos, cada um
+com a própria conexão, reservam blocos pendentes (FOR UPDATE SKIP LOCKED),
+comparam os exames do bloco com a base local e enviam os faltantes sob um
+limite global de envios por segundo, compartilhado entre os processos.
+
+Para não interferir na rotina incremental, o período termina na marca
+d'água da rotina (último processamento bem-sucedido): o que vem depois é
+dela. O envio passa pelo mesmo registro de idempotência e quarentena, e a
+carga não altera controle_processamento, log_execucoes nem as impressões
+das origens.
+
+Uso:
+    python backfill.py iniciar AAAA-MM-DD AAAA-MM-DD [--lote NOME] [--dias-bloco 7] [--processos 4] [--taxa 10]
+    python backfill.py retomar LOTE [--processos 4] [--taxa 10]
+    python backfill.py status [LOTE]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import banco
+import indice_chaves
+import reconciliar
+from verificar_exames import (
+    classificar_exames,
+    enviar_exames,
+    obter_data_ultimo_processamento,
+    obter_exames_aghu,
+    obter_exames_baselocal,
+    registrar_log,
+)
+
+class LimiteTaxa:
+    """Limite global de envios por segundo, compartilhado entre processos (0 = sem limite)."""
+
+    def __init__(self, por_segundo):
+        self.intervalo = 1.0 / por_segundo if por_segundo else 0.0
+        self._proximo = multiprocessing.Value("d", 0.0)
+
+    def __call__(self):
+        if not self.intervalo:
+            return
+        with self._proximo.get_lock():
+            agora = time.monotonic()
+            vez = max(agora, self._proximo.value)
+            self._proximo.value = vez + self.intervalo
+        if vez > agora:
+            time.sleep(vez - agora)
+
+def criar_blocos(conn, lote, inicio, fim, dias_bloco):
+    """Divide [inicio, fim) em blocos de dias_bloco dias; fim é limitado à marca d'água incremental."""
+    marca = obter_data_ultimo_processamento(conn)
+    if fim > marca:
+        registrar_log(f"Fim do backfill ajustado de {fim} para a marca d'água incremental {marca}.")
+        fim = marca
+
+    blocos = []
+    atual = inicio
+    while atual < fim:
+        proximo = min(atual + timedelta(days=dias_bloco), fim)
+        blocos.append((lote, atual, proximo))
+        atual = proximo
+
+    with conn.cursor() as cur:
+        for bloco in blocos:
+            cur.execute("""
+                INSERT INTO exa.backfill_blocos (lote, inicio, fim)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (lote, inicio) DO NOTHING
+            """, bloco)
+    conn.commit()
+    return len(blocos)
+
+def preparar_cadastros(conn, inicio):
+    """Internações e admissões do período ausentes na base local (os exames dependem delas)."""
+    for entidade, recuperar in (
+        ("internacoes", reconciliar.recuperar_internacoes),
+        ("admissoes", reconciliar.recuperar_admissoes),
+    ):
+        _, ausentes, _, _ = reconciliar.comparar(conn, entidade, inicio)
+        conn.rollback()
+        if ausentes:
+            registrar_log(f"Backfill: recuperando {len(ausentes)} {entidade} ausentes desde {inicio}…")
+            recuperar(conn, ausentes)
+
+def reservar_bloco(conn, lote):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE exa.backfill_blocos
+            SET status = 'processando', tentativas = tentativas + 1, pid = %s,
+                iniciado_em = NOW(), concluido_em = NULL, erro = NULL
+            WHERE id = (
+                SELECT id FROM exa.backfill_blocos
+                WHERE lote = %s AND status = 'pendente'
+                ORDER BY inicio
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, inicio, fim
+        """, (os.getpid(), lote))
+        bloco = cur.fetchone()
+    conn.commit()
+    return bloco
+
+def concluir_bloco(conn, bloco_id, status, enviados=0, pendentes=0, erro=None):
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE exa.backfill_blocos
+            SET status = %s, exames_enviados = %s, envios_pendentes = %s,
+                concluido_em = NOW(), erro = %s
+            WHERE id = %s
+        """, (status, enviados, pendentes, erro, bloco_id))
+    conn.commit()
+
+def processar_bloco(conn, inicio, fim, limitador):
+    exames_aghu = obter_exames_aghu(conn, inicio, data_limite=fim)
+    exames_epimed = obter_exames_baselocal(conn, inicio, data_limite=fim)
+    novos, corrigidos, anulados = classificar_exames(exames_aghu, exames_epimed)
+    registrar_log(
+        f"Backfill {inicio:%Y-%m-%d}..{fim:%Y-%m-%d}: AGHU {len(exames_aghu)}, Epimed {len(exames_epimed)}; "
+        f"novos {len(novos)}, corrigidos {len(corrigidos)}, anulados {len(anulados)}"
+    )
+    enviados, pendentes, gravados = enviar_exames(conn, novos, corrigidos, anulados, limitador)
+    # Gravados e confirmados: o índice de chaves (motor "indice") passa a conhecê-los
+    indice_chaves.acrescentar_existente("exames", gravados)
+    return enviados, pendentes
+
+def trabalhador(lote, limitador):
+    """Processo trabalhador: reserva e processa blocos até não restar nenhum."""
+    conn = banco.obter()
+    try:
+        while True:
+            bloco = reservar_bloco(conn, lote)
+            if bloco is None:
+                break
+            bloco_id, inicio, fim = bloco
+            try:
+                enviados, pendentes = processar_bloco(conn, inicio, fim, limitador)
+            except Exception as erro:
+                conn.rollback()
+                registrar_log(f"Backfill: erro no bloco {inicio:%Y-%m-%d}: {erro}", nivel="error")
+                concluir_bloco(conn, bloco_id, "erro", erro=str(erro))
+            else:
+                concluir_bloco(conn, bloco_id, "concluido", enviados, pendentes)
+    finally:
+        banco.devolver(conn)
+
+def executar(lote, processos, taxa):
+    conn = banco.obter()
+    try:
+        # Um coordenador por lote: blocos com erro e blocos 'processando' de uma
+        # execução interrompida voltam à fila (uma nova tentativa por execução)
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"backfill:{lote}",))
+            if not cur.fetchone()[0]:
+                registrar_log(f"Backfill {lote} já está em execução.", nivel="error")
+                return False
+            cur.execute("""
+                UPDATE exa.backfill_blocos SET status = 'pendente'
+                WHERE lote = %s AND status IN ('processando', 'erro')
+            """, (lote,))
+            cur.execute("SELECT MIN(inicio) FROM exa.backfill_blocos WHERE lote = %s", (lote,))
+            inicio = cur.fetchone()[0]
+        conn.commit()
+
+        if inicio is None:
+            registrar_log(f"Backfill {lote}: nenhum bloco cadastrado.", nivel="warning")
+            return False
+
+        preparar_cadastros(conn, inicio)
+
+        registrar_log(f"Backfill {lote}: {processos} processos, limite de {taxa or 'sem limite'} envios/s.")
+        limitador = LimiteTaxa(taxa)
+        trabalhadores = [
+            multiprocessing.Process(target=trabalhador, args=(lote, limitador), name=f"backfill-{n}")
+            for n in range(processos)
+        ]
+        for processo in trabalhadores:
+            processo.start()
+        for processo in trabalhadores:
+            processo.join()
+
+        imprimir_status(conn, lote)
+        return True
+    finally:
+        # A trava consultiva é da sessão, que volta ao pool
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock_all()")
+        conn.commit()
+        banco.devolver(conn)
+
+def imprimir_status(conn, lote=None):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT lote, status, COUNT(*), SUM(exames_enviados), SUM(envios_pendentes),
+                   MIN(inicio), MAX(fim), MAX(concluido_em)
+            FROM exa.backfill_blocos
+            WHERE %(lote)s::varchar IS NULL OR lote = %(lote)s
+            GROUP BY lote, status
+            ORDER BY lote, status
+        """, {"lote": lote})
+        linhas = cur.fetchall()
+    conn.rollback()
+
+    if not linhas:
+        print("Nenhum bloco de backfill.")
+        return
+    print(f"{'LOTE':<24} {'STATUS':<12} {'BLOCOS':>7} {'ENVIADOS':>9} {'PENDENTES':>9}  PERÍODO / ÚLTIMA CONCLUSÃO")
+    for lote_, status, blocos, enviados, pendentes, inicio, fim, concluido in linhas:
+        print(f"{lote_:<24} {status:<12} {blocos:>7} {enviados or 0:>9} {pendentes or 0:>9}  "
+              f"{inicio:%Y-%m-%d}..{fim:%Y-%m-%d} / {concluido or '-'}")
+
+def _data(valor):
+    return datetime.strptime(valor, "%Y-%m-%d")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carga histórica de exames em blocos paralelos.")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    iniciar = comandos.add_parser("iniciar")
+    iniciar.add_argument("inicio", type=_data)
+    iniciar.add_argument("fim", type=_data)
+    iniciar.add_argument("--lote")
+    iniciar.add_argument("--dias-bloco", type=int, default=7)
+
+    retomar = comandos.add_parser("retomar")
+    retomar.add_argument("lote")
+
+    for sub in (iniciar, retomar):
+        sub.add_argument("--processos", type=int, default=4)
+        sub.add_argument("--taxa", type=float, default=10.0, help="envios por segundo (0 = sem limite)")
+
+    status = comandos.add_parser("status")
+    status.add_argument("lote", nargs="?")
+
+    args = parser.parse_args()
+
+    if args.comando == "status":
+        conexao = banco.obter()
+        try:
+            imprimir_status(conexao, args.lote)
+        finally:
+            banco.devolver(conexao)
+        sys.exit(0)
+
+    if args.comando == "iniciar":
+        args.lote = args.lote or f"backfill_{args.inicio:%Y%m%d}_{args.fim:%Y%m%d}"
+        conexao = banco.obter()
+        try:
+            quantidade = criar_blocos(conexao, args.lote, args.inicio, args.fim, args.dias_bloco)
+        finally:
+            banco.devolver(conexao)
+        registrar_log(f"Backfill {args.lote}: {quantidade} blocos de {args.dias_bloco} dias.")
+
+    sys.exit(0 if executar(args.lote, args.processos, args.taxa) else 1)
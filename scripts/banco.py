@@ -0,0 +1,153 @@
+"""Conexões PostgreSQL compartilhadas pelas rotinas: um ThreadedConnectionPool por destino.
+
+Destinos:
+
+* "epimed": base local (exa.*, leitos, views do AGHU), leitura e escrita;
+* "aghu":   banco do AGHU, só leitura.
+
+Com somente_leitura=True a conexão vem de um pool próprio, com transações
+read-only; se as variáveis epimed_leitura_host/epimed_leitura_port
+existirem, esse pool aponta para a réplica. Leituras que dependem de
+gravações da própria execução devem usar a conexão de escrita.
+
+Toda conexão sai do pool com application_name, statement_timeout,
+keepalives e o cursor de rastreio (rastreio.py) configurados; uma conexão ociosa há mais de VERIFICAR_APOS
+segundos é testada (SELECT 1) antes de ser entregue e descartada se
+estiver quebrada. O pool esgotado bloqueia o chamador em vez de falhar,
+para uso por várias threads de envio e gravação.
+
+Os pools são por processo: um processo filho (multiprocessing) cria os
+seus na primeira conexão e nunca usa os sockets herdados do pai.
+"""
+import multiprocessing.util
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool
+import rastreio
+
+# epimed_sync.py já carrega o .env antes de importar as rotinas
+if "epimed_dbname" not in os.environ:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+def _config(prefixo, leitura=False):
+    host = os.getenv(f"{prefixo}_leitura_host") if leitura else None
+    return {
+        'dbname': os.getenv(f"{prefixo}_dbname"),
+        'user': os.getenv(f"{prefixo}_user"),
+        'password': os.getenv(f"{prefixo}_password"),
+        'host': host or os.getenv(f"{prefixo}_host"),
+        'port': (os.getenv(f"{prefixo}_leitura_port") if host else None) or os.getenv(f"{prefixo}_port"),
+    }
+
+CONFIGS = {
+    ("epimed", False): _config("epimed"),
+    ("epimed", True): _config("epimed", leitura=True),
+    ("aghu", True): _config("aghu"),
+}
+
+APLICACAO = os.getenv("EPIMED_APLICACAO", "epimed_sync")
+STATEMENT_TIMEOUT_MS = int(os.getenv("EPIMED_STATEMENT_TIMEOUT_MS", "600000"))
+POOL_MAXIMO = int(os.getenv("EPIMED_POOL_MAXIMO", "8"))
+VERIFICAR_APOS = float(os.getenv("EPIMED_POOL_VERIFICAR_APOS", "30"))
+
+_trava = threading.Lock()
+# (pid, destino, somente_leitura) -> _Pool; os pools herdados de outro pid
+# ficam no dicionário sem uso (descartá-los fecharia as conexões do pai)
+_pools = {}
+_origens = {}  # id(conexão emprestada) -> _Pool
+
+class _Pool:
+
+    def __init__(self, destino, somente_leitura):
+        self.destino = destino
+        self.somente_leitura = somente_leitura
+        opcoes = f"-c statement_timeout={STATEMENT_TIMEOUT_MS}"
+        if somente_leitura:
+            opcoes += " -c default_transaction_read_only=on"
+        self.pool = pool.ThreadedConnectionPool(
+            0, POOL_MAXIMO,
+            application_name=f"{APLICACAO}:{os.getpid()}",
+            options=opcoes,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=5,
+            cursor_factory=rastreio.CursorRastreado,
+            **CONFIGS[(destino, somente_leitura)],
+        )
+        self.vagas = threading.BoundedSemaphore(POOL_MAXIMO)
+        self.devolvidas = {}  # id(conexão) -> instante da devolução
+
+    def obter(self):
+        self.vagas.acquire()
+        try:
+            while True:
+                conexao = self.pool.getconn()
+                ociosa = time.monotonic() - self.devolvidas.pop(id(conexao), time.monotonic())
+                if not conexao.closed and (ociosa < VERIFICAR_APOS or _saudavel(conexao)):
+                    return conexao
+                self.pool.putconn(conexao, close=True)
+        except BaseException:
+            self.vagas.release()
+            raise
+
+    def devolver(self, conexao):
+        quebrada = bool(conexao.closed)
+        if not quebrada and conexao.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conexao.rollback()
+            except psycopg2.Error:
+                quebrada = True
+        if not quebrada:
+            self.devolvidas[id(conexao)] = time.monotonic()
+        self.pool.putconn(conexao, close=quebrada)
+        self.vagas.release()
+
+def _saudavel(conexao):
+    try:
+        with conexao.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conexao.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _pool(destino, somente_leitura):
+    if (destino, somente_leitura) not in CONFIGS:
+        raise ValueError(f"Destino sem configuração: {destino} (somente_leitura={somente_leitura})")
+    chave = (os.getpid(), destino, somente_leitura)
+    with _trava:
+        if chave not in _pools:
+            _pools[chave] = _Pool(destino, somente_leitura)
+        return _pools[chave]
+
+def obter(destino="epimed", somente_leitura=False):
+    """Conexão do pool do destino; devolver com devolver()."""
+    origem = _pool(destino, somente_leitura)
+    conexao = origem.obter()
+    _origens[id(conexao)] = origem
+    return conexao
+
+def devolver(conexao):
+    """Devolve a conexão ao pool (transação aberta é desfeita; conexão quebrada é descartada)."""
+    _origens.pop(id(conexao)).devolver(conexao)
+
+@contextmanager
+def conexao(destino="epimed", somente_leitura=False):
+    conn = obter(destino, somente_leitura)
+    try:
+        yield conn
+    finally:
+        devolver(conn)
+
+def fechar_todos():
+    """Fecha os pools do processo atual."""
+    with _trava:
+        for chave in [c for c in _pools if c[0] == os.getpid()]:
+            _pools.pop(chave).pool.closeall()
+
+# Prioridade baixa: roda depois dos finalizadores que ainda gravam no banco
+multiprocessing.util.Finalize(None, fechar_todos, exitpriority=0)
@@ -0,0 +1,61 @@
+"""Compara os motores de comparação de exames (EPIMED_MOTOR_DIFF) numa ressincronização completa.
+
+Uso: python bench_diff.py [quantidade_de_linhas] [--memoria]   (padrão: 1.000.000)
+
+Com --memoria, cada motor roda de novo sob tracemalloc para medir o pico
+(a medição deixa a execução várias vezes mais lenta).
+
+A base local recebe 90% das chaves da origem, 2% delas com impressão diferente.
+O motor "ordenado" é medido sobre listas já ordenadas (no banco, a ordenação
+fica a cargo do ORDER BY).
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from bench_registros import gerar_linhas
+from diff_colunar import classificar_exames_colunar
+from diff_ordenado import chave_texto
+from registros import Exame
+from verificar_exames import classificar_exames, classificar_exames_ordenado
+
+def gerar_lados(quantidade):
+    origem = [Exame(*row) for row in gerar_linhas(quantidade)]
+    destino = []
+    for n, row in enumerate(gerar_linhas(quantidade)):
+        if n % 10 == 0:
+            continue
+        if n % 50 == 1:
+            row = row[:-1] + ("0" * 32,)
+        destino.append(Exame(*row))
+    return origem, destino
+
+def medir(nome, classificar, origem, destino, memoria=False):
+    gc.collect()
+    inicio = time.perf_counter()
+    novos, corrigidos, anulados = classificar(origem, destino)
+    duracao = time.perf_counter() - inicio
+    linha = (f"{nome:<10} {duracao:>7.2f} s  "
+             f"novos {len(novos):,}  corrigidos {len(corrigidos):,}  anulados {len(anulados):,}")
+    if memoria:
+        del novos, corrigidos, anulados
+        gc.collect()
+        tracemalloc.start()
+        classificar(origem, destino)
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        linha += f"  pico {pico / 2**20:.1f} MiB"
+    print(linha)
+
+if __name__ == "__main__":
+    argumentos = [a for a in sys.argv[1:] if a != "--memoria"]
+    memoria = "--memoria" in sys.argv[1:]
+    quantidade = int(argumentos[0]) if argumentos else 1_000_000
+    origem, destino = gerar_lados(quantidade)
+    print(f"Comparação de {len(origem):,} exames da origem com {len(destino):,} da base local:")
+    medir("conjunto", classificar_exames, origem, destino, memoria)
+    medir("numpy", classificar_exames_colunar, origem, destino, memoria)
+    origem.sort(key=chave_texto)
+    destino.sort(key=chave_texto)
+    medir("ordenado", classificar_exames_ordenado, origem, destino, memoria)
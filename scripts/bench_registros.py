@@ -0,0 +1,55 @@
+"""Compara a memória de linhas de exames como dict (formato anterior) e como registros Exame.
+
+Uso: python bench_registros.py [quantidade_de_linhas]   (padrão: 1.000.000)
+"""
+import gc
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from registros import Exame
+
+CAMPOS_DICT = (
+    "adm_id", "hospitaladmissionnumber", "medicalrecord", "soe_seq", "idexame", "nome_exame",
+    "valor", "tipo_inf_valor", "unidade", "result_sigla_exa", "result_material_exa_cod",
+    "ind_anulacao_laudo", "dthrcoleta", "impressao"
+)
+
+def gerar_linhas(quantidade):
+    """Linhas sintéticas no formato retornado pelo cursor de obter_exames_aghu."""
+    base = datetime(2025, 1, 1)
+    siglas = [f"EX{n:03d}" for n in range(300)]
+    for n in range(quantidade):
+        sigla = siglas[n % len(siglas)]
+        yield (
+            n // 40, 100000 + n // 40, 500000 + n // 40, n, sigla, f"Exame {sigla}",
+            str(n % 1000), "N", "mg/dL", sigla, 1, "N",
+            base + timedelta(minutes=n), f"{n:032x}"
+        )
+
+def medir(nome, construir, quantidade):
+    gc.collect()
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    registros = [construir(row) for row in gerar_linhas(quantidade)]
+    duracao = time.perf_counter() - inicio
+    atual, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{nome:<10} {len(registros):>10,} linhas  {atual / 2**20:>9.1f} MiB  "
+          f"{atual / len(registros):>7.0f} bytes/linha  {duracao:>6.2f} s")
+    del registros
+    return atual
+
+def construir_dict(row):
+    registro = dict(zip(CAMPOS_DICT, row))
+    # a chave era recalculada a cada comparação; aqui é guardada para comparação justa
+    registro["chave"] = (row[0], row[4], row[12].replace(tzinfo=None, microsecond=0))
+    return registro
+
+if __name__ == "__main__":
+    quantidade = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f"Memória de {quantidade:,} linhas de exames (dados + estrutura):")
+    memoria_dict = medir("dict", construir_dict, quantidade)
+    memoria_registro = medir("Exame", lambda row: Exame(*row), quantidade)
+    print(f"Redução: {(1 - memoria_registro / memoria_dict) * 100:.1f}%")
@@ -0,0 +1,159 @@
+"""Compactação das mensagens HL7 e respostas gravadas nos logs de envio.
+
+Cada valor compactado (bytea) começa com um cabeçalho de 5 bytes: o
+algoritmo (1 = zlib, 2 = zstd) e o id do dicionário em exa.dicionarios_hl7
+(0 = sem dicionário), seguido dos dados. As mensagens HL7 repetem quase
+todo o texto dos segmentos de uma mensagem para outra; com um dicionário
+treinado nessas repetições, mesmo mensagens curtas compactam bem.
+
+* zstd (pacote zstandard, opcional): dicionário treinado pelo zstd;
+* zlib: dicionário pré-definido (zdict, até 32 KiB) com os segmentos e
+  sequências de campos mais repetidos das amostras.
+
+Os dicionários nunca são removidos: qualquer valor gravado (inclusive nos
+arquivos exportados pela retenção) continua legível pelo id do cabeçalho.
+"""
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import Counter
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB, ZSTD = 1, 2
+ALGORITMOS = {"zlib": ZLIB, "zstd": ZSTD}
+
+ALGORITMO = ALGORITMOS[os.getenv("EPIMED_COMPACTACAO", "zstd" if zstandard else "zlib")]
+NIVEL_ZLIB = int(os.getenv("EPIMED_COMPACTACAO_NIVEL_ZLIB", "9"))
+NIVEL_ZSTD = int(os.getenv("EPIMED_COMPACTACAO_NIVEL_ZSTD", "12"))
+# zlib só aproveita os últimos 32 KiB do dicionário
+TAMANHO_DICIONARIO = {ZLIB: 32 * 1024, ZSTD: int(os.getenv("EPIMED_DICIONARIO_ZSTD_KB", "64")) * 1024}
+
+_CABECALHO = struct.Struct(">BI")
+_SEGMENTOS = re.compile(r"[\r\n]+")
+
+_dicionarios = {}  # id -> (algoritmo, conteúdo)
+_trava = threading.Lock()
+
+class Compactador:
+    """Compacta textos com um algoritmo e, opcionalmente, um dicionário (uso por uma thread)."""
+
+    def __init__(self, algoritmo=ZLIB, dicionario_id=0, dicionario=None):
+        if algoritmo == ZSTD and zstandard is None:
+            raise RuntimeError("Compactação zstd requer o pacote zstandard.")
+        self.algoritmo = algoritmo
+        self.dicionario_id = dicionario_id if dicionario else 0
+        self.dicionario = dicionario
+        if algoritmo == ZSTD:
+            dados = zstandard.ZstdCompressionDict(dicionario) if dicionario else None
+            self._zstd = zstandard.ZstdCompressor(level=NIVEL_ZSTD, dict_data=dados)
+
+    def compactar(self, texto):
+        if texto is None:
+            return None
+        dados = texto.encode("utf-8")
+        if self.algoritmo == ZSTD:
+            corpo = self._zstd.compress(dados)
+        else:
+            c = zlib.compressobj(NIVEL_ZLIB, zdict=self.dicionario) if self.dicionario else zlib.compressobj(NIVEL_ZLIB)
+            corpo = c.compress(dados) + c.flush()
+        return _CABECALHO.pack(self.algoritmo, self.dicionario_id) + corpo
+
+def _dicionario(conn, dicionario_id):
+    with _trava:
+        if dicionario_id in _dicionarios:
+            return _dicionarios[dicionario_id]
+    with conn.cursor() as cur:
+        cur.execute("SELECT algoritmo, conteudo FROM exa.dicionarios_hl7 WHERE id = %s", (dicionario_id,))
+        linha = cur.fetchone()
+    if linha is None:
+        raise LookupError(f"Dicionário HL7 {dicionario_id} não encontrado.")
+    with _trava:
+        _dicionarios[dicionario_id] = (linha[0], bytes(linha[1]))
+        return _dicionarios[dicionario_id]
+
+def descompactar(conn, valor):
+    """Texto original de um valor compactado (conn só é usada para buscar o dicionário)."""
+    if valor is None:
+        return None
+    valor = bytes(valor)
+    algoritmo, dicionario_id = _CABECALHO.unpack_from(valor)
+    corpo = valor[_CABECALHO.size:]
+    dicionario = _dicionario(conn, dicionario_id)[1] if dicionario_id else None
+    if algoritmo == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Valor compactado com zstd; instale o pacote zstandard para lê-lo.")
+        dados = zstandard.ZstdCompressionDict(dicionario) if dicionario else None
+        texto = zstandard.ZstdDecompressor(dict_data=dados).decompress(corpo)
+    else:
+        d = zlib.decompressobj(zdict=dicionario) if dicionario else zlib.decompressobj()
+        texto = d.decompress(corpo) + d.flush()
+    return texto.decode("utf-8")
+
+def compactador_ativo(conn, algoritmo=ALGORITMO):
+    """Compactador com o dicionário mais recente do algoritmo (sem dicionário se ainda não houver)."""
+    if algoritmo == ZSTD and zstandard is None:
+        algoritmo = ZLIB
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('exa.dicionarios_hl7') IS NOT NULL")
+        linha = None
+        if cur.fetchone()[0]:
+            cur.execute("""
+                SELECT id, conteudo FROM exa.dicionarios_hl7
+                WHERE algoritmo = %s ORDER BY id DESC LIMIT 1
+            """, (algoritmo,))
+            linha = cur.fetchone()
+    conn.rollback()
+    if linha is None:
+        return Compactador(algoritmo)
+    return Compactador(algoritmo, linha[0], bytes(linha[1]))
+
+def _dicionario_zlib(textos, tamanho):
+    """Trechos repetidos dos segmentos (o segmento inteiro e os campos repetidos),
+    os mais frequentes no fim, onde as distâncias até eles são menores."""
+    contagem = Counter()
+    for texto in textos:
+        for segmento in _SEGMENTOS.split(texto):
+            if not segmento:
+                continue
+            contagem[segmento + "\r"] += 1
+            # Sequências de 2 a 4 campos consecutivos (ex.: MSH|^~\&|AGHU|HCPA|)
+            campos = segmento.split("|")
+            for n in range(2, 5):
+                for i in range(len(campos) - n + 1):
+                    contagem["|".join(campos[i:i + n]) + "|"] += 1
+    escolhidos, total = [], 0
+    for trecho, vezes in sorted(contagem.items(), key=lambda t: t[1] * len(t[0]), reverse=True):
+        if vezes < 2:
+            continue
+        dados = trecho.encode("utf-8")
+        if total + len(dados) <= tamanho:
+            escolhidos.append(dados)
+            total += len(dados)
+    return b"".join(reversed(escolhidos))
+
+def treinar(textos, algoritmo=ALGORITMO):
+    """Conteúdo de um dicionário treinado nas amostras."""
+    textos = [t for t in textos if t]
+    if algoritmo == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Treino de dicionário zstd requer o pacote zstandard.")
+        amostras = [t.encode("utf-8") for t in textos]
+        return zstandard.train_dictionary(TAMANHO_DICIONARIO[ZSTD], amostras).as_bytes()
+    return _dicionario_zlib(textos, TAMANHO_DICIONARIO[ZLIB])
+
+def salvar_dicionario(conn, algoritmo, conteudo, amostras):
+    """Grava o dicionário, que passa a ser o ativo do algoritmo; retorna o id."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO exa.dicionarios_hl7 (algoritmo, conteudo, amostras)
+            VALUES (%s, %s, %s) RETURNING id
+        """, (algoritmo, conteudo, amostras))
+        dicionario_id = cur.fetchone()[0]
+    conn.commit()
+    return dicionario_id
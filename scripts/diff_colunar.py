@@ -0,0 +1,102 @@
+"""Comparação colunar (NumPy) de chaves de exames, para ressincronizações completas.
+
+As chaves (adm_id, idexame, dthrcoleta) viram três colunas int64: adm_id, o
+código da sigla internada e dthrcoleta em segundos de época. Os dois lados
+são ordenados juntos (lexsort) e cada chave recebe um posto denso, de modo
+que a comparação vira busca binária (searchsorted) sobre um único array
+int64, exata e sem tuplas Python nem conjuntos. O resultado são índices no
+lote de origem.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+EPOCA = datetime(1970, 1, 1)
+UM_SEGUNDO = timedelta(seconds=1)
+NULO = np.iinfo(np.int64).min
+
+def _inteiros(valores):
+    try:
+        return np.array(valores, dtype="i8")
+    except TypeError:  # None na chave
+        return np.array([NULO if v is None else v for v in valores], dtype="i8")
+
+def _colunas(exames, codigos):
+    """(adm_id, sigla, coleta) em arrays int64, a partir da chave normalizada (.chave)."""
+    chaves = [e.chave for e in exames]
+    return (
+        _inteiros([c[0] for c in chaves]),
+        np.array([codigos.setdefault(c[1], len(codigos)) for c in chaves], dtype="i8"),
+        np.array([NULO if c[2] is None else (c[2] - EPOCA) // UM_SEGUNDO for c in chaves], dtype="i8"),
+    )
+
+def postos(*colunas):
+    """Posto denso de cada linha: linhas com as mesmas chaves recebem o mesmo número."""
+    ordem = np.lexsort(colunas[::-1])
+    inicio_grupo = np.zeros(len(ordem), dtype=bool)
+    if len(ordem):
+        inicio_grupo[0] = True
+        for coluna in colunas:
+            ordenada = coluna[ordem]
+            inicio_grupo[1:] |= ordenada[1:] != ordenada[:-1]
+    resultado = np.empty(len(ordem), dtype="i8")
+    resultado[ordem] = np.cumsum(inicio_grupo) - 1
+    return resultado
+
+def localizar(postos_origem, postos_destino):
+    """Para cada posto da origem, índice da mesma chave no destino ou -1."""
+    if len(postos_destino) == 0:
+        return np.full(len(postos_origem), -1, dtype="i8")
+    ordem = np.argsort(postos_destino, kind="stable")
+    destino_ordenado = postos_destino[ordem]
+    posicoes = np.minimum(np.searchsorted(destino_ordenado, postos_origem), len(ordem) - 1)
+    return np.where(destino_ordenado[posicoes] == postos_origem, ordem[posicoes], -1)
+
+def primeiros_por_chave(postos_, preferidos):
+    """Índice de um registro por chave: o primeiro preferido ou, sem preferidos, o primeiro."""
+    ordem = np.lexsort((~preferidos, postos_))
+    ordenados = postos_[ordem]
+    inicio_grupo = np.ones(len(ordem), dtype=bool)
+    inicio_grupo[1:] = ordenados[1:] != ordenados[:-1]
+    return np.sort(ordem[inicio_grupo])
+
+def classificar_indices(exames_aghu, exames_epimed):
+    """Retorna (novos, corrigidos, anulados) como arrays de índices em exames_aghu.
+
+    Mesma regra de verificar_exames.classificar_exames: chave ausente no
+    destino é novo (se não anulado); chave presente com impressão diferente
+    é correção ou anulação. Chaves repetidas na origem: prevalece o laudo
+    não anulado.
+    """
+    codigos = {}
+    origem = _colunas(exames_aghu, codigos)
+    destino = _colunas(exames_epimed, codigos)
+    todos = postos(*(np.concatenate(par) for par in zip(origem, destino)))
+    postos_origem, postos_destino = todos[:len(exames_aghu)], todos[len(exames_aghu):]
+
+    anulados_origem = np.fromiter((e.ind_anulacao_laudo == "S" for e in exames_aghu),
+                                  dtype=bool, count=len(exames_aghu))
+    unicos = primeiros_por_chave(postos_origem, ~anulados_origem)
+    no_destino = localizar(postos_origem[unicos], postos_destino)
+    anulado = anulados_origem[unicos]
+
+    ausente = no_destino < 0
+    alterado = np.zeros(len(unicos), dtype=bool)
+    presentes = np.flatnonzero(~ausente)
+    alterado[presentes] = [
+        exames_aghu[i].impressao != exames_epimed[j].impressao
+        for i, j in zip(unicos[presentes].tolist(), no_destino[presentes].tolist())
+    ]
+
+    return (
+        unicos[ausente & ~anulado],
+        unicos[alterado & ~anulado],
+        unicos[alterado & anulado],
+    )
+
+def classificar_exames_colunar(exames_aghu, exames_epimed):
+    """classificar_indices convertido para listas de registros, na ordem da origem."""
+    return tuple(
+        [exames_aghu[i] for i in indices.tolist()]
+        for indices in classificar_indices(exames_aghu, exames_epimed)
+    )
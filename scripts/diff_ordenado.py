@@ -0,0 +1,89 @@
+"""Motor de diferenças por merge de dois fluxos ordenados pela chave (memória constante).
+
+A comparação usa chave_texto(registro): cada parte da chave dos registros
+(.chave) vira texto, com datas em ISO 8601 (AAAA-MM-DDTHH:MM:SS), de modo que o
+ORDER BY do banco (ordem_sql, texto com COLLATE "C") produza exatamente a
+mesma ordem independente do tipo das colunas. A ordem é verificada durante o
+merge: um fluxo fora de ordem gera ErroOrdenacao em vez de um diff incorreto.
+"""
+import heapq
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+
+INSERIR = "inserir"    # só na origem
+REMOVER = "remover"    # só no destino
+ALTERAR = "alterar"    # nos dois lados, com conteúdo diferente
+
+class ErroOrdenacao(Exception):
+    pass
+
+def _texto(valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    return str(valor)
+
+def chave_texto(registro):
+    """Chave de ordenação do merge, comparável com o ORDER BY de ordem_sql."""
+    chave = registro.chave if isinstance(registro.chave, tuple) else (registro.chave,)
+    return tuple(_texto(v) for v in chave)
+
+def ordem_sql(*colunas, datas=()):
+    """ORDER BY equivalente a chave_texto para as colunas da chave (datas: colunas timestamp)."""
+    termos = []
+    for coluna in colunas:
+        if coluna in datas:
+            expressao = f"to_char({coluna}, 'YYYY-MM-DD\"T\"HH24:MI:SS')"
+        else:
+            expressao = f"{coluna}::text"
+        termos.append(f'COALESCE({expressao}, \'\') COLLATE "C"')
+    return "ORDER BY " + ", ".join(termos)
+
+def _verificar_ordem(fluxo, nome, contagem=None):
+    """Gera (chave_texto, registro), calculando a chave uma única vez por registro."""
+    anterior = None
+    for registro in fluxo:
+        chave = chave_texto(registro)
+        if anterior is not None and chave < anterior:
+            raise ErroOrdenacao(f"Fluxo {nome} fora de ordem: {chave!r} após {anterior!r}")
+        anterior = chave
+        if contagem is not None:
+            contagem[nome] = contagem.get(nome, 0) + 1
+        yield chave, registro
+
+def _sem_duplicatas(fluxo, escolher):
+    for chave, grupo in groupby(fluxo, key=itemgetter(0)):
+        registros = [registro for _, registro in grupo]
+        yield chave, registros[0] if len(registros) == 1 or escolher is None else escolher(registros)
+
+def mesclar(*fluxos):
+    """Une fluxos ordenados pela chave em um único fluxo ordenado."""
+    return heapq.merge(*fluxos, key=chave_texto)
+
+def diff_ordenado(origem, destino, alterado=None, escolher=None, contagem=None):
+    """Gera (acao, registro_origem, registro_destino) numa única passada de merge.
+
+    alterado(origem, destino) -> bool decide se chaves iguais geram ALTERAR;
+    escolher(registros) escolhe um registro quando a origem repete a chave
+    (padrão: o primeiro). contagem, se informado, recebe o total lido de cada lado.
+    """
+    it_origem = _sem_duplicatas(_verificar_ordem(origem, "origem", contagem), escolher)
+    it_destino = _sem_duplicatas(_verificar_ordem(destino, "destino", contagem), None)
+
+    ko, o = next(it_origem, (None, None))
+    kd, d = next(it_destino, (None, None))
+
+    while o is not None or d is not None:
+        if d is None or (o is not None and ko < kd):
+            yield INSERIR, o, None
+            ko, o = next(it_origem, (None, None))
+        elif o is None or kd < ko:
+            yield REMOVER, None, d
+            kd, d = next(it_destino, (None, None))
+        else:
+            if alterado is not None and alterado(o, d):
+                yield ALTERAR, o, d
+            ko, o = next(it_origem, (None, None))
+            kd, d = next(it_destino, (None, None))
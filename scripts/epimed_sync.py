@@ -0,0 +1,131 @@
+"""Ponto de entrada único das rotinas de sincronização com o Epimed.
+
+Uso: python epimed_sync.py <comando> [argumentos]
+
+    leitos    [--forcar] [--processos N]    sincronização de leitos (verificar_leitos.py)
+    exames    [--forcar] [--processos N]    rotina de exames (verificar_exames.py)
+    backfill  iniciar|retomar|status ...    carga histórica (backfill.py)
+    reconcile [dias]                        reconciliação por faixas (reconciliar.py)
+    replay    listar [entidade] | liberar <entidade> <chave> [operador]
+              itens rejeitados em quarentena, liberados para reenvio na
+              próxima execução (quarentena_hl7.py)
+    bench     diff [quantidade] [--memoria] | registros [quantidade]
+              | partida [repetições]
+
+Cada comando importa só os módulos de que precisa (requests, psycopg2,
+numpy...), na hora de executar. O .env é carregado uma única vez, aqui,
+antes de qualquer rotina: as configurações EPIMED_* lidas na importação
+dos módulos também vêm dele. O tempo de partida (do início do processo
+até o comando começar) é informado em stderr; "bench partida" mede esse
+tempo para cada comando, em processos novos.
+"""
+import importlib
+import os
+import sys
+import time
+
+DIR_SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+# Só importa o módulo do comando e sai (usado por "bench partida")
+SOMENTE_PARTIDA = os.getenv("EPIMED_SOMENTE_PARTIDA") == "1"
+
+# comando -> (módulo, argumentos repassados à linha de comando do próprio módulo)
+COMANDOS = {
+    "leitos": ("verificar_leitos", False),
+    "exames": ("verificar_exames", False),
+    "backfill": ("backfill", True),
+    "reconcile": ("reconciliar", True),
+    "replay": ("quarentena_hl7", True),
+    "bench": (None, True),
+}
+BENCHMARKS = {"diff": "bench_diff", "registros": "bench_registros"}
+
+_INICIO = time.perf_counter()
+
+def tempo_desde_inicio():
+    """Segundos desde o início do processo (pelo /proc; na falta dele, desde a importação deste módulo)."""
+    try:
+        with open("/proc/self/stat") as f:
+            inicio = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            ativo = float(f.read().split()[0])
+        return max(0.0, ativo - inicio / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - _INICIO
+
+def carregar_env():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+def _opcoes_rotina(comando, argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog=f"epimed_sync.py {comando}")
+    parser.add_argument("--forcar", action="store_true", help="roda mesmo sem alterações nas origens")
+    parser.add_argument("--processos", type=int, help="processos em paralelo (padrão: EPIMED_PROCESSOS)")
+    return vars(parser.parse_args(argv))
+
+def _repassar(modulo, argv):
+    """Executa o bloco __main__ do módulo com os argumentos, como em "python <módulo>.py ..."."""
+    import runpy
+
+    sys.argv = [os.path.join(DIR_SCRIPTS, f"{modulo}.py")] + argv
+    runpy.run_module(modulo, run_name="__main__", alter_sys=True)
+
+def medir_partida(repeticoes=5):
+    """Tempo de partida de cada comando (mediana de processos novos, até o módulo importado)."""
+    import statistics
+    import subprocess
+
+    ambiente = dict(os.environ, EPIMED_SOMENTE_PARTIDA="1")
+    print(f"Partida dos comandos (mediana de {repeticoes} execuções):")
+    for comando in [c for c in COMANDOS if c != "bench"] + [f"bench {b}" for b in BENCHMARKS]:
+        tempos = []
+        for _ in range(repeticoes):
+            inicio = time.perf_counter()
+            subprocess.run([sys.executable, os.path.abspath(__file__)] + comando.split(),
+                           env=ambiente, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            tempos.append(time.perf_counter() - inicio)
+        print(f"  {comando:<16} {statistics.median(tempos) * 1000:8.0f} ms")
+
+def main(argv):
+    if not argv or argv[0] not in COMANDOS:
+        print(__doc__)
+        return 1
+    comando, argumentos = argv[0], argv[1:]
+    modulo, repassar = COMANDOS[comando]
+
+    if comando == "bench":
+        if not argumentos or argumentos[0] not in (*BENCHMARKS, "partida"):
+            print(__doc__)
+            return 1
+        if argumentos[0] == "partida":
+            medir_partida(int(argumentos[1]) if len(argumentos) > 1 else 5)
+            return 0
+        modulo = BENCHMARKS[argumentos[0]]
+        argumentos = argumentos[1:]
+
+    carregar_env()
+    if repassar and not SOMENTE_PARTIDA:
+        # run_module importa e executa o módulo uma única vez, como __main__
+        print(f"[epimed_sync] {comando}: partida em {tempo_desde_inicio() * 1000:.0f} ms", file=sys.stderr)
+        _repassar(modulo, argumentos)
+        return 0
+
+    opcoes = None if repassar else _opcoes_rotina(comando, argumentos)
+    inicio_importacao = time.perf_counter()
+    rotina = importlib.import_module(modulo)
+    if SOMENTE_PARTIDA:
+        return 0
+    print(f"[epimed_sync] {comando}: partida em {tempo_desde_inicio() * 1000:.0f} ms "
+          f"(importação {(time.perf_counter() - inicio_importacao) * 1000:.0f} ms)", file=sys.stderr)
+
+    if comando == "leitos":
+        rotina.sincronizar_leitos(**opcoes)
+    else:
+        rotina.verificar_e_enviar_exames(**opcoes)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+def obter_estado(conexao, chave, validade=None):
+    """Valor gravado para a chave; None se inexistente ou mais antigo que validade (timedelta)."""
+    with conexao.cursor() as cursor:
+        cursor.execute("SELECT valor, atualizado_em FROM estado_sincronizacao WHERE chave = %s", (chave,))
+        row = cursor.fetchone()
+    if not row:
+        return None
+    if validade is not None and row[1] < datetime.now() - validade:
+        return None
+    return row[0]
+
+def salvar_estado(conexao, chave, valor):
+    with conexao.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO estado_sincronizacao (chave, valor, atualizado_em)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (chave) DO UPDATE
+            SET valor = EXCLUDED.valor, atualizado_em = NOW()
+        """, (chave, None if valor is None else str(valor)))
+
+def obter_data(conexao, chave):
+    valor = obter_estado(conexao, chave)
+    return datetime.fromisoformat(valor) if valor else None
+
+def salvar_data(conexao, chave, data):
+    salvar_estado(conexao, chave, data.isoformat() if data else None)
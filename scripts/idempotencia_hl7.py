@@ -0,0 +1,67 @@
+import hashlib
+import uuid
+from datetime import datetime
+
+# Decisões retornadas por preparar_envio
+ENVIAR = "enviar"        # conteúdo novo: enviar com novo MSH-10
+REENVIAR = "reenviar"    # mesmo conteúdo sem confirmação: reenviar com o mesmo MSH-10
+IGNORAR = "ignorar"      # mesmo conteúdo já aceito: não enviar
+
+def hash_payload(*campos):
+    """Hash do conteúdo semântico da mensagem (sem timestamps e ids de envio)."""
+    texto = "|".join("" if c is None else str(c) for c in campos)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+def chave_leito(lto_id):
+    return str(lto_id)
+
+def chave_exame(adm_id, idexame, dthrcoleta):
+    return f"{adm_id}|{idexame}|{dthrcoleta.replace(tzinfo=None, microsecond=0):%Y%m%d%H%M%S}"
+
+def gerar_controle_msh10():
+    return f"{datetime.now():%Y%m%d%H%M%S}_ORU_{uuid.uuid4().hex[:16]}"
+
+def consultar_envio(conexao, entidade, chave):
+    with conexao.cursor() as cursor:
+        cursor.execute("""
+            SELECT hash_payload, controle_msh10, status
+            FROM idempotencia_hl7
+            WHERE entidade = %s AND chave = %s
+        """, (entidade, chave))
+        return cursor.fetchone()
+
+def preparar_envio(conexao, entidade, chave, hash_atual):
+    """Decide se a mensagem deve ser enviada e retorna (decisao, controle_msh10).
+
+    Em ENVIAR o registro 'pendente' é gravado e confirmado (commit) antes do
+    envio, para sobreviver a falhas ambíguas (timeout após o processamento,
+    queda antes da gravação local).
+    """
+    registro = consultar_envio(conexao, entidade, chave)
+
+    if registro and registro[0] == hash_atual:
+        if registro[2] == "aceito":
+            return IGNORAR, registro[1]
+        return REENVIAR, registro[1]
+
+    controle = gerar_controle_msh10()
+    with conexao.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO idempotencia_hl7 (entidade, chave, hash_payload, controle_msh10, status, atualizado_em)
+            VALUES (%s, %s, %s, %s, 'pendente', NOW())
+            ON CONFLICT (entidade, chave) DO UPDATE
+            SET hash_payload = EXCLUDED.hash_payload,
+                controle_msh10 = EXCLUDED.controle_msh10,
+                status = 'pendente',
+                atualizado_em = NOW()
+        """, (entidade, chave, hash_atual, controle))
+    conexao.commit()
+    return ENVIAR, controle
+
+def registrar_aceite(conexao, entidade, chave, controle_msh10):
+    with conexao.cursor() as cursor:
+        cursor.execute("""
+            UPDATE idempotencia_hl7
+            SET status = 'aceito', atualizado_em = NOW()
+            WHERE entidade = %s AND chave = %s AND controle_msh10 = %s
+        """, (entidade, chave, controle_msh10))
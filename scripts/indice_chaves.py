@@ -0,0 +1,286 @@
+"""Índice local em disco das chaves já gravadas em exa.internacoes, exa.admissoes e exa.exames.
+
+Um arquivo por entidade, com registros de 8 bytes de hash da chave
+(chave_texto do registro) e 8 bytes de hash do valor (da impressão inteira
+do exame; 0 nas demais entidades):
+
+    cabeçalho (32 bytes): assinatura, quantidade do segmento ordenado
+    segmento ordenado:    n hashes de chave (uint64), depois n hashes de valor
+    cauda:                pares (chave, valor) acrescentados após cada gravação
+
+O segmento ordenado é lido por mmap e consultado por busca binária; a cauda
+fica em memória e é incorporada ao segmento em compactar(). Acréscimos,
+compactação e reconstrução são serializados entre processos por flock no
+arquivo <índice>.lock; a compactação relê o arquivo sob a trava, para não
+perder pares acrescentados por outro processo. Ao repetir uma
+chave, vale o último valor. Uma gravação que falhe antes do acréscimo só faz
+a chave parecer nova na próxima execução (os INSERTs usam ON CONFLICT e o
+registro de idempotência evita reenvio); o comando validar compara o índice
+com as tabelas e reconstruir o refaz a partir delas.
+
+Rotinas que gravam nessas tabelas fora da rotina de exames acrescentam ao
+índice o que gravaram (acrescentar_existente).
+
+Uso: python indice_chaves.py validar|reconstruir [internacoes|admissoes|exames]
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from diff_ordenado import chave_texto
+
+DIR_INDICE = os.getenv("EPIMED_DIR_INDICE", "/var/www/html/epimed/indice")
+
+ASSINATURA = b"EPIDX002"
+CABECALHO = struct.Struct("=8sQ16x")
+TAMANHO_PAR = 16
+
+# Cauda acima deste tamanho (ou de 1/8 do segmento) é compactada ao fechar
+LIMITE_CAUDA = 100_000
+
+def caminho_indice(entidade):
+    return os.path.join(DIR_INDICE, f"{entidade}.idx")
+
+@contextmanager
+def _trava(caminho):
+    """Trava exclusiva (flock) do índice, num arquivo ao lado: o próprio índice é trocado por os.replace."""
+    with open(f"{caminho}.lock", "a") as arquivo:
+        fcntl.flock(arquivo.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(arquivo.fileno(), fcntl.LOCK_UN)
+
+def hash_chave(registro):
+    texto = "\x1f".join(chave_texto(registro)).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(texto, digest_size=8).digest(), "little")
+
+def hash_valor(registro):
+    impressao = getattr(registro, "impressao", None)
+    if not impressao:
+        return 0
+    return int.from_bytes(hashlib.blake2b(impressao.encode("utf-8"), digest_size=8).digest(), "little")
+
+def _gravar(caminho, chaves, valores):
+    """Grava o arquivo inteiro (segmento ordenado, sem cauda) e troca o anterior de forma atômica."""
+    temporario = f"{caminho}.tmp"
+    with open(temporario, "wb") as arquivo:
+        arquivo.write(CABECALHO.pack(ASSINATURA, len(chaves)))
+        chaves.tofile(arquivo)
+        valores.tofile(arquivo)
+        arquivo.flush()
+        os.fsync(arquivo.fileno())
+    os.replace(temporario, caminho)
+
+def reconstruir(caminho, registros):
+    """Refaz o índice a partir dos registros da tabela (por exemplo, um fluxo do banco)."""
+    pares = {}
+    for registro in registros:
+        pares[hash_chave(registro)] = hash_valor(registro)
+    chaves = array("Q", sorted(pares))
+    valores = array("Q", (pares[c] for c in chaves))
+    del pares
+    os.makedirs(os.path.dirname(caminho) or ".", exist_ok=True)
+    with _trava(caminho):
+        _gravar(caminho, chaves, valores)
+    return len(chaves)
+
+class IndiceChaves:
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._abrir()
+
+    def _abrir(self):
+        self._arquivo = open(self.caminho, "rb")
+        cabecalho = self._arquivo.read(CABECALHO.size)
+        assinatura, self.ordenados = (CABECALHO.unpack(cabecalho) if len(cabecalho) == CABECALHO.size
+                                      else (None, 0))
+        if assinatura != ASSINATURA:
+            self._arquivo.close()
+            raise ValueError(f"{self.caminho}: arquivo não é um índice de chaves")
+
+        fim_segmento = CABECALHO.size + self.ordenados * TAMANHO_PAR
+        self._mapa = None
+        self._visoes = []
+        self._chaves = self._valores = array("Q")
+        if self.ordenados:
+            self._mapa = mmap.mmap(self._arquivo.fileno(), fim_segmento, access=mmap.ACCESS_READ)
+            base = memoryview(self._mapa)
+            visao = base[CABECALHO.size:].cast("Q")
+            self._chaves = visao[:self.ordenados]
+            self._valores = visao[self.ordenados:]
+            self._visoes = [base, visao, self._chaves, self._valores]
+
+        # Cauda: pares acrescentados depois da última compactação (um par
+        # incompleto no fim, de uma escrita interrompida, é ignorado)
+        self._arquivo.seek(fim_segmento)
+        dados = self._arquivo.read()
+        cauda = array("Q")
+        cauda.frombytes(dados[:len(dados) - len(dados) % TAMANHO_PAR])
+        self.cauda = dict(zip(cauda[::2], cauda[1::2]))
+
+    def fechar(self, compactar=True):
+        if compactar and len(self.cauda) > max(LIMITE_CAUDA, self.ordenados // 8):
+            self.compactar()
+        self._liberar()
+
+    def _liberar(self):
+        if self._mapa is not None:
+            for visao in reversed(self._visoes):
+                visao.release()
+            self._visoes = []
+            self._chaves = self._valores = array("Q")
+            self._mapa.close()
+            self._mapa = None
+        self._arquivo.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.fechar()
+
+    def __len__(self):
+        return self.ordenados + sum(1 for c in self.cauda if self._posicao(c) is None)
+
+    def _posicao(self, chave):
+        i = bisect_left(self._chaves, chave)
+        return i if i < self.ordenados and self._chaves[i] == chave else None
+
+    def buscar(self, registro):
+        """Hash do valor gravado para a chave do registro, ou None se a chave não está no índice."""
+        chave = hash_chave(registro)
+        valor = self.cauda.get(chave)
+        if valor is not None:
+            return valor
+        i = self._posicao(chave)
+        return self._valores[i] if i is not None else None
+
+    def contem(self, registro):
+        return self.buscar(registro) is not None
+
+    def alterado(self, registro):
+        """True se a chave está no índice com outro valor (ex.: impressão do exame)."""
+        valor = self.buscar(registro)
+        return valor is not None and valor != hash_valor(registro)
+
+    def acrescentar(self, registros):
+        """Acrescenta ao fim do arquivo as chaves de registros já gravados (e confirmados) no banco."""
+        pares = array("Q")
+        for registro in registros:
+            chave, valor = hash_chave(registro), hash_valor(registro)
+            pares.extend((chave, valor))
+            self.cauda[chave] = valor
+        if pares:
+            with _trava(self.caminho), open(self.caminho, "ab") as arquivo:
+                pares.tofile(arquivo)
+                arquivo.flush()
+                os.fsync(arquivo.fileno())
+        return len(pares) // 2
+
+    def compactar(self):
+        """Incorpora a cauda ao segmento ordenado (merge linear) e regrava o arquivo.
+
+        Sob a trava, o arquivo é relido antes do merge: a cauda em disco inclui
+        os pares desta instância e os acrescentados por outros processos.
+        """
+        with _trava(self.caminho):
+            self._liberar()
+            self._abrir()
+            self._compactar()
+
+    def _compactar(self):
+        chaves, valores = array("Q"), array("Q")
+        inicio = 0
+        for chave, valor in sorted(self.cauda.items()):
+            i = bisect_left(self._chaves, chave, inicio)
+            chaves.frombytes(self._chaves[inicio:i].tobytes())
+            valores.frombytes(self._valores[inicio:i].tobytes())
+            chaves.append(chave)
+            valores.append(valor)
+            inicio = i + 1 if i < self.ordenados and self._chaves[i] == chave else i
+        chaves.frombytes(self._chaves[inicio:].tobytes())
+        valores.frombytes(self._valores[inicio:].tobytes())
+
+        self._liberar()
+        _gravar(self.caminho, chaves, valores)
+        self._abrir()
+
+def abrir(caminho, carregar):
+    """Abre o índice; se ainda não existe (ou é de outra versão), constrói a partir de carregar()."""
+    if os.path.exists(caminho):
+        try:
+            return IndiceChaves(caminho)
+        except ValueError:
+            pass
+    reconstruir(caminho, carregar())
+    return IndiceChaves(caminho)
+
+def acrescentar_existente(entidade, registros):
+    """Acrescenta registros já gravados ao índice da entidade, se ele existir (sem compactar)."""
+    if not registros or not os.path.exists(caminho_indice(entidade)):
+        return 0
+    try:
+        indice = IndiceChaves(caminho_indice(entidade))
+    except ValueError:
+        return 0  # de outra versão: será reconstruído na abertura
+    try:
+        return indice.acrescentar(registros)
+    finally:
+        indice.fechar(compactar=False)
+
+def validar(indice, registros):
+    """Compara o índice com os registros da tabela.
+
+    Retorna contagens: presentes, ausentes (na tabela e não no índice),
+    divergentes (valor diferente) e excedentes (no índice e não na tabela).
+    As chaves das tabelas são únicas, então cada registro é contado uma vez.
+    """
+    resultado = {"presentes": 0, "ausentes": 0, "divergentes": 0}
+    for registro in registros:
+        valor = indice.buscar(registro)
+        if valor is None:
+            resultado["ausentes"] += 1
+        else:
+            resultado["presentes"] += 1
+            if valor != hash_valor(registro):
+                resultado["divergentes"] += 1
+    resultado["excedentes"] = len(indice) - resultado["presentes"]
+    return resultado
+
+if __name__ == "__main__":
+    import banco
+    import verificar_exames
+
+    comandos = ("validar", "reconstruir")
+    if len(sys.argv) < 2 or sys.argv[1] not in comandos:
+        print(__doc__)
+        sys.exit(1)
+
+    comando = sys.argv[1]
+    entidades = sys.argv[2:] or list(verificar_exames.LEITORES_INDICE)
+    conn = banco.obter()
+    codigo_saida = 0
+    try:
+        for entidade in entidades:
+            caminho = caminho_indice(entidade)
+            registros = verificar_exames.LEITORES_INDICE[entidade](conn, fluxo=True)
+            if comando == "reconstruir":
+                print(f"{entidade}: {reconstruir(caminho, registros)} chaves gravadas em {caminho}")
+            else:
+                with IndiceChaves(caminho) as indice:
+                    resultado = validar(indice, registros)
+                print(f"{entidade}: " + ", ".join(f"{k} {v}" for k, v in resultado.items()))
+                if resultado["ausentes"] or resultado["divergentes"] or resultado["excedentes"]:
+                    codigo_saida = 2
+            conn.commit()
+    finally:
+        banco.devolver(conn)
+    sys.exit(codigo_saida)
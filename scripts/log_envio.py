@@ -0,0 +1,403 @@
+"""Gravação dos logs de envio HL7 fora do caminho do envio.
+
+Antes, cada mensagem custava dois comandos síncronos na transação do envio
+(INSERT ... RETURNING id antes e UPDATE depois). Agora:
+
+* os ids vêm de blocos reservados da sequência da tabela (um nextval por
+  bloco de TAMANHO_BLOCO, numa conexão própria), de modo que o id — usado
+  como clientid na mensagem de leitos — é conhecido sem ida ao banco;
+* envio e resposta ficam num buffer em memória e uma thread gravadora os
+  grava com COPY em lotes, numa conexão do pool separada da do envio.
+
+Uma linha é gravada quando a resposta chega (status 'enviado') ou, sem
+resposta, no fechamento do gravador (status 'pendente'). Se o banco recusa
+o COPY (DataError/IntegrityError), o lote é gravado linha a linha (uma
+linha inválida não impede as demais; as recusadas vão para
+DIR_PENDENTES/*.rejeitados.jsonl). Sem conexão, o lote volta ao buffer e,
+no fechamento, é salvo em DIR_PENDENTES/*.jsonl, regravado pela próxima
+execução; um arquivo ilegível é renomeado para .rejeitados.jsonl. Uma queda do
+processo perde apenas os logs ainda no buffer; o estado de cada envio
+continua no registro de idempotência, gravado na transação do envio.
+
+Mensagem e resposta são gravadas compactadas (compactacao_hl7) em
+mensagem_z e resposta_z; ler_log() e buscar_logs() as devolvem em texto.
+Linhas antigas, com o texto nas colunas mensagem e resposta, são
+convertidas em lotes por "python log_envio.py migrar".
+
+Uso: python log_envio.py ler <tabela> <id> | buscar <tabela> <entidade>
+                         | treinar [amostras] | migrar [tabela]
+"""
+import csv
+import glob
+import io
+import json
+import logging
+import multiprocessing.util
+import os
+import sys
+import threading
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import banco
+import compactacao_hl7
+
+TAMANHO_BLOCO = int(os.getenv("EPIMED_LOG_BLOCO_IDS", "100"))
+TAMANHO_LOTE = int(os.getenv("EPIMED_LOG_LOTE", "200"))
+INTERVALO = float(os.getenv("EPIMED_LOG_INTERVALO", "2"))
+LOTE_MIGRACAO = int(os.getenv("EPIMED_LOG_LOTE_MIGRACAO", "2000"))
+AMOSTRAS_DICIONARIO = int(os.getenv("EPIMED_LOG_AMOSTRAS_DICIONARIO", "5000"))
+# Logs que não puderam ser gravados no fechamento
+DIR_PENDENTES = os.getenv("EPIMED_DIR_LOG_ENVIO", "/var/www/html/epimed/log_envio")
+
+# tabela -> (coluna da entidade enviada, coluna que repete o id ou None, coluna da referência ou None)
+TABELAS = {
+    "exa.log_envio_hl7": ("chave", None, "exame_id"),
+    "public.log_envio_hl7": ("lto_id", "id_log", None),
+}
+
+logger = logging.getLogger("log_envio")
+
+class GravadorLogEnvio:
+
+    def __init__(self, tabela):
+        self.tabela = tabela
+        self.coluna_entidade, self.coluna_id_log, self.coluna_referencia = TABELAS[tabela]
+        self.colunas = ["id", self.coluna_entidade, "data_envio", "status", "mensagem_z", "resposta_z"]
+        self.colunas += [c for c in (self.coluna_id_log, self.coluna_referencia) if c]
+        self._ids = []
+        self._trava_ids = threading.Lock()
+        self._pendentes = {}   # id -> registro (aguardando resposta)
+        self._prontos = []     # registros completos, aguardando gravação
+        self._trava = threading.Lock()
+        self._condicao = threading.Condition(self._trava)
+        self._encerrar = False
+        self._sequencia = None
+        self._compactador = None
+        self._thread = threading.Thread(target=self._gravar_periodicamente, name=f"log-{tabela}", daemon=True)
+        self._thread.start()
+
+    def reservar_id(self):
+        """Próximo id do bloco reservado (reserva um novo bloco quando acaba)."""
+        with self._trava_ids:
+            if not self._ids:
+                self._ids = self._reservar_bloco()
+            return self._ids.pop(0)
+
+    def _reservar_bloco(self):
+        with banco.conexao() as conn:
+            with conn.cursor() as cur:
+                if self._sequencia is None:
+                    cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (self.tabela,))
+                    self._sequencia = cur.fetchone()[0]
+                cur.execute("SELECT nextval(%s) FROM generate_series(1, %s)", (self._sequencia, TAMANHO_BLOCO))
+                ids = [row[0] for row in cur.fetchall()]
+            conn.commit()
+        return ids
+
+    def registrar_envio(self, log_id, entidade, mensagem, referencia=None):
+        """referencia vai para a coluna de referência da tabela (exa: exame_id, o idexame)."""
+        with self._trava:
+            self._pendentes[log_id] = {
+                "id": log_id, "entidade": entidade, "data_envio": datetime.now(),
+                "status": "pendente", "mensagem": mensagem, "resposta": None,
+                "referencia": referencia,
+            }
+
+    def registrar_resposta(self, log_id, resposta, status="enviado"):
+        with self._condicao:
+            registro = self._pendentes.pop(log_id, None)
+            if registro is None:
+                return
+            registro["resposta"] = resposta
+            registro["status"] = status
+            self._prontos.append(registro)
+            if len(self._prontos) >= TAMANHO_LOTE:
+                self._condicao.notify()
+
+    def _gravar_periodicamente(self):
+        self._recuperar_pendentes()
+        while True:
+            with self._condicao:
+                if not self._encerrar and len(self._prontos) < TAMANHO_LOTE:
+                    self._condicao.wait(INTERVALO)
+                encerrar = self._encerrar
+            self.descarregar()
+            if encerrar:
+                return
+
+    def _linha(self, r):
+        linha = [r["id"], r["entidade"], r["data_envio"], r["status"],
+                 self._compactador.compactar(r["mensagem"]), self._compactador.compactar(r["resposta"])]
+        if self.coluna_id_log:
+            linha.append(r["id"])
+        if self.coluna_referencia:
+            linha.append(r.get("referencia"))
+        return linha
+
+    def descarregar(self, incluir_pendentes=False):
+        """Grava com COPY os registros prontos (e, se pedido, os sem resposta)."""
+        with self._trava:
+            lote, self._prontos = self._prontos, []
+            if incluir_pendentes:
+                lote.extend(self._pendentes.values())
+                self._pendentes.clear()
+        if not lote:
+            return 0
+
+        try:
+            with banco.conexao() as conn:
+                if self._compactador is None:
+                    self._compactador = compactacao_hl7.compactador_ativo(conn)
+                dados = io.StringIO()
+                escritor = csv.writer(dados)
+                for r in lote:
+                    escritor.writerow([_bytea(v) if isinstance(v, bytes) else v for v in self._linha(r)])
+                dados.seek(0)
+                with conn.cursor() as cur:
+                    cur.copy_expert(
+                        f"COPY {self.tabela} ({', '.join(self.colunas)}) FROM STDIN WITH (FORMAT csv)", dados)
+                conn.commit()
+        except (psycopg2.DataError, psycopg2.IntegrityError) as erro:
+            # Linha recusada pelo banco: as demais são gravadas uma a uma, sem prender o buffer
+            logger.error(f"COPY de {len(lote)} log(s) de envio recusado por {self.tabela} ({erro}); "
+                         f"gravando linha a linha.")
+            restantes = self._inserir_um_a_um(lote)
+            if restantes:
+                with self._trava:
+                    self._prontos[:0] = restantes
+            return len(lote) - len(restantes)
+        except Exception as erro:
+            # Volta ao buffer: a próxima descarga (ou o fechamento) tenta de novo
+            with self._trava:
+                self._prontos[:0] = lote
+            logger.error(f"Falha ao gravar {len(lote)} log(s) de envio em {self.tabela}: {erro}")
+            return 0
+        return len(lote)
+
+    def _inserir_um_a_um(self, lote):
+        """INSERT de cada linha num savepoint; retorna as não gravadas por falha de conexão.
+
+        As recusadas pelo banco são salvas em .rejeitados.jsonl e não voltam ao buffer.
+        """
+        recusadas = []
+        try:
+            with banco.conexao() as conn:
+                if self._compactador is None:
+                    self._compactador = compactacao_hl7.compactador_ativo(conn)
+                with conn.cursor() as cur:
+                    for r in lote:
+                        cur.execute("SAVEPOINT log_envio")
+                        try:
+                            cur.execute(f"INSERT INTO {self.tabela} ({', '.join(self.colunas)}) "
+                                        f"VALUES ({', '.join(['%s'] * len(self.colunas))})", self._linha(r))
+                        except (psycopg2.DataError, psycopg2.IntegrityError) as erro:
+                            cur.execute("ROLLBACK TO SAVEPOINT log_envio")
+                            logger.error(f"Log de envio {r['id']} ({r['entidade']}) recusado por "
+                                         f"{self.tabela}: {erro}")
+                            recusadas.append(r)
+                conn.commit()
+        except Exception as erro:
+            logger.error(f"Falha ao gravar logs de envio em {self.tabela} linha a linha: {erro}")
+            return lote
+        if recusadas:
+            self._salvar_em_disco(recusadas, ".rejeitados.jsonl")
+        return []
+
+    def _salvar_em_disco(self, registros, sufixo=".jsonl"):
+        caminho = os.path.join(DIR_PENDENTES, f"{self.tabela}_{os.getpid()}_{datetime.now():%Y%m%d%H%M%S%f}{sufixo}")
+        try:
+            os.makedirs(DIR_PENDENTES, exist_ok=True)
+            with open(caminho + ".tmp", "w", encoding="utf-8") as f:
+                for r in registros:
+                    f.write(json.dumps(dict(r, data_envio=r["data_envio"].isoformat()), default=str) + "\n")
+            os.replace(caminho + ".tmp", caminho)
+        except OSError as erro:
+            logger.error(f"{len(registros)} log(s) de envio de {self.tabela} perdidos: {erro}")
+            return
+        logger.warning(f"{len(registros)} log(s) de envio de {self.tabela} salvos em {caminho}.")
+
+    def _recuperar_pendentes(self):
+        """Volta ao buffer os logs salvos em disco por execuções anteriores (cada arquivo, por um só processo)."""
+        for caminho in sorted(glob.glob(os.path.join(DIR_PENDENTES, f"{glob.escape(self.tabela)}_*.jsonl"))):
+            if caminho.endswith(".rejeitados.jsonl"):
+                continue
+            carregando = f"{caminho}.{os.getpid()}"
+            try:
+                os.rename(caminho, carregando)
+            except FileNotFoundError:
+                continue  # outro processo já o carregou
+            try:
+                with open(carregando, encoding="utf-8") as f:
+                    registros = [json.loads(linha) for linha in f if linha.strip()]
+                for r in registros:
+                    r["data_envio"] = datetime.fromisoformat(r["data_envio"])
+            except (OSError, ValueError, KeyError) as erro:
+                rejeitado = caminho[:-len(".jsonl")] + ".rejeitados.jsonl"
+                try:
+                    os.rename(carregando, rejeitado)
+                except OSError:
+                    rejeitado = carregando
+                logger.error(f"Logs de envio em {caminho} ilegíveis ({erro}); mantidos em {rejeitado}.")
+                continue
+            with self._trava:
+                self._prontos.extend(registros)
+            os.remove(carregando)
+            logger.info(f"{len(registros)} log(s) de envio recuperados de {caminho}.")
+
+    def fechar(self):
+        """Encerra a thread e grava tudo o que restou, inclusive envios sem resposta.
+
+        Se o COPY falhar, grava linha a linha; sem conexão, salva em disco.
+        """
+        with self._condicao:
+            self._encerrar = True
+            self._condicao.notify()
+        self._thread.join()
+        self.descarregar(incluir_pendentes=True)
+        with self._trava:
+            restantes, self._prontos = self._prontos, []
+        if restantes:
+            restantes = self._inserir_um_a_um(restantes)
+        if restantes:
+            self._salvar_em_disco(restantes)
+
+def _bytea(valor):
+    """Valor bytea no formato texto do COPY (None vira campo vazio, isto é, NULL)."""
+    return None if valor is None else "\\x" + valor.hex()
+
+_gravadores = {}
+_trava_gravadores = threading.Lock()
+
+def gravador(tabela):
+    """Gravador da tabela neste processo (criado na primeira chamada)."""
+    chave = (os.getpid(), tabela)
+    with _trava_gravadores:
+        if chave not in _gravadores:
+            _gravadores[chave] = GravadorLogEnvio(tabela)
+        return _gravadores[chave]
+
+def fechar_todos():
+    """Grava os buffers dos gravadores deste processo; chamado no fim das rotinas e do processo."""
+    with _trava_gravadores:
+        gravadores = [_gravadores.pop(c) for c in list(_gravadores) if c[0] == os.getpid()]
+    for g in gravadores:
+        g.fechar()
+
+multiprocessing.util.Finalize(None, fechar_todos, exitpriority=20)
+
+# =====================================================================
+# LEITURA E CONVERSÃO DOS LOGS
+# =====================================================================
+def _linha_log(conn, colunas, linha):
+    registro = dict(zip(colunas, linha))
+    for campo in ("mensagem", "resposta"):
+        compactado = registro.pop(f"{campo}_z")
+        if registro[campo] is None:
+            registro[campo] = compactacao_hl7.descompactar(conn, compactado)
+    return registro
+
+def ler_log(conn, tabela, log_id):
+    """Linha do log com mensagem e resposta em texto (None se não existe)."""
+    coluna_entidade = TABELAS[tabela][0]
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT id, {coluna_entidade} AS entidade, data_envio, status,
+                   mensagem, resposta, mensagem_z, resposta_z
+            FROM {tabela} WHERE id = %s
+        """, (log_id,))
+        linha = cur.fetchone()
+        colunas = [d[0] for d in cur.description]
+    return _linha_log(conn, colunas, linha) if linha else None
+
+def buscar_logs(conn, tabela, entidade, limite=20):
+    """Envios mais recentes de uma entidade (chave do exame ou lto_id), com texto descompactado."""
+    coluna_entidade = TABELAS[tabela][0]
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT id, {coluna_entidade} AS entidade, data_envio, status,
+                   mensagem, resposta, mensagem_z, resposta_z
+            FROM {tabela} WHERE {coluna_entidade}::text = %s
+            ORDER BY data_envio DESC LIMIT %s
+        """, (str(entidade), limite))
+        linhas = cur.fetchall()
+        colunas = [d[0] for d in cur.description]
+    return [_linha_log(conn, colunas, linha) for linha in linhas]
+
+def amostras(conn, limite=AMOSTRAS_DICIONARIO):
+    """Mensagens e respostas mais recentes das tabelas de log, em texto, para treinar o dicionário."""
+    textos = []
+    for tabela in TABELAS:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT mensagem, resposta, mensagem_z, resposta_z FROM {tabela}
+                ORDER BY data_envio DESC LIMIT %s
+            """, (limite // len(TABELAS),))
+            linhas = cur.fetchall()
+        for mensagem, resposta, mensagem_z, resposta_z in linhas:
+            textos.append(mensagem if mensagem is not None else compactacao_hl7.descompactar(conn, mensagem_z))
+            textos.append(resposta if resposta is not None else compactacao_hl7.descompactar(conn, resposta_z))
+    conn.rollback()
+    return [t for t in textos if t]
+
+def migrar(conn, tabela, lote=LOTE_MIGRACAO, registrar=print):
+    """Compacta, em lotes com commit por lote, as linhas ainda com texto em mensagem/resposta."""
+    compactador = compactacao_hl7.compactador_ativo(conn)
+    ultimo_id, total = 0, 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT id, mensagem, resposta FROM {tabela}
+                WHERE id > %s AND (mensagem IS NOT NULL OR resposta IS NOT NULL)
+                ORDER BY id LIMIT %s
+            """, (ultimo_id, lote))
+            linhas = cur.fetchall()
+            if not linhas:
+                break
+            execute_values(cur, f"""
+                UPDATE {tabela} t
+                SET mensagem_z = COALESCE(v.mensagem_z, t.mensagem_z),
+                    resposta_z = COALESCE(v.resposta_z, t.resposta_z),
+                    mensagem = NULL, resposta = NULL
+                FROM (VALUES %s) AS v (id, mensagem_z, resposta_z)
+                WHERE t.id = v.id
+            """, [(i, compactador.compactar(m), compactador.compactar(r)) for i, m, r in linhas],
+                template="(%s, %s::bytea, %s::bytea)")
+        conn.commit()
+        ultimo_id = linhas[-1][0]
+        total += len(linhas)
+        registrar(f"{tabela}: {total} linha(s) compactada(s) (até id {ultimo_id}).")
+    return total
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    comandos = {"ler": 3, "buscar": 3, "treinar": 1, "migrar": 1}
+    if not args or args[0] not in comandos or len(args) < comandos[args[0]]:
+        print(__doc__)
+        sys.exit(1)
+
+    conn = banco.obter()
+    try:
+        if args[0] == "ler":
+            registro = ler_log(conn, args[1], int(args[2]))
+            registros = [registro] if registro else []
+        elif args[0] == "buscar":
+            registros = buscar_logs(conn, args[1], args[2])
+        else:
+            registros = []
+        for r in registros:
+            print(f"[{r['id']}] {r['entidade']} — {r['data_envio']:%Y-%m-%d %H:%M:%S} — {r['status']}")
+            print(f"--- mensagem ---\n{r['mensagem']}\n--- resposta ---\n{r['resposta']}\n")
+
+        if args[0] == "treinar":
+            textos = amostras(conn, int(args[1]) if len(args) > 1 else AMOSTRAS_DICIONARIO)
+            conteudo = compactacao_hl7.treinar(textos)
+            dicionario_id = compactacao_hl7.salvar_dicionario(conn, compactacao_hl7.ALGORITMO, conteudo, len(textos))
+            print(f"Dicionário {dicionario_id} ({len(conteudo)} bytes) treinado com {len(textos)} amostra(s).")
+        elif args[0] == "migrar":
+            for tabela in args[1:] or list(TABELAS):
+                print(f"{tabela}: {migrar(conn, tabela)} linha(s) compactada(s).")
+    finally:
+        banco.devolver(conn)
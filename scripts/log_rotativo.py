@@ -0,0 +1,177 @@
+"""Handler de log com rotação por dia e por tamanho, usado pelas rotinas.
+
+O arquivo ativo tem nome fixo (ex.: sincronizar_exames.log). Ele é
+rotacionado, durante a execução, na virada do dia ou ao passar de
+MAX_BYTES, para <nome>_AAAA-MM-DD_HHMMSS.log (data e hora do início do
+arquivo). Uma thread em segundo plano compacta cada arquivo rotacionado
+(.log.gz) e, em seguida, remove os rotacionados mais antigos do diretório
+até o total caber em LIMITE_TOTAL. O arquivamento noturno
+(arquivar_logs.py) leva os .log.gz para o backup.
+
+Rotinas diferentes (exames, backfill, reconciliação) podem escrever no
+mesmo arquivo ativo: a rotação é serializada por flock em .<nome>.lock e,
+sob a trava, só renomeia o arquivo se ele ainda for o que este processo tem
+aberto. Antes de cada registro o handler compara o inode do caminho com o
+do arquivo aberto e, se outro processo rotacionou, reabre o caminho. Os
+processos filhos (multiprocessing) não rotacionam, só reabrem; um arquivo
+rotacionado só é compactado quando nenhum processo o tem aberto.
+"""
+import fcntl
+import gzip
+import logging.handlers
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from arquivar_logs import arquivos_abertos
+
+MAX_BYTES = int(os.getenv("EPIMED_LOG_MAX_MB", "50")) * 1024 * 1024
+LIMITE_TOTAL = int(os.getenv("EPIMED_LOG_LIMITE_MB", "2048")) * 1024 * 1024
+# Espera máxima por um arquivo rotacionado ainda aberto por outro processo
+ESPERA_FECHAMENTO = int(os.getenv("EPIMED_LOG_ESPERA_FECHAMENTO", "600"))
+# Espera, no fim do processo, pela compactação em andamento
+ESPERA_ENCERRAMENTO = 30
+
+ROTACIONADO = re.compile(r"_\d{4}-\d{2}-\d{2}_\d{6}(_\d+)?\.log(\.gz)?$")
+
+class ArquivoLogRotativo(logging.handlers.BaseRotatingHandler):
+
+    def __init__(self, caminho, max_bytes=MAX_BYTES, limite_total=LIMITE_TOTAL):
+        os.makedirs(os.path.dirname(caminho), exist_ok=True)
+        super().__init__(caminho, mode="a", encoding="utf-8")
+        self.max_bytes = max_bytes
+        self.limite_total = limite_total
+        self._pid = os.getpid()
+        self._inicio = self._inicio_arquivo()
+        self._fila = queue.Queue()
+        self._thread = threading.Thread(target=self._compactar_rotacionados, name="log-rotativo", daemon=True)
+        self._thread.start()
+        # Rotacionados que ficaram sem compactar (processo encerrado antes)
+        for nome in sorted(os.listdir(os.path.dirname(caminho))):
+            completo = os.path.join(os.path.dirname(caminho), nome)
+            if completo.startswith(self._base() + "_") and ROTACIONADO.search(nome) and nome.endswith(".log"):
+                self._fila.put(completo)
+
+    def _base(self):
+        return os.path.splitext(self.baseFilename)[0]
+
+    def _open(self):
+        stream = super()._open()
+        self._inode = os.fstat(stream.fileno()).st_ino
+        return stream
+
+    @contextmanager
+    def _trava(self):
+        caminho = os.path.join(os.path.dirname(self.baseFilename), f".{os.path.basename(self.baseFilename)}.lock")
+        with open(caminho, "a") as arquivo:
+            fcntl.flock(arquivo.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(arquivo.fileno(), fcntl.LOCK_UN)
+
+    def _rotacionado_por_outro(self):
+        """True se o caminho não aponta mais para o arquivo aberto (renomeado por outro processo)."""
+        try:
+            return os.stat(self.baseFilename).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def _reabrir(self):
+        if self.stream:
+            self.stream.close()
+        self.stream = self._open()
+        self._inicio = self._inicio_arquivo()
+
+    def _inicio_arquivo(self):
+        try:
+            return datetime.fromtimestamp(os.stat(self.baseFilename).st_mtime)
+        except FileNotFoundError:
+            return datetime.now()
+
+    def shouldRollover(self, record):
+        if self.stream is None or self._rotacionado_por_outro():
+            self._reabrir()
+        if os.getpid() != self._pid:
+            return False
+        if datetime.fromtimestamp(record.created).date() != self._inicio.date():
+            return True
+        # Posição no fim do arquivo (modo append), sem formatar o registro de novo
+        return bool(self.max_bytes) and self.stream.tell() >= self.max_bytes
+
+    def doRollover(self):
+        with self._trava():
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+            if self._rotacionado_por_outro():
+                # Outro processo rotacionou enquanto esperávamos a trava
+                self._reabrir()
+                return
+            if os.path.getsize(self.baseFilename):
+                destino = f"{self._base()}_{self._inicio:%Y-%m-%d_%H%M%S}.log"
+                sequencia = 1
+                while os.path.exists(destino) or os.path.exists(destino + ".gz"):
+                    destino = f"{self._base()}_{self._inicio:%Y-%m-%d_%H%M%S}_{sequencia}.log"
+                    sequencia += 1
+                os.rename(self.baseFilename, destino)
+                self._fila.put(destino)
+            self.stream = self._open()
+            self._inicio = datetime.now()
+
+    def _compactar_rotacionados(self):
+        while True:
+            caminho = self._fila.get()
+            if caminho is None:
+                return
+            try:
+                limite = time.monotonic() + ESPERA_FECHAMENTO
+                while os.path.realpath(caminho) in arquivos_abertos() and time.monotonic() < limite:
+                    time.sleep(5)
+                compactar(caminho)
+                self._aplicar_limite()
+            except Exception as erro:
+                print(f"[ERROR] {datetime.now():%Y-%m-%d %H:%M:%S} - Falha ao compactar {caminho}: {erro}")
+
+    def _aplicar_limite(self):
+        """Remove os rotacionados compactados mais antigos do diretório até o total caber no limite."""
+        if not self.limite_total:
+            return
+        diretorio = os.path.dirname(self.baseFilename)
+        arquivos = []
+        total = 0
+        for entrada in os.scandir(diretorio):
+            if entrada.is_file():
+                info = entrada.stat()
+                total += info.st_size
+                if entrada.name.endswith(".log.gz") and ROTACIONADO.search(entrada.name):
+                    arquivos.append((info.st_mtime, info.st_size, entrada.path))
+        for _, tamanho, caminho in sorted(arquivos):
+            if total <= self.limite_total:
+                break
+            os.remove(caminho)
+            total -= tamanho
+
+    def close(self):
+        if os.getpid() == self._pid and self._thread.is_alive():
+            self._fila.put(None)
+            self._thread.join(ESPERA_ENCERRAMENTO)
+        super().close()
+
+def compactar(caminho):
+    """caminho -> caminho.gz (via temporário), removendo o original."""
+    temporario = f"{caminho}.{os.getpid()}.tmp"
+    try:
+        entrada = open(caminho, "rb")
+    except FileNotFoundError:
+        return  # já compactado por outra execução
+    with entrada, gzip.open(temporario, "wb", compresslevel=6) as saida:
+        shutil.copyfileobj(entrada, saida, 1024 * 1024)
+    shutil.copystat(caminho, temporario)
+    os.replace(temporario, f"{caminho}.gz")
+    os.remove(caminho)
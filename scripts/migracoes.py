@@ -0,0 +1,303 @@
+"""Migrações versionadas (scripts/sql) e verificação do esquema no início das rotinas.
+
+Cada arquivo sql/NNN_nome.sql é uma versão, aplicada uma única vez, em
+ordem e numa transação própria, e registrada em exa.migracoes com o
+sha256 do conteúdo (um arquivo alterado depois de aplicado gera alerta).
+Os arquivos 001 a 008 são anteriores ao registro e idempotentes: numa base
+em que já foram aplicados à mão, reaplicá-los não altera nada. sql/aghu/
+não é aplicado aqui: as rotinas só leem o AGHU.
+
+preparar() roda no início da rotina de exames e verificar_aghu() no da de
+leitos: criam as partições dos próximos meses e retornam alertas para
+migrações pendentes, FKs removidas pelo particionamento e não recriadas,
+índices ausentes e consultas quentes que fariam varredura sequencial
+(EXPLAIN sem ANALYZE) em tabelas grandes.
+
+Uso: python migracoes.py status|aplicar|verificar
+"""
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+DIR_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql")
+ARQUIVO_MIGRACAO = re.compile(r"^(\d{3})_.+\.sql$")
+
+TABELAS_PARTICIONADAS = ("exa.exames", "exa.log_envio_hl7")
+PARTICOES_FUTURAS = int(os.getenv("EPIMED_PARTICOES_FUTURAS", "3"))
+
+# Varredura sequencial só é alerta acima desta estimativa de linhas
+LIMITE_SEQ_SCAN = int(os.getenv("EPIMED_LIMITE_SEQ_SCAN", "10000"))
+
+# (tabela, colunas iniciais, único)
+INDICES_EPIMED = (
+    ("exa.internacoes", ("hospitaladmissionnumber",), True),
+    ("exa.admissoes", ("hospitaladmissionnumber", "unitcode", "bedcode", "unitadmissiondatetime"), True),
+    ("exa.admissoes", ("hospitaladmissionnumber", "unitadmissiondatetime"), False),
+    ("exa.exames", ("adm_id", "idexame", "dthrcoleta"), True),
+    ("exa.exames", ("dthrcoleta",), False),
+)
+INDICES_AGHU = (
+    ("agh.ain_leitos_jn", ("lto_id", "ind_situacao", "jn_date_time"), False),
+    ("agh.ain_leitos_jn", ("jn_date_time",), False),
+)
+
+# Consultas quentes das rotinas, com valores representativos
+CONSULTAS_EPIMED = (
+    ("exames por data de coleta",
+     "SELECT adm_id, idexame, dthrcoleta FROM exa.exames WHERE dthrcoleta >= now() - INTERVAL '1 day'"),
+    ("chave de exames (ON CONFLICT)",
+     "SELECT 1 FROM exa.exames WHERE adm_id = 1 AND idexame = '1' AND dthrcoleta = now()::timestamp"),
+    ("admissão mais recente da internação",
+     "SELECT id FROM exa.admissoes WHERE hospitaladmissionnumber = '1' "
+     "ORDER BY unitadmissiondatetime DESC LIMIT 1"),
+    ("chave de internações (ON CONFLICT)",
+     "SELECT 1 FROM exa.internacoes WHERE hospitaladmissionnumber = '1'"),
+)
+CONSULTAS_AGHU = (
+    ("journal de leitos por leito e situação",
+     "SELECT jn_date_time FROM agh.ain_leitos_jn WHERE lto_id = '1' AND ind_situacao = 'A' "
+     "ORDER BY jn_date_time DESC LIMIT 1"),
+    ("última alteração do journal de leitos", "SELECT MAX(jn_date_time) FROM agh.ain_leitos_jn"),
+)
+
+def arquivos():
+    """[(versão, nome do arquivo, caminho)] em ordem de versão."""
+    return sorted(
+        (int(m.group(1)), nome, os.path.join(DIR_SQL, nome))
+        for nome in os.listdir(DIR_SQL)
+        if (m := ARQUIVO_MIGRACAO.match(nome))
+    )
+
+def _conteudo(caminho):
+    with open(caminho, encoding="utf-8") as arquivo:
+        conteudo = arquivo.read()
+    return conteudo, hashlib.sha256(conteudo.encode("utf-8")).hexdigest()
+
+def _garantir_registro(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS exa.migracoes (
+                versao      integer PRIMARY KEY,
+                arquivo     varchar(200) NOT NULL,
+                sha256      char(64) NOT NULL,
+                aplicada_em timestamp NOT NULL DEFAULT NOW(),
+                duracao     interval
+            )
+        """)
+    conn.commit()
+
+def aplicadas(conn):
+    """{versão: (arquivo, sha256)} das migrações registradas."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('exa.migracoes') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return {}
+        cur.execute("SELECT versao, arquivo, sha256 FROM exa.migracoes")
+        return {versao: (arquivo, sha) for versao, arquivo, sha in cur.fetchall()}
+
+def situacao(conn):
+    """Retorna (pendentes, alteradas): arquivos não aplicados e aplicados com conteúdo diferente."""
+    registradas = aplicadas(conn)
+    pendentes, alteradas = [], []
+    for versao, nome, caminho in arquivos():
+        if versao not in registradas:
+            pendentes.append((versao, nome, caminho))
+        elif registradas[versao][1] != _conteudo(caminho)[1]:
+            alteradas.append(nome)
+    return pendentes, alteradas
+
+def aplicar(conn, registrar=print):
+    """Aplica as migrações pendentes, cada uma na sua transação; para na primeira falha."""
+    _garantir_registro(conn)
+    pendentes, _ = situacao(conn)
+    for versao, nome, caminho in pendentes:
+        conteudo, sha = _conteudo(caminho)
+        inicio = time.monotonic()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(conteudo)
+                cur.execute("""
+                    INSERT INTO exa.migracoes (versao, arquivo, sha256, duracao)
+                    VALUES (%s, %s, %s, make_interval(secs => %s))
+                """, (versao, nome, sha, time.monotonic() - inicio))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            registrar(f"Falha ao aplicar {nome}; migrações seguintes não aplicadas.")
+            raise
+        for aviso in conn.notices:
+            registrar(aviso.strip())
+        del conn.notices[:]
+        registrar(f"{nome} aplicada em {time.monotonic() - inicio:.1f} s.")
+    return len(pendentes)
+
+def _indices(conn, tabela):
+    """[(colunas, único)] dos índices da tabela (None se a tabela não existe)."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)", (tabela,))
+        if cur.fetchone()[0] is None:
+            return None
+        cur.execute("""
+            SELECT (SELECT array_agg(a.attname::text ORDER BY k.ordem)
+                    FROM unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ordem)
+                    JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum),
+                   i.indisunique
+            FROM pg_index i
+            WHERE i.indrelid = %s::regclass
+        """, (tabela,))
+        return [(tuple(colunas or ()), unico) for colunas, unico in cur.fetchall()]
+
+def verificar_indices(conn, esperados):
+    alertas = []
+    for tabela, colunas, unico in esperados:
+        existentes = _indices(conn, tabela)
+        if existentes is None:
+            alertas.append(f"Tabela {tabela} não encontrada.")
+        elif not any(c[:len(colunas)] == colunas and (u or not unico) for c, u in existentes):
+            alertas.append(f"Índice {'único ' if unico else ''}{tabela} ({', '.join(colunas)}) ausente.")
+    conn.rollback()
+    return alertas
+
+def _varreduras(plano):
+    """(esquema, tabela) de cada nó Seq Scan do plano."""
+    if plano.get("Node Type") == "Seq Scan":
+        yield plano.get("Schema"), plano["Relation Name"]
+    for filho in plano.get("Plans", ()):
+        yield from _varreduras(filho)
+
+def verificar_varreduras(conn, consultas):
+    """Alertas das consultas cujo plano faz varredura sequencial de tabela grande."""
+    alertas = []
+    for descricao, sql in consultas:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("EXPLAIN (VERBOSE, FORMAT JSON) " + sql)
+                plano = cur.fetchone()[0]
+                if isinstance(plano, str):
+                    plano = json.loads(plano)
+                for esquema, tabela in set(_varreduras(plano[0]["Plan"])):
+                    cur.execute("""
+                        SELECT c.reltuples FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                        WHERE c.relname = %s AND n.nspname = COALESCE(%s, n.nspname)
+                    """, (tabela, esquema))
+                    linhas = max((r[0] for r in cur.fetchall()), default=0)
+                    if linhas >= LIMITE_SEQ_SCAN:
+                        alertas.append(f"Consulta '{descricao}' faria varredura sequencial de "
+                                       f"{esquema}.{tabela} (~{int(linhas):,} linhas).")
+        except Exception as erro:
+            alertas.append(f"Consulta '{descricao}' não pôde ser verificada: {erro}")
+        conn.rollback()
+    return alertas
+
+def consultas_epimed():
+    """CONSULTAS_EPIMED e a junção dos exames com a janela da última admissão
+    (obter_exames_aghu, execução incremental), com o SQL da própria rotina."""
+    from verificar_exames import SQL_EXAMES_AGHU
+
+    janela = SQL_EXAMES_AGHU.format(filtro_admissoes="""
+                WHERE janela_exames && tsrange((now() - INTERVAL '1 day')::timestamp, NULL)""", filtro="""
+              AND (i.medicaldischargedate IS NULL OR i.medicaldischargedate >= now() - INTERVAL '1 day')
+              AND ve.dthr_programada >= now() - INTERVAL '1 day'""")
+    return CONSULTAS_EPIMED + (("exames na janela da admissão", janela),)
+
+def criar_particoes(conn):
+    """Partições dos próximos PARTICOES_FUTURAS meses das tabelas já particionadas."""
+    criadas = 0
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regprocedure('exa.fn_criar_particoes_mensais(regclass,integer)') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return 0
+        for tabela in TABELAS_PARTICIONADAS:
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (tabela,))
+            if cur.fetchone() == ("p",):
+                cur.execute("SELECT exa.fn_criar_particoes_mensais(%s::regclass, %s)", (tabela, PARTICOES_FUTURAS))
+                criadas += cur.fetchone()[0]
+    conn.commit()
+    return criadas
+
+def fks_removidas(conn):
+    """Alertas das FKs removidas pelo particionamento (sql/010) que ainda não foram recriadas.
+
+    A definição de cada uma fica em exa.particionamento_fks_removidas; a FK
+    deixa de ser alertada quando uma restrição de mesmo nome volta a existir
+    na tabela.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('exa.particionamento_fks_removidas') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return []
+        cur.execute("""
+            SELECT f.tabela, f.restricao, f.definicao, f.alvo, f.removida_em
+            FROM exa.particionamento_fks_removidas f
+            WHERE NOT EXISTS (
+                SELECT 1 FROM pg_constraint c
+                WHERE c.conrelid = to_regclass(f.tabela) AND c.conname = f.restricao
+            )
+            ORDER BY f.id
+        """)
+        linhas = cur.fetchall()
+    conn.rollback()
+    return [f"FK {restricao} de {tabela} para {alvo} removida pelo particionamento em "
+            f"{removida_em:%Y-%m-%d} e não recriada: {definicao}"
+            for tabela, restricao, definicao, alvo, removida_em in linhas]
+
+def preparar(conn):
+    """Início da rotina de exames: partições futuras e alertas do esquema da base local."""
+    alertas = []
+    pendentes, alteradas = situacao(conn)
+    if pendentes:
+        alertas.append("Migrações pendentes: " + ", ".join(nome for _, nome, _ in pendentes)
+                       + " (python migracoes.py aplicar)")
+    if alteradas:
+        alertas.append("Migrações alteradas depois de aplicadas: " + ", ".join(alteradas))
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('exa.janelas_exame') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT 1 FROM exa.janelas_exame WHERE sigla = '*'")
+            if cur.fetchone() is None:
+                alertas.append("exa.janelas_exame sem a janela padrão (sigla '*'): "
+                               "usando 4 h antes e 24 h depois.")
+    conn.rollback()
+    try:
+        criar_particoes(conn)
+    except Exception as erro:
+        conn.rollback()
+        alertas.append(f"Falha ao criar partições futuras: {erro}")
+    return (alertas + fks_removidas(conn) + verificar_indices(conn, INDICES_EPIMED)
+            + verificar_varreduras(conn, consultas_epimed()))
+
+def verificar_aghu(conn_aghu):
+    """Início da rotina de leitos: índices e planos das consultas ao journal de leitos do AGHU."""
+    return verificar_indices(conn_aghu, INDICES_AGHU) + verificar_varreduras(conn_aghu, CONSULTAS_AGHU)
+
+if __name__ == "__main__":
+    import banco
+
+    comando = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if comando not in ("status", "aplicar", "verificar"):
+        print(__doc__)
+        sys.exit(1)
+
+    conn = banco.obter()
+    codigo_saida = 0
+    try:
+        if comando == "aplicar":
+            print(f"{aplicar(conn)} migração(ões) aplicada(s).")
+        elif comando == "status":
+            registradas = aplicadas(conn)
+            for versao, nome, _ in arquivos():
+                print(f"{'aplicada ' if versao in registradas else 'PENDENTE '} {nome}")
+        else:
+            with banco.conexao("aghu", somente_leitura=True) as conn_aghu:
+                alertas = preparar(conn) + verificar_aghu(conn_aghu)
+            for alerta in alertas:
+                print(f"⚠️  {alerta}")
+            print("Esquema conforme." if not alertas else f"{len(alertas)} alerta(s).")
+            codigo_saida = 2 if alertas else 0
+    finally:
+        banco.devolver(conn)
+    sys.exit(codigo_saida)
@@ -0,0 +1,39 @@
+"""Execução particionada por hash: N processos, cada um dono de uma partição da chave.
+
+A partição de uma linha é (hashtext(chave::text) % N + N) % N, calculada no
+banco; cada processo recebe particao = (indice, N) e filtra suas consultas
+com condicao(). Internações, admissões e exames são particionados por
+hospitaladmissionnumber. Leitos são particionados por lto_id (bedcode) com
+pertence(), no Python: os dois inventários vêm de servidores diferentes e a
+partição precisa ser a mesma dos dois lados.
+"""
+import multiprocessing
+import os
+import zlib
+
+import rastreio
+
+# Processos por execução (1 = sem particionamento)
+PROCESSOS = int(os.getenv("EPIMED_PROCESSOS", "1"))
+
+def condicao(coluna, particao):
+    """(fragmento SQL, parâmetros) que restringe coluna à partição (indice, total)."""
+    indice, total = particao
+    return f"(hashtext({coluna}::text)::bigint %% %s + %s) %% %s = %s", (total, total, total, indice)
+
+def pertence(valor, particao):
+    """True se o valor cai na partição (indice, total); mesmo resultado em qualquer processo."""
+    indice, total = particao
+    return zlib.crc32(str(valor).encode("utf-8")) % total == indice
+
+def _executar(funcao, argumentos, particao):
+    try:
+        return funcao(*argumentos, particao=particao)
+    finally:
+        # O Pool encerra os processos sem rodar os finalizadores
+        rastreio.gravar_resumo()
+
+def executar(funcao, total, *argumentos):
+    """Executa funcao(*argumentos, particao=(i, total)) em total processos; resultados na ordem das partições."""
+    with multiprocessing.Pool(total) as pool:
+        return pool.starmap(_executar, [(funcao, argumentos, (i, total)) for i in range(total)])
@@ -0,0 +1,98 @@
+import sys
+
+# Retornado pelos envios suprimidos por quarentena
+EM_QUARENTENA = "QUARENTENA"
+
+CODIGOS_REJEICAO = ("AE", "AR")
+
+def em_quarentena(conexao, entidade, chave, hash_atual):
+    """Indica se o item está em quarentena para este mesmo conteúdo."""
+    with conexao.cursor() as cursor:
+        cursor.execute("""
+            SELECT 1
+            FROM quarentena_hl7
+            WHERE entidade = %s AND chave = %s AND hash_payload = %s
+              AND liberado_em IS NULL
+        """, (entidade, chave, hash_atual))
+        return cursor.fetchone() is not None
+
+def registrar_rejeicao(conexao, entidade, chave, hash_atual, codigo_ack, detalhes_erro=None):
+    """Coloca (ou mantém) o item em quarentena após um ACK AE/AR."""
+    with conexao.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO quarentena_hl7 (entidade, chave, hash_payload, codigo_ack, detalhes_erro)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (entidade, chave) DO UPDATE
+            SET codigo_ack = EXCLUDED.codigo_ack,
+                detalhes_erro = EXCLUDED.detalhes_erro,
+                tentativas = CASE WHEN quarentena_hl7.hash_payload = EXCLUDED.hash_payload
+                                  THEN quarentena_hl7.tentativas + 1 ELSE 1 END,
+                primeira_rejeicao = CASE WHEN quarentena_hl7.hash_payload = EXCLUDED.hash_payload
+                                         THEN quarentena_hl7.primeira_rejeicao ELSE NOW() END,
+                hash_payload = EXCLUDED.hash_payload,
+                ultima_rejeicao = NOW(),
+                liberado_em = NULL,
+                liberado_por = NULL
+        """, (entidade, chave, hash_atual, codigo_ack, detalhes_erro))
+
+def remover_quarentena(conexao, entidade, chave):
+    """Remove o item da quarentena (após um ACK AA)."""
+    with conexao.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM quarentena_hl7 WHERE entidade = %s AND chave = %s",
+            (entidade, chave)
+        )
+
+def liberar(conexao, entidade, chave, operador=None):
+    """Libera manualmente o item para reenvio na próxima execução."""
+    with conexao.cursor() as cursor:
+        cursor.execute("""
+            UPDATE quarentena_hl7
+            SET liberado_em = NOW(), liberado_por = %s
+            WHERE entidade = %s AND chave = %s AND liberado_em IS NULL
+        """, (operador, entidade, chave))
+        return cursor.rowcount
+
+def obter_quarentena(conexao, entidade=None):
+    with conexao.cursor() as cursor:
+        cursor.execute("""
+            SELECT entidade, chave, codigo_ack, tentativas, primeira_rejeicao,
+                   ultima_rejeicao, detalhes_erro
+            FROM quarentena_hl7
+            WHERE liberado_em IS NULL
+              AND (%s IS NULL OR entidade = %s)
+            ORDER BY entidade, ultima_rejeicao DESC
+        """, (entidade, entidade))
+        return cursor.fetchall()
+
+def imprimir_relatorio(conexao, entidade=None):
+    itens = obter_quarentena(conexao, entidade)
+    print(f"{len(itens)} item(ns) em quarentena.")
+    for entidade, chave, codigo_ack, tentativas, primeira, ultima, detalhes in itens:
+        print(f"[{entidade}] {chave} — ACK {codigo_ack}, {tentativas} rejeição(ões), "
+              f"desde {primeira:%Y-%m-%d %H:%M}, última em {ultima:%Y-%m-%d %H:%M}")
+        if detalhes:
+            print(f"    {detalhes}")
+
+#-----------------------------------------------------------------------------------------------#
+# Uso:                                                                                          #
+#   python quarentena_hl7.py listar [entidade]                                                  #
+#   python quarentena_hl7.py liberar <entidade> <chave> [operador]                              #
+#-----------------------------------------------------------------------------------------------#
+if __name__ == "__main__":
+    import banco
+
+    args = sys.argv[1:] or ["listar"]
+    conn_epimed = banco.obter()
+    try:
+        if args[0] == "listar":
+            imprimir_relatorio(conn_epimed, args[1] if len(args) > 1 else None)
+        elif args[0] == "liberar" and len(args) >= 3:
+            with conn_epimed:
+                qtd = liberar(conn_epimed, args[1], args[2], args[3] if len(args) > 3 else None)
+            print(f"{qtd} item(ns) liberado(s).")
+        else:
+            print("Uso: quarentena_hl7.py listar [entidade] | liberar <entidade> <chave> [operador]")
+            sys.exit(2)
+    finally:
+        banco.devolver(conn_epimed)
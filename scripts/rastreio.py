@@ -0,0 +1,219 @@
+"""Rastreio das consultas SQL: cursor que mede cada comando executado pelas rotinas.
+
+Toda conexão do pool (banco.py) usa CursorRastreado, e os cursores de
+registros (registros.cursor_de) herdam dele. Por comando são medidos:
+
+* rótulo: função e linha da rotina que executou o comando (o primeiro
+  quadro fora deste módulo, de registros.py e do psycopg2);
+* duração: execute mais o tempo gasto nos fetch (em cursores nomeados,
+  a leitura acontece nos fetch);
+* linhas: retornadas (SELECT) ou afetadas (INSERT/UPDATE/DELETE);
+* bytes: tamanho aproximado das linhas lidas, pela representação em
+  texto (a do protocolo); só com EPIMED_RASTREIO_BYTES=1, pois custa uma
+  conversão por valor.
+
+Comandos com duração >= EPIMED_RASTREIO_MINIMO_MS viram uma linha JSON em
+DIR_RASTREIO/consultas_<data>.jsonl. Um SELECT que passe de
+EPIMED_RASTREIO_LENTO_MS tem o plano capturado com EXPLAIN (ANALYZE,
+BUFFERS, FORMAT JSON), na mesma conexão e transação, em
+DIR_RASTREIO/planos/. O EXPLAIN ANALYZE executa a consulta de novo; por
+isso só roda para SELECT sem comandos de escrita e no máximo uma vez por
+rótulo a cada EPIMED_RASTREIO_INTERVALO_PLANO_H horas, entre todos os
+processos e execuções (marca em planos/.capturados/, pelo mtime).
+gravar_resumo() acrescenta o total por rótulo, ao fim de cada processo.
+"""
+import json
+import os
+import multiprocessing.util
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extensions import cursor as _cursor, encodings
+
+ATIVO = os.getenv("EPIMED_RASTREIO", "1") == "1"
+CONTAR_BYTES = os.getenv("EPIMED_RASTREIO_BYTES", "0") == "1"
+MINIMO_MS = float(os.getenv("EPIMED_RASTREIO_MINIMO_MS", "100"))
+LENTO_MS = float(os.getenv("EPIMED_RASTREIO_LENTO_MS", "5000"))
+DIR_RASTREIO = os.getenv("EPIMED_DIR_RASTREIO", "/var/www/html/epimed/logs/consultas")
+INTERVALO_PLANO = float(os.getenv("EPIMED_RASTREIO_INTERVALO_PLANO_H", "24")) * 3600
+
+# Quadros ignorados ao procurar o rótulo do comando
+_MODULOS_INTERNOS = {"rastreio.py", "registros.py", "contextlib.py"}
+_DIR_PSYCOPG2 = os.path.dirname(psycopg2.__file__)
+_SOMENTE_LEITURA = re.compile(r"^\s*(SELECT|WITH)\b", re.IGNORECASE)
+_ESCRITA = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|CREATE|DROP|ALTER|TRUNCATE|COPY|nextval|setval)\b",
+                      re.IGNORECASE)
+
+_trava = threading.Lock()
+_resumo = {}              # rótulo -> [comandos, ms, linhas, bytes, maior ms]
+
+def _rotulo():
+    quadro = sys._getframe(2)
+    while quadro is not None:
+        arquivo = quadro.f_code.co_filename
+        if os.path.basename(arquivo) not in _MODULOS_INTERNOS and not arquivo.startswith(_DIR_PSYCOPG2):
+            modulo = quadro.f_globals.get("__name__", "?")
+            return f"{modulo}.{quadro.f_code.co_name}:{quadro.f_lineno}"
+        quadro = quadro.f_back
+    return "?"
+
+def _tamanho(linhas):
+    return sum(len(str(v)) for linha in linhas for v in linha if v is not None)
+
+def _gravar(nome, registro):
+    os.makedirs(os.path.dirname(nome), exist_ok=True)
+    with _trava, open(nome, "a", encoding="utf-8") as arquivo:
+        arquivo.write(json.dumps(registro, ensure_ascii=False, default=str) + "\n")
+
+def _reservar_captura(nome):
+    """True se nenhum processo capturou o plano do rótulo nas últimas INTERVALO_PLANO horas."""
+    marca = os.path.join(DIR_RASTREIO, "planos", ".capturados", nome)
+    os.makedirs(os.path.dirname(marca), exist_ok=True)
+    try:
+        os.close(os.open(marca, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        pass
+    if time.time() - os.stat(marca).st_mtime < INTERVALO_PLANO:
+        return False
+    os.utime(marca)
+    return True
+
+def _arquivo_consultas():
+    return os.path.join(DIR_RASTREIO, f"consultas_{datetime.now():%Y-%m-%d}.jsonl")
+
+class CursorRastreado(_cursor):
+    """Cursor que mede cada comando; o registro é fechado no próximo execute ou no close."""
+
+    _medicao = None
+
+    def execute(self, query, vars=None):
+        if not ATIVO:
+            return super().execute(query, vars)
+        self._encerrar()
+        self._medicao = {"rotulo": _rotulo(), "ms": 0.0, "lidas": 0, "bytes": 0,
+                         "query": query, "vars": vars, "erro": False}
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except Exception:
+            self._medicao["erro"] = True
+            raise
+        finally:
+            self._medicao["ms"] += (time.perf_counter() - inicio) * 1000
+
+    def _medir(self, inicio, linhas):
+        if self._medicao is not None:
+            self._medicao["ms"] += (time.perf_counter() - inicio) * 1000
+            self._medicao["lidas"] += len(linhas)
+            if CONTAR_BYTES:
+                self._medicao["bytes"] += _tamanho(linhas)
+        return linhas
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        row = super().fetchone()
+        self._medir(inicio, [row] if row is not None else [])
+        return row
+
+    def fetchmany(self, size=None):
+        inicio = time.perf_counter()
+        return self._medir(inicio, super().fetchmany(size) if size is not None else super().fetchmany())
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        return self._medir(inicio, super().fetchall())
+
+    def __iter__(self):
+        it = super().__iter__()
+        while True:
+            inicio = time.perf_counter()
+            try:
+                row = next(it)
+            except StopIteration:
+                return
+            self._medir(inicio, (row,))
+            yield row
+
+    def close(self):
+        self._encerrar()
+        return super().close()
+
+    def _encerrar(self):
+        medicao, self._medicao = self._medicao, None
+        if medicao is None:
+            return
+        linhas = max(self.rowcount, medicao["lidas"])
+        with _trava:
+            total = _resumo.setdefault(medicao["rotulo"], [0, 0.0, 0, 0, 0.0])
+            total[0] += 1
+            total[1] += medicao["ms"]
+            total[2] += linhas
+            total[3] += medicao["bytes"]
+            total[4] = max(total[4], medicao["ms"])
+        if medicao["ms"] < MINIMO_MS:
+            return
+
+        sql = self._sql(medicao)
+        _gravar(_arquivo_consultas(), {
+            "em": datetime.now().isoformat(timespec="seconds"), "pid": os.getpid(),
+            "rotulo": medicao["rotulo"], "ms": round(medicao["ms"], 1), "linhas": linhas,
+            "bytes": medicao["bytes"] if CONTAR_BYTES else None, "erro": medicao["erro"],
+            "sql": " ".join(sql.split())[:2000],
+        })
+        if medicao["ms"] >= LENTO_MS and not medicao["erro"]:
+            self._capturar_plano(medicao, sql)
+
+    def _sql(self, medicao):
+        try:
+            return self.mogrify(medicao["query"], medicao["vars"]).decode(encodings.get(self.connection.encoding, "utf-8"), "replace")
+        except Exception:
+            return str(medicao["query"])
+
+    def _capturar_plano(self, medicao, sql):
+        if not _SOMENTE_LEITURA.match(sql) or _ESCRITA.search(sql):
+            return
+        nome = re.sub(r"[^\w.-]+", "_", medicao["rotulo"])
+        if not _reservar_captura(nome):
+            return
+        # Savepoint: uma falha do EXPLAIN (ex.: statement_timeout) não aborta a transação da rotina
+        with self.connection.cursor(cursor_factory=_cursor) as cursor:
+            try:
+                cursor.execute("SAVEPOINT rastreio_plano")
+                cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql)
+                plano = cursor.fetchone()[0]
+                cursor.execute("RELEASE SAVEPOINT rastreio_plano")
+            except Exception as erro:
+                plano = {"erro": str(erro)}
+                try:
+                    cursor.execute("ROLLBACK TO SAVEPOINT rastreio_plano")
+                except Exception:
+                    pass
+        _gravar(os.path.join(DIR_RASTREIO, "planos", f"{datetime.now():%Y%m%d_%H%M%S}_{nome}.json"), {
+            "rotulo": medicao["rotulo"], "ms": round(medicao["ms"], 1), "sql": sql, "plano": plano,
+        })
+
+def gravar_resumo():
+    """Acrescenta ao arquivo do dia o total por rótulo deste processo e zera os totais."""
+    with _trava:
+        resumo = dict(_resumo)
+        _resumo.clear()
+    if not resumo:
+        return
+    _gravar(_arquivo_consultas(), {
+        "em": datetime.now().isoformat(timespec="seconds"), "pid": os.getpid(),
+        "resumo": {
+            rotulo: {"comandos": n, "ms": round(ms, 1), "linhas": linhas,
+                     "bytes": total_bytes if CONTAR_BYTES else None, "maior_ms": round(maior, 1)}
+            for rotulo, (n, ms, linhas, total_bytes, maior) in sorted(resumo.items(), key=lambda i: -i[1][1])
+        },
+    })
+
+# Processo filho começa com totais zerados; o resumo é gravado ao fim do
+# processo principal e dos filhos do multiprocessing
+os.register_at_fork(after_in_child=_resumo.clear)
+multiprocessing.util.Finalize(None, gravar_resumo, exitpriority=10)
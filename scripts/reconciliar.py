@@ -0,0 +1,245 @@
+"""Reconciliação por faixas (estilo árvore de Merkle) entre o AGHU e as tabelas exa.*.
+
+Para cada entidade, os dois lados são resumidos no banco por dia (contagem e
+soma de hashtextextended da chave normalizada + valor). Só os dias com resumo
+diferente descem para o nível dia + unidade e, destes, só as faixas
+divergentes têm as chaves lidas e comparadas linha a linha.
+
+* internações e admissões ausentes na base local são inseridas (mesmas
+  funções da rotina de exames; as admissões criadas entram como pendência
+  de exames);
+* exames ausentes ou com impressão divergente viram pendências em
+  exa.reconciliacao_pendencias, consumidas pela próxima execução de
+  verificar_exames.py (busca por adm_id).
+
+Uso: python reconciliar.py [dias]   (padrão: 30 dias até hoje)
+"""
+import json
+import sys
+from datetime import date, timedelta
+
+import banco
+import estado_sincronizacao
+import indice_chaves
+from registros import Admissao, Internacao, consultar_registros
+from verificar_exames import (
+    SQL_EXAMES_AGHU,
+    inserir_admissoes,
+    inserir_internacoes,
+    registrar_log,
+)
+
+ISO = """'YYYY-MM-DD"T"HH24:MI:SS'"""
+
+# Cada lado é uma consulta com as colunas dia, unidade, chave e valor (texto
+# normalizado, igual nos dois lados); %(desde)s limita o período.
+ENTIDADES = {
+    "internacoes": {
+        "origem": """
+            SELECT DISTINCT hospitaladmissiondate::date AS dia, NULL::text AS unidade,
+                   concat_ws('|', medicalrecord, hospitaladmissionnumber) AS chave, NULL::text AS valor
+            FROM public.vw_epimed
+            WHERE hospitaladmissiondate >= %(desde)s""",
+        "local": """
+            SELECT hospitaladmissiondate::date AS dia, NULL::text AS unidade,
+                   concat_ws('|', medicalrecord, hospitaladmissionnumber) AS chave, NULL::text AS valor
+            FROM exa.internacoes
+            WHERE hospitaladmissiondate >= %(desde)s""",
+    },
+    "admissoes": {
+        "origem": f"""
+            SELECT DISTINCT unitadmissiondatetime::date AS dia, unitcode::text AS unidade,
+                   concat_ws('|', hospitaladmissionnumber, unitcode, bedcode,
+                             to_char(unitadmissiondatetime, {ISO})) AS chave, NULL::text AS valor
+            FROM public.vw_epimed
+            WHERE unitadmissiondatetime >= %(desde)s""",
+        "local": f"""
+            SELECT unitadmissiondatetime::date AS dia, unitcode::text AS unidade,
+                   concat_ws('|', hospitaladmissionnumber, unitcode, bedcode,
+                             to_char(unitadmissiondatetime, {ISO})) AS chave, NULL::text AS valor
+            FROM exa.admissoes
+            WHERE unitadmissiondatetime >= %(desde)s""",
+    },
+    # Exames: só laudos não anulados (anulados ausentes nunca são gravados)
+    "exames": {
+        "origem": f"""
+            SELECT DISTINCT ON (chave) dia, unidade, chave, valor
+            FROM (
+                SELECT e.dthrcoleta::date AS dia, e.unitcode::text AS unidade,
+                       concat_ws('|', e.adm_id, e.idexame, to_char(e.dthrcoleta, {ISO})) AS chave,
+                       e.impressao AS valor
+                FROM ({SQL_EXAMES_AGHU.format(filtro_admissoes='''
+                WHERE janela_exames && tsrange(%(desde)s, NULL)''', filtro='''
+                  AND ve.dthr_programada >= %(desde)s''')}) e
+                WHERE e.ind_anulacao_laudo IS DISTINCT FROM 'S'
+            ) origem""",
+        "local": f"""
+            SELECT e.dthrcoleta::date AS dia, a.unitcode::text AS unidade,
+                   concat_ws('|', e.adm_id, e.idexame, to_char(e.dthrcoleta, {ISO})) AS chave,
+                   e.impressao AS valor
+            FROM exa.exames e
+            JOIN exa.admissoes a ON a.id = e.adm_id
+            WHERE e.dthrcoleta >= %(desde)s
+              AND e.ind_anulacao_laudo IS DISTINCT FROM 'S'""",
+    },
+}
+
+def resumir(conn, sql, parametros, agrupamento, filtro=""):
+    """{faixa: (quantidade, soma dos hashes)} agrupando o lado por dia ou por (dia, unidade)."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT {agrupamento}, count(*),
+                   sum(hashtextextended(chave || '|' || COALESCE(valor, ''), 0)::numeric)
+            FROM ({sql}) lado
+            WHERE TRUE{filtro}
+            GROUP BY {agrupamento}
+        """, parametros)
+        return {tuple(row[:-2]): tuple(row[-2:]) for row in cur.fetchall()}
+
+def faixas_divergentes(origem, local):
+    return sorted((f for f in origem.keys() | local.keys() if origem.get(f) != local.get(f)),
+                  key=lambda f: tuple("" if v is None else str(v) for v in f))
+
+def ler_chaves(conn, sql, parametros, faixas):
+    """{(dia, unidade): {chave: valor}} de todas as faixas, numa única leitura do lado."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT lado.dia, lado.unidade, lado.chave, lado.valor
+            FROM ({sql}) lado
+            JOIN unnest(%(faixa_dias)s::date[], %(faixa_unidades)s::text[]) AS f (dia, unidade)
+              ON f.dia = lado.dia AND f.unidade IS NOT DISTINCT FROM lado.unidade
+        """, dict(parametros, faixa_dias=[d for d, _ in faixas], faixa_unidades=[u for _, u in faixas]))
+        chaves = {}
+        for dia, unidade, chave, valor in cur.fetchall():
+            chaves.setdefault((dia, unidade), {})[chave] = valor
+        return chaves
+
+def comparar(conn, entidade, desde):
+    """Desce dia -> dia/unidade -> chaves nas faixas divergentes.
+
+    Retorna (faixas_divergentes, ausentes, divergentes, excedentes), com as
+    chaves normalizadas de cada grupo.
+    """
+    consultas = ENTIDADES[entidade]
+    parametros = {"desde": desde}
+
+    dias = faixas_divergentes(
+        resumir(conn, consultas["origem"], parametros, "dia"),
+        resumir(conn, consultas["local"], parametros, "dia"),
+    )
+    if not dias:
+        return [], [], [], []
+
+    filtro_dias = "\n              AND dia = ANY(%(dias)s)"
+    parametros_dias = dict(parametros, dias=[d for (d,) in dias])
+    faixas = faixas_divergentes(
+        resumir(conn, consultas["origem"], parametros_dias, "dia, unidade", filtro_dias),
+        resumir(conn, consultas["local"], parametros_dias, "dia, unidade", filtro_dias),
+    )
+
+    ausentes, divergentes, excedentes = [], [], []
+    if not faixas:
+        return faixas, ausentes, divergentes, excedentes
+    # Uma leitura por lado para todas as faixas: a consulta de origem é a mais
+    # pesada da rotina e o filtro por faixa não desce até ela
+    chaves_origem = ler_chaves(conn, consultas["origem"], parametros, faixas)
+    chaves_local = ler_chaves(conn, consultas["local"], parametros, faixas)
+    for faixa in faixas:
+        origem = chaves_origem.get(faixa, {})
+        local = chaves_local.get(faixa, {})
+        for chave, valor in origem.items():
+            if chave not in local:
+                ausentes.append(chave)
+            elif local[chave] != valor:
+                divergentes.append(chave)
+        excedentes.extend(chave for chave in local if chave not in origem)
+
+    return faixas, ausentes, divergentes, excedentes
+
+def enfileirar_exames(conn, chaves, motivo):
+    """Grava pendências de exames (chave 'adm_id|idexame|dthrcoleta'); a rotina de exames as consome por adm_id."""
+    with conn.cursor() as cur:
+        for chave in chaves:
+            cur.execute("""
+                INSERT INTO exa.reconciliacao_pendencias (entidade, chave, adm_id, motivo)
+                VALUES ('exames', %s, %s, %s)
+                ON CONFLICT (entidade, chave) WHERE processado_em IS NULL DO NOTHING
+            """, (chave, int(chave.split("|", 1)[0]), motivo))
+    conn.commit()
+
+def recuperar_internacoes(conn, chaves):
+    registros = consultar_registros(conn, Internacao, """
+        SELECT DISTINCT medicalrecord, hospitaladmissionnumber, hospitaladmissiondate, medicaldischargedate
+        FROM public.vw_epimed
+        WHERE concat_ws('|', medicalrecord, hospitaladmissionnumber) = ANY(%s)
+    """, (list(chaves),))
+    inseridas = inserir_internacoes(conn, registros)
+    indice_chaves.acrescentar_existente("internacoes", registros)
+    return inseridas
+
+def recuperar_admissoes(conn, chaves):
+    """Insere as admissões ausentes e retorna os ids criados."""
+    registros = consultar_registros(conn, Admissao, f"""
+        SELECT DISTINCT hospitaladmissionnumber, unitcode, bedcode, unitadmissiondatetime
+        FROM public.vw_epimed
+        WHERE concat_ws('|', hospitaladmissionnumber, unitcode, bedcode,
+                        to_char(unitadmissiondatetime, {ISO})) = ANY(%s)
+    """, (list(chaves),))
+    adm_ids = inserir_admissoes(conn, registros)
+    indice_chaves.acrescentar_existente("admissoes", registros)
+    return adm_ids
+
+def enfileirar_admissoes_criadas(conn, adm_ids):
+    """Exames das admissões recuperadas: uma pendência por admissão."""
+    with conn.cursor() as cur:
+        for adm_id in adm_ids:
+            cur.execute("""
+                INSERT INTO exa.reconciliacao_pendencias (entidade, chave, adm_id, motivo)
+                VALUES ('exames', %s, %s, 'ausente')
+                ON CONFLICT (entidade, chave) WHERE processado_em IS NULL DO NOTHING
+            """, (f"admissao:{adm_id}", adm_id))
+    conn.commit()
+
+def reconciliar(dias=30):
+    desde = date.today() - timedelta(days=dias)
+    registrar_log(f"INICIANDO RECONCILIAÇÃO POR FAIXAS desde {desde}.")
+
+    conn = banco.obter()
+    resumo = {"desde": desde.isoformat()}
+    try:
+        # Internações antes de admissões, e estas antes de exames: cada
+        # recuperação alimenta a comparação da entidade seguinte
+        for entidade in ("internacoes", "admissoes", "exames"):
+            faixas, ausentes, divergentes, excedentes = comparar(conn, entidade, desde)
+            conn.rollback()
+            registrar_log(
+                f"{entidade}: {len(faixas)} faixas divergentes; ausentes {len(ausentes)}, "
+                f"divergentes {len(divergentes)}, excedentes na base local {len(excedentes)}"
+            )
+            resumo[entidade] = {"faixas": len(faixas), "ausentes": len(ausentes),
+                                "divergentes": len(divergentes), "excedentes": len(excedentes)}
+
+            if entidade == "internacoes" and ausentes:
+                registrar_log(f"Internações recuperadas: {recuperar_internacoes(conn, ausentes)}")
+            elif entidade == "admissoes" and ausentes:
+                adm_ids = recuperar_admissoes(conn, ausentes)
+                registrar_log(f"Admissões recuperadas: {len(adm_ids)}")
+                enfileirar_admissoes_criadas(conn, adm_ids)
+            elif entidade == "exames":
+                enfileirar_exames(conn, ausentes, "ausente")
+                enfileirar_exames(conn, divergentes, "divergente")
+
+        estado_sincronizacao.salvar_estado(conn, "reconciliacao.ultima", json.dumps(resumo))
+        conn.commit()
+        registrar_log("Reconciliação concluída ✔️")
+    except Exception as erro:
+        conn.rollback()
+        registrar_log(f"Erro durante a reconciliação: {erro}", nivel="error")
+        raise
+    finally:
+        banco.devolver(conn)
+
+    return resumo
+
+if __name__ == "__main__":
+    reconciliar(int(sys.argv[1]) if len(sys.argv) > 1 else 30)
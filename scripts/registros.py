@@ -0,0 +1,130 @@
+import uuid
+from operator import itemgetter
+
+from rastreio import CursorRastreado
+
+def normalizar_data(valor):
+    """Normalização usada nas chaves de comparação (sem fuso e sem microssegundos)."""
+    return valor.replace(tzinfo=None, microsecond=0) if valor is not None else None
+
+class Registro:
+    """Base dos registros compactos: atributos em __slots__ e chave de comparação pré-calculada."""
+    __slots__ = ("chave",)
+    CAMPOS = ()
+
+    def __init__(self, *valores):
+        for campo, valor in zip(self.CAMPOS, valores):
+            setattr(self, campo, valor)
+        self.chave = self.calcular_chave()
+
+    def calcular_chave(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        campos = ", ".join(f"{c}={getattr(self, c)!r}" for c in self.CAMPOS)
+        return f"{type(self).__name__}({campos})"
+
+    def __eq__(self, outro):
+        return type(self) is type(outro) and all(
+            getattr(self, c) == getattr(outro, c) for c in self.CAMPOS
+        )
+
+    __hash__ = None
+
+    @classmethod
+    def leitor(cls, description):
+        """Função linha -> registro para as colunas da consulta (por nome; ausentes = None)."""
+        nomes = [d[0] for d in description]
+        indices = [nomes.index(c) if c in nomes else -1 for c in cls.CAMPOS]
+        if indices == list(range(len(cls.CAMPOS))):
+            return lambda row: cls(*row)
+        pegar = itemgetter(*indices)
+        return lambda row: cls(*pegar(row + (None,)))
+
+class Internacao(Registro):
+    __slots__ = ("hospitaladmissionnumber", "medicalrecord", "hospitaladmissiondate", "medicaldischargedate")
+    CAMPOS = __slots__
+
+    def calcular_chave(self):
+        return (self.medicalrecord, self.hospitaladmissionnumber)
+
+class Admissao(Registro):
+    __slots__ = ("id", "hospitaladmissionnumber", "unitcode", "bedcode", "unitadmissiondatetime")
+    CAMPOS = __slots__
+
+    def calcular_chave(self):
+        return (self.hospitaladmissionnumber, self.unitcode, self.bedcode,
+                normalizar_data(self.unitadmissiondatetime))
+
+class Exame(Registro):
+    __slots__ = ("adm_id", "hospitaladmissionnumber", "medicalrecord", "soe_seq", "idexame",
+                 "nome_exame", "valor", "tipo_inf_valor", "unidade", "result_sigla_exa",
+                 "result_material_exa_cod", "ind_anulacao_laudo", "dthrcoleta", "impressao")
+    CAMPOS = __slots__
+
+    def calcular_chave(self):
+        return (self.adm_id, self.idexame, normalizar_data(self.dthrcoleta))
+
+class Leito(Registro):
+    __slots__ = ("clientid", "unitcode", "unitname", "unittypecode", "bedcode", "bedname",
+                 "typebedcode", "ind_situacao", "impressao")
+    CAMPOS = __slots__
+
+    def calcular_chave(self):
+        return self.bedcode
+
+def cursor_de(classe):
+    """cursor_factory do psycopg2 que devolve instâncias de `classe` em vez de tuplas."""
+
+    class CursorRegistro(CursorRastreado):
+        _leitor = None
+
+        def execute(self, query, vars=None):
+            self._leitor = None
+            return super().execute(query, vars)
+
+        def _ler(self, row):
+            if self._leitor is None:
+                self._leitor = classe.leitor(self.description)
+            return self._leitor(row)
+
+        def fetchone(self):
+            row = super().fetchone()
+            return self._ler(row) if row is not None else None
+
+        def fetchmany(self, size=None):
+            rows = super().fetchmany(size) if size is not None else super().fetchmany()
+            return [self._ler(r) for r in rows]
+
+        def fetchall(self):
+            return [self._ler(r) for r in super().fetchall()]
+
+        def __iter__(self):
+            it = super().__iter__()
+            while True:
+                try:
+                    row = next(it)
+                except StopIteration:
+                    return
+                yield self._ler(row)
+
+    CursorRegistro.__name__ = f"Cursor{classe.__name__}"
+    return CursorRegistro
+
+def consultar_registros(conexao, classe, sql, parametros=None):
+    """Executa a consulta e retorna a lista de registros."""
+    with conexao.cursor(cursor_factory=cursor_de(classe)) as cursor:
+        cursor.execute(sql, parametros)
+        return cursor.fetchall()
+
+def iterar_registros(conexao, classe, sql, parametros=None, itersize=5000):
+    """Lê a consulta por um cursor nomeado (no servidor), gerando os registros sob demanda.
+
+    O cursor vive na transação corrente: não faça commit na mesma conexão
+    antes de consumir o fluxo.
+    """
+    nome = f"fluxo_{classe.__name__.lower()}_{uuid.uuid4().hex[:8]}"
+    with conexao.cursor(name=nome, cursor_factory=cursor_de(classe)) as cursor:
+        cursor.itersize = itersize
+        cursor.execute(sql, parametros)
+        yield from cursor
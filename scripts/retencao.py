@@ -0,0 +1,187 @@
+"""Retenção dos logs de envio HL7 e do histórico de execuções.
+
+Para cada tabela de POLITICAS, as linhas com a coluna de data anterior ao
+corte (hoje - dias de retenção) são exportadas para um CSV compactado
+(gzip) em DIR_ARQUIVO/<tabela>/ e só então removidas:
+
+* partição mensal inteira abaixo do corte (exa.log_envio_hl7, 010):
+  exportada, desanexada e descartada com DROP TABLE, sem DELETE;
+* demais casos (a partição "_legado", a padrão "_padrao", tabelas não
+  particionadas): exportação das linhas antigas e DELETE em lotes, com
+  commit por lote.
+
+A linha mais recente com status 'SUCESSO' de exa.controle_processamento
+nunca é removida: é a marca d'água da rotina de exames.
+
+Uso: python retencao.py [--simular]
+"""
+import gzip
+import logging
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+
+import banco
+import log_rotativo
+
+DIR_ARQUIVO = os.getenv("EPIMED_DIR_ARQUIVO", "/var/www/html/epimed/arquivo")
+DIAS_LOG = int(os.getenv("EPIMED_RETENCAO_LOG_DIAS", "180"))
+DIAS_EXECUCOES = int(os.getenv("EPIMED_RETENCAO_EXECUCOES_DIAS", "365"))
+TAMANHO_LOTE = int(os.getenv("EPIMED_RETENCAO_LOTE", "5000"))
+
+LOG_DIR = os.getenv("EPIMED_LOG_DIR", "/var/www/html/epimed/logs")
+
+# Arquivo ativo de nome fixo, rotacionado por dia e por tamanho (log_rotativo)
+LOG_PATH = os.path.join(LOG_DIR, "retencao.log")
+
+handler = log_rotativo.ArquivoLogRotativo(LOG_PATH)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+handler.setFormatter(formatter)
+
+logger = logging.getLogger("retencao_logger")
+logger.setLevel(logging.INFO)
+logger.addHandler(handler)
+logger.propagate = False
+
+def registrar_log(mensagem, nivel="info"):
+    print(f"[{nivel.upper()}] {datetime.now():%Y-%m-%d %H:%M:%S} - {mensagem}")
+    if nivel == "info":
+        logger.info(mensagem)
+    elif nivel == "error":
+        logger.error(mensagem)
+    elif nivel == "warning":
+        logger.warning(mensagem)
+
+# tabela -> (coluna de data, dias de retenção, condição adicional das linhas removíveis)
+POLITICAS = {
+    "exa.log_envio_hl7": ("data_envio", DIAS_LOG, None),
+    "public.log_envio_hl7": ("data_envio", DIAS_LOG, None),
+    "exa.log_execucoes": ("data_execucao", DIAS_EXECUCOES, None),
+    "exa.controle_processamento": ("data_inicio", DIAS_EXECUCOES, """
+        id IS DISTINCT FROM (SELECT id FROM exa.controle_processamento
+                             WHERE status = 'SUCESSO' ORDER BY data_inicio DESC LIMIT 1)"""),
+}
+
+_FAIXA = re.compile(r"FROM \((MINVALUE|'[^']+')\) TO \((MAXVALUE|'[^']+')\)")
+
+def particoes(conn, tabela):
+    """[(partição, início, fim)] das partições (None = MINVALUE/MAXVALUE; a padrão, sem faixa,
+    vem com início e fim None); [] se não particionada."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.oid::regclass::text, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+        """, (tabela,))
+        resultado = []
+        for particao, faixa in cur.fetchall():
+            m = _FAIXA.search(faixa or "")
+            if m is None:  # partição padrão: purgada por linha
+                resultado.append((particao, None, None))
+                continue
+            inicio, fim = (None if v.endswith("VALUE") else datetime.fromisoformat(v.strip("'")[:19])
+                           for v in m.groups())
+            resultado.append((particao, inicio, fim))
+        return sorted(resultado, key=lambda p: p[1] or datetime.min)
+
+def exportar(conn, tabela, consulta, parametros, rotulo):
+    """COPY da consulta para DIR_ARQUIVO/<tabela>/<tabela>_<rotulo>.csv.gz; retorna o caminho."""
+    destino = os.path.join(DIR_ARQUIVO, tabela)
+    os.makedirs(destino, exist_ok=True)
+    caminho = os.path.join(destino, f"{tabela}_{rotulo}.csv.gz")
+    temporario = f"{caminho}.tmp"
+    with conn.cursor() as cur:
+        sql = cur.mogrify(f"COPY ({consulta}) TO STDOUT WITH (FORMAT csv, HEADER)", parametros).decode()
+        with gzip.open(temporario, "wb", compresslevel=6) as arquivo:
+            cur.copy_expert(sql, arquivo)
+        with open(temporario, "rb") as arquivo:
+            os.fsync(arquivo.fileno())
+    os.replace(temporario, caminho)
+    return caminho
+
+def descartar_particao(conn, tabela, particao, fim, simular):
+    rotulo = f"{particao.split('.')[-1]}_ate_{fim:%Y%m%d}"
+    if simular:
+        registrar_log(f"[simulação] {particao}: exportar e descartar a partição inteira.")
+        return
+    caminho = exportar(conn, tabela, f"SELECT * FROM {particao}", None, rotulo)
+    with conn.cursor() as cur:
+        cur.execute(f"ALTER TABLE {tabela} DETACH PARTITION {particao}")
+        cur.execute(f"DROP TABLE {particao}")
+    conn.commit()
+    registrar_log(f"{particao} exportada para {caminho} e descartada.")
+
+def purgar_linhas(conn, tabela, coluna, corte, condicao, simular):
+    """Exporta e remove em lotes as linhas anteriores ao corte; retorna a quantidade removida."""
+    filtro = f"{coluna} < %(corte)s" + (f" AND {condicao}" if condicao else "")
+    parametros = {"corte": corte}
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM {tabela} WHERE {filtro}", parametros)
+        quantidade = cur.fetchone()[0]
+    conn.rollback()
+    if not quantidade:
+        return 0
+    if simular:
+        registrar_log(f"[simulação] {tabela}: {quantidade} linha(s) anteriores a {corte:%Y-%m-%d}.")
+        return quantidade
+
+    caminho = exportar(conn, tabela, f"SELECT * FROM {tabela} WHERE {filtro}", parametros,
+                       f"ate_{corte:%Y%m%d}_{datetime.now():%Y%m%d%H%M%S}")
+    conn.commit()
+    removidas = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                DELETE FROM {tabela}
+                WHERE ctid = ANY(ARRAY(SELECT ctid FROM {tabela} WHERE {filtro} LIMIT %(lote)s))
+            """, dict(parametros, lote=TAMANHO_LOTE))
+            lote = cur.rowcount
+        conn.commit()
+        removidas += lote
+        if lote < TAMANHO_LOTE:
+            break
+    registrar_log(f"{tabela}: {removidas} linha(s) exportadas para {caminho} e removidas.")
+    return removidas
+
+def aplicar_politica(conn, tabela, coluna, dias, condicao=None, simular=False):
+    """Aplica a política à tabela; retorna as linhas removidas por DELETE mais as partições descartadas."""
+    corte = datetime.combine(datetime.now().date() - timedelta(days=dias), datetime.min.time())
+    lista = particoes(conn, tabela)
+    if not lista:
+        return purgar_linhas(conn, tabela, coluna, corte, condicao, simular)
+
+    removidas = 0
+    for particao, inicio, fim in lista:
+        if fim is not None and fim <= corte and condicao is None:
+            descartar_particao(conn, tabela, particao, fim, simular)
+            removidas += 1
+        elif inicio is None or inicio < corte:
+            # Partição que atravessa o corte (ex.: a legada) ou a padrão: por linha
+            removidas += purgar_linhas(conn, particao, coluna, corte, condicao, simular)
+    return removidas
+
+def executar(simular=False):
+    conn = banco.obter()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(hashtext('epimed:retencao'))")
+            if not cur.fetchone()[0]:
+                registrar_log("Retenção já em execução.", nivel="warning")
+                return False
+        conn.commit()
+        for tabela, (coluna, dias, condicao) in POLITICAS.items():
+            try:
+                aplicar_politica(conn, tabela, coluna, dias, condicao, simular)
+            except Exception as erro:
+                conn.rollback()
+                registrar_log(f"Erro na retenção de {tabela}: {erro}", nivel="error")
+        return True
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock_all()")
+        conn.commit()
+        banco.devolver(conn)
+
+if __name__ == "__main__":
+    sys.exit(0 if executar(simular="--simular" in sys.argv[1:]) else 1)
@@ -0,0 +1,83 @@
+-- =====================================================================
+-- 001 — Janelas de exames por admissão
+--
+-- * exa.internacoes.prontuario: chave tipada do paciente (inteiro), para
+--   que o JOIN com exa.vw_exames não precise de prontuario::varchar e
+--   possa usar o índice por prontuário da origem.
+-- * exa.janelas_exame: janela (antes/depois da admissão) configurável por
+--   sigla de exame; a linha '*' é a janela padrão.
+-- * exa.admissoes.janela_exames: tsrange pré-calculado com a maior janela
+--   configurada, mantido por trigger e indexado com GiST.
+--
+-- Observação: a busca por faixa em exa.vw_exames depende de um índice
+-- btree (prontuario, dthr_programada) na tabela de origem da view.
+-- =====================================================================
+
+ALTER TABLE exa.internacoes
+    ADD COLUMN IF NOT EXISTS prontuario integer
+    GENERATED ALWAYS AS (
+        CASE WHEN medicalrecord ~ '^[0-9]{1,9}$' THEN medicalrecord::integer END
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_internacoes_prontuario
+    ON exa.internacoes (prontuario);
+
+CREATE TABLE IF NOT EXISTS exa.janelas_exame (
+    sigla   varchar(20) PRIMARY KEY,
+    antes   interval NOT NULL DEFAULT INTERVAL '4 hours',
+    depois  interval NOT NULL DEFAULT INTERVAL '24 hours',
+    CHECK (antes >= INTERVAL '0' AND depois >= INTERVAL '0')
+);
+
+-- Janela padrão: a mesma da rotina incremental (-4h / +24h)
+INSERT INTO exa.janelas_exame (sigla, antes, depois)
+VALUES ('*', INTERVAL '4 hours', INTERVAL '24 hours')
+ON CONFLICT (sigla) DO NOTHING;
+
+ALTER TABLE exa.admissoes
+    ADD COLUMN IF NOT EXISTS janela_exames tsrange;
+
+CREATE OR REPLACE FUNCTION exa.fn_janela_admissao(p_unitadmissiondatetime timestamp)
+RETURNS tsrange
+LANGUAGE sql STABLE AS $$
+    SELECT tsrange(p_unitadmissiondatetime - MAX(antes),
+                   p_unitadmissiondatetime + MAX(depois), '[]')
+    FROM exa.janelas_exame;
+$$;
+
+CREATE OR REPLACE FUNCTION exa.fn_calcular_janela_admissao()
+RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.janela_exames := exa.fn_janela_admissao(NEW.unitadmissiondatetime::timestamp);
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS tg_admissoes_janela_exames ON exa.admissoes;
+CREATE TRIGGER tg_admissoes_janela_exames
+    BEFORE INSERT OR UPDATE OF unitadmissiondatetime ON exa.admissoes
+    FOR EACH ROW EXECUTE FUNCTION exa.fn_calcular_janela_admissao();
+
+-- Alterações na configuração recalculam as janelas já gravadas
+CREATE OR REPLACE FUNCTION exa.fn_recalcular_janelas_admissoes()
+RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE exa.admissoes
+       SET janela_exames = exa.fn_janela_admissao(unitadmissiondatetime::timestamp);
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS tg_janelas_exame_recalcular ON exa.janelas_exame;
+CREATE TRIGGER tg_janelas_exame_recalcular
+    AFTER INSERT OR UPDATE OR DELETE ON exa.janelas_exame
+    FOR EACH STATEMENT EXECUTE FUNCTION exa.fn_recalcular_janelas_admissoes();
+
+UPDATE exa.admissoes
+   SET janela_exames = exa.fn_janela_admissao(unitadmissiondatetime::timestamp)
+ WHERE janela_exames IS NULL;
+
+CREATE INDEX IF NOT EXISTS ix_admissoes_janela_exames
+    ON exa.admissoes USING gist (janela_exames);
@@ -0,0 +1,19 @@
+-- =====================================================================
+-- 002 — Registro de idempotência dos envios HL7
+--
+-- Uma linha por entidade enviada ao Epimed (leito: lto_id; exame:
+-- adm_id|idexame|dthrcoleta) com o hash do conteúdo semântico da última
+-- mensagem e o MSH-10 usado. 'pendente' = enviado sem confirmação;
+-- 'aceito' = ACK AA recebido.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS idempotencia_hl7 (
+    entidade        varchar(20)  NOT NULL,
+    chave           varchar(200) NOT NULL,
+    hash_payload    char(64)     NOT NULL,
+    controle_msh10  varchar(50)  NOT NULL,
+    status          varchar(20)  NOT NULL DEFAULT 'pendente',
+    atualizado_em   timestamp    NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (entidade, chave),
+    CHECK (status IN ('pendente', 'aceito'))
+);
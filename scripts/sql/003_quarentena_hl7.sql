@@ -0,0 +1,20 @@
+-- =====================================================================
+-- 003 — Quarentena (cache negativo) de envios rejeitados (AE/AR)
+--
+-- Enquanto o hash do conteúdo for o mesmo e o item não tiver sido
+-- liberado por um operador, o reenvio é suprimido.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS quarentena_hl7 (
+    entidade           varchar(20)  NOT NULL,
+    chave              varchar(200) NOT NULL,
+    hash_payload       char(64)     NOT NULL,
+    codigo_ack         varchar(10)  NOT NULL,
+    detalhes_erro      text,
+    tentativas         integer      NOT NULL DEFAULT 1,
+    primeira_rejeicao  timestamp    NOT NULL DEFAULT NOW(),
+    ultima_rejeicao    timestamp    NOT NULL DEFAULT NOW(),
+    liberado_em        timestamp,
+    liberado_por       varchar(100),
+    PRIMARY KEY (entidade, chave)
+);
@@ -0,0 +1,24 @@
+-- =====================================================================
+-- 004 — Impressão digital (fingerprint) dos resultados de exames
+--
+-- exa.exames.impressao = md5 dos campos de resultado. A mesma função é
+-- usada na leitura da origem (exa.vw_exames), de modo que correções de
+-- valor e anulações de laudo são detectadas com uma única comparação.
+-- =====================================================================
+
+CREATE OR REPLACE FUNCTION exa.fn_impressao_exame(
+    p_valor text, p_tipo_inf_valor text, p_result_sigla_exa text, p_ind_anulacao_laudo text
+)
+RETURNS char(32)
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT md5(coalesce(p_valor, '') || '|' || coalesce(p_tipo_inf_valor, '') || '|' ||
+               coalesce(p_result_sigla_exa, '') || '|' || coalesce(p_ind_anulacao_laudo, ''));
+$$;
+
+ALTER TABLE exa.exames
+    ADD COLUMN IF NOT EXISTS impressao char(32);
+
+UPDATE exa.exames
+   SET impressao = exa.fn_impressao_exame(valor::text, tipo_inf_valor::text,
+                                          result_sigla_exa::text, ind_anulacao_laudo::text)
+ WHERE impressao IS NULL;
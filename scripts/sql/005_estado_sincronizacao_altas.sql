@@ -0,0 +1,18 @@
+-- =====================================================================
+-- 005 — Estado persistente das rotinas e conjunto ativo de internações
+--
+-- * estado_sincronizacao: pares chave/valor gravados pelas rotinas
+--   (marcas d'água, impressões das origens etc.).
+-- * índice parcial das internações sem alta: o conjunto varrido pela
+--   descoberta de exames.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS estado_sincronizacao (
+    chave          varchar(100) PRIMARY KEY,
+    valor          text,
+    atualizado_em  timestamp NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_internacoes_sem_alta
+    ON exa.internacoes (hospitaladmissionnumber)
+    WHERE medicaldischargedate IS NULL;
@@ -0,0 +1,15 @@
+-- =====================================================================
+-- 006 — Impressão digital dos atributos dos leitos
+--
+-- leitos.impressao = md5 de todos os campos enviados na mensagem HL7
+-- (unidade, tipo de unidade, leito, tipo de leito e situação), calculado
+-- no AGHU na leitura do inventário. Mudança de unidade, nome, leito
+-- extra ou CTI é detectada com uma comparação por leito.
+-- =====================================================================
+
+ALTER TABLE leitos
+    ADD COLUMN IF NOT EXISTS impressao char(32);
+
+-- Leitura do inventário local apenas pelo índice
+CREATE INDEX IF NOT EXISTS ix_leitos_clientid_impressao
+    ON leitos (clientid) INCLUDE (bedcode, bedstatus, impressao);
@@ -0,0 +1,26 @@
+-- =====================================================================
+-- 007 — Pendências da reconciliação por faixas (reconciliar.py)
+--
+-- Chaves presentes no AGHU e ausentes/divergentes na base local. Para
+-- exames, a próxima execução de verificar_exames.py busca os exames das
+-- admissões pendentes (adm_id) e marca as pendências como processadas.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS exa.reconciliacao_pendencias (
+    id             bigserial PRIMARY KEY,
+    entidade       varchar(20) NOT NULL,
+    chave          text NOT NULL,
+    adm_id         integer,
+    motivo         varchar(20) NOT NULL CHECK (motivo IN ('ausente', 'divergente')),
+    detectado_em   timestamp NOT NULL DEFAULT NOW(),
+    processado_em  timestamp
+);
+
+-- Uma pendência aberta por chave
+CREATE UNIQUE INDEX IF NOT EXISTS ux_reconciliacao_pendencias_abertas
+    ON exa.reconciliacao_pendencias (entidade, chave)
+    WHERE processado_em IS NULL;
+
+CREATE INDEX IF NOT EXISTS ix_reconciliacao_pendencias_adm
+    ON exa.reconciliacao_pendencias (adm_id)
+    WHERE processado_em IS NULL;
@@ -0,0 +1,28 @@
+-- =====================================================================
+-- 008 — Progresso da carga histórica de exames (backfill.py)
+--
+-- Cada lote (uma execução de backfill) é dividido em blocos de datas;
+-- os processos trabalhadores reservam blocos pendentes com SKIP LOCKED e
+-- registram aqui o andamento, o que permite acompanhar e retomar a carga.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS exa.backfill_blocos (
+    id                serial PRIMARY KEY,
+    lote              varchar(100) NOT NULL,
+    inicio            timestamp NOT NULL,
+    fim               timestamp NOT NULL,
+    status            varchar(20) NOT NULL DEFAULT 'pendente'
+                      CHECK (status IN ('pendente', 'processando', 'concluido', 'erro')),
+    tentativas        integer NOT NULL DEFAULT 0,
+    pid               integer,
+    exames_enviados   integer NOT NULL DEFAULT 0,
+    envios_pendentes  integer NOT NULL DEFAULT 0,
+    iniciado_em       timestamp,
+    concluido_em      timestamp,
+    erro              text,
+    UNIQUE (lote, inicio)
+);
+
+CREATE INDEX IF NOT EXISTS ix_backfill_blocos_pendentes
+    ON exa.backfill_blocos (lote, inicio)
+    WHERE status = 'pendente';
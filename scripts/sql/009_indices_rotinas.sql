@@ -0,0 +1,55 @@
+-- =====================================================================
+-- 009 — Índices das consultas quentes das rotinas
+--
+-- * exa.fn_garantir_indice: cria o índice só se a tabela ainda não tem
+--   um índice com as mesmas colunas iniciais (e unicidade, quando pedida),
+--   qualquer que seja o nome — bases criadas à mão já têm parte deles.
+-- * chaves dos ON CONFLICT de internações, admissões e exames;
+-- * exa.exames (dthrcoleta): leitura incremental e backfill por período;
+-- * exa.admissoes (hospitaladmissionnumber, unitadmissiondatetime DESC):
+--   admissão mais recente da internação.
+--
+-- O índice do journal de leitos do AGHU (agh.ain_leitos_jn) fica em
+-- sql/aghu/, aplicado pelo DBA do AGHU; migracoes.py verifica a presença.
+-- =====================================================================
+
+CREATE OR REPLACE FUNCTION exa.fn_garantir_indice(
+    p_tabela regclass, p_colunas text[], p_definicao text, p_unico boolean DEFAULT false
+)
+RETURNS boolean
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM pg_index i
+        WHERE i.indrelid = p_tabela
+          AND (i.indisunique OR NOT p_unico)
+          AND (SELECT array_agg(a.attname::text ORDER BY k.ordem)
+               FROM unnest(i.indkey[0:array_length(p_colunas, 1) - 1]) WITH ORDINALITY AS k(attnum, ordem)
+               JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum) = p_colunas
+          AND (NOT p_unico OR i.indnkeyatts = array_length(p_colunas, 1))
+    ) THEN
+        RETURN false;
+    END IF;
+    EXECUTE p_definicao;
+    RETURN true;
+END;
+$$;
+
+SELECT exa.fn_garantir_indice('exa.internacoes', ARRAY['hospitaladmissionnumber'],
+    'CREATE UNIQUE INDEX ux_internacoes_atendimento ON exa.internacoes (hospitaladmissionnumber)', true);
+
+SELECT exa.fn_garantir_indice('exa.admissoes',
+    ARRAY['hospitaladmissionnumber', 'unitcode', 'bedcode', 'unitadmissiondatetime'],
+    'CREATE UNIQUE INDEX ux_admissoes_chave ON exa.admissoes '
+    '(hospitaladmissionnumber, unitcode, bedcode, unitadmissiondatetime)', true);
+
+SELECT exa.fn_garantir_indice('exa.exames', ARRAY['adm_id', 'idexame', 'dthrcoleta'],
+    'CREATE UNIQUE INDEX ux_exames_chave ON exa.exames (adm_id, idexame, dthrcoleta)', true);
+
+SELECT exa.fn_garantir_indice('exa.exames', ARRAY['dthrcoleta'],
+    'CREATE INDEX ix_exames_dthrcoleta ON exa.exames (dthrcoleta)');
+
+SELECT exa.fn_garantir_indice('exa.admissoes', ARRAY['hospitaladmissionnumber', 'unitadmissiondatetime'],
+    'CREATE INDEX ix_admissoes_atendimento_data ON exa.admissoes '
+    '(hospitaladmissionnumber, unitadmissiondatetime DESC)');
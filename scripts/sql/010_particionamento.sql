@@ -0,0 +1,294 @@
+-- =====================================================================
+-- 010 — Particionamento mensal de exa.exames e exa.log_envio_hl7
+--
+-- * exa.fn_particionar_por_mes: converte a tabela em particionada por
+--   faixa mensal da coluna, sem copiar os dados: a tabela atual vira a
+--   partição "<tabela>_legado" (do início até o fim do mês corrente) e
+--   uma partição padrão recebe valores nulos ou fora das faixas. Os
+--   índices da tabela atual são recriados na tabela particionada (e
+--   reaproveitados na partição legada). Uma chave primária ou índice
+--   único sem a coluna de partição (ex.: PK em id) não pode existir na
+--   tabela particionada: vira chave única (colunas, coluna de partição) —
+--   PRIMARY KEY se a coluna não tiver nulos — mais um índice comum nas
+--   colunas originais, para as buscas por id.
+--   Chaves estrangeiras da tabela são recriadas na tabela particionada.
+--   As que apontam para ela são removidas: referenciam só o id, e a
+--   chave única passa a incluir a coluna de partição, que a tabela de
+--   origem não tem. A definição de cada uma fica em
+--   exa.particionamento_fks_removidas. Views que dependem da tabela
+--   interrompem a migração, para serem recriadas à mão.
+-- * exa.fn_criar_particoes_mensais: cria as partições dos próximos
+--   meses; chamada pela migração e no início de cada execução da rotina
+--   de exames (migracoes.preparar). Linhas de um mês ainda sem partição
+--   caem na partição padrão; ao criar a partição do mês, elas são
+--   movidas da padrão para a nova tabela antes da anexação.
+--
+-- A conversão valida a partição legada (uma leitura completa da tabela
+-- sob trava exclusiva) e cria nela o índice da nova chave única: aplicar
+-- fora do horário das rotinas.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS exa.particionamento_fks_removidas (
+    id           serial PRIMARY KEY,
+    tabela       text NOT NULL,
+    restricao    text NOT NULL,
+    definicao    text NOT NULL,
+    alvo         text NOT NULL,
+    removida_em  timestamp NOT NULL DEFAULT NOW()
+);
+
+CREATE OR REPLACE FUNCTION exa.fn_criar_particoes_mensais(p_tabela regclass, p_meses integer DEFAULT 3)
+RETURNS integer
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_esquema  text;
+    v_nome     text;
+    v_coluna   text;
+    v_padrao   regclass;
+    v_colunas  text;
+    v_particao text;
+    v_mes      timestamp;
+    v_ultimo   timestamp;
+    v_pendente boolean;
+    v_criadas  integer := 0;
+BEGIN
+    SELECT n.nspname, c.relname INTO v_esquema, v_nome
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = p_tabela;
+
+    SELECT a.attname INTO v_coluna
+    FROM pg_partitioned_table pt
+    JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+    WHERE pt.partrelid = p_tabela;
+
+    SELECT c.oid::regclass INTO v_padrao
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = p_tabela AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT';
+
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO v_colunas
+    FROM pg_attribute
+    WHERE attrelid = p_tabela AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+
+    -- Fim da última faixa já coberta por uma partição
+    SELECT max((regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''([^'']+)''\)'))[1]::timestamp)
+      INTO v_mes
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = p_tabela;
+
+    v_mes := COALESCE(v_mes, date_trunc('month', now()));
+    v_ultimo := date_trunc('month', now()) + make_interval(months => p_meses);
+
+    WHILE v_mes <= v_ultimo LOOP
+        v_particao := v_nome || to_char(v_mes, '"_p"YYYYMM');
+        v_pendente := false;
+        IF v_padrao IS NOT NULL THEN
+            EXECUTE format('SELECT EXISTS (SELECT 1 FROM %s WHERE %I >= %L AND %I < %L)',
+                           v_padrao, v_coluna, v_mes, v_coluna, v_mes + INTERVAL '1 month')
+               INTO v_pendente;
+        END IF;
+
+        IF to_regclass(format('%I.%I', v_esquema, v_particao)) IS NOT NULL THEN
+            NULL;
+        ELSIF v_pendente THEN
+            -- Linhas do mês já gravadas na partição padrão: a anexação falharia
+            -- com elas lá; vão para a tabela nova, que então é anexada
+            EXECUTE format('CREATE TABLE %I.%I (LIKE %s INCLUDING DEFAULTS INCLUDING GENERATED '
+                           'INCLUDING CONSTRAINTS INCLUDING STORAGE)', v_esquema, v_particao, p_tabela);
+            EXECUTE format('WITH movidas AS (DELETE FROM %s WHERE %I >= %L AND %I < %L RETURNING %s) '
+                           'INSERT INTO %I.%I (%s) SELECT %s FROM movidas',
+                           v_padrao, v_coluna, v_mes, v_coluna, v_mes + INTERVAL '1 month', v_colunas,
+                           v_esquema, v_particao, v_colunas, v_colunas);
+            EXECUTE format('ALTER TABLE %s ATTACH PARTITION %I.%I FOR VALUES FROM (%L) TO (%L)',
+                           p_tabela, v_esquema, v_particao, v_mes, v_mes + INTERVAL '1 month');
+            v_criadas := v_criadas + 1;
+        ELSE
+            EXECUTE format('CREATE TABLE %I.%I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)',
+                           v_esquema, v_particao, p_tabela, v_mes, v_mes + INTERVAL '1 month');
+            v_criadas := v_criadas + 1;
+        END IF;
+        v_mes := v_mes + INTERVAL '1 month';
+    END LOOP;
+    RETURN v_criadas;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION exa.fn_particionar_por_mes(p_tabela regclass, p_coluna text, p_meses integer DEFAULT 3)
+RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_esquema  text;
+    v_nome     text;
+    v_legado   text;
+    v_limite   timestamp := date_trunc('month', now()) + INTERVAL '1 month';
+    v_views    text;
+    v_colunas  text;
+    v_nulos    boolean;
+    v_registro record;
+BEGIN
+    SELECT n.nspname, c.relname INTO v_esquema, v_nome
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = p_tabela;
+
+    IF (SELECT relkind FROM pg_class WHERE oid = p_tabela) = 'p' THEN
+        RAISE NOTICE '%.% já é particionada', v_esquema, v_nome;
+        RETURN;
+    END IF;
+    v_legado := v_nome || '_legado';
+
+    SELECT string_agg(DISTINCT v.oid::regclass::text, ', ') INTO v_views
+    FROM pg_depend d
+    JOIN pg_rewrite r ON r.oid = d.objid
+    JOIN pg_class v ON v.oid = r.ev_class
+    WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = p_tabela AND v.oid <> p_tabela;
+    IF v_views IS NOT NULL THEN
+        RAISE EXCEPTION 'Views dependem de %.%: %. Remova-as, aplique a migração e recrie-as.',
+                        v_esquema, v_nome, v_views;
+    END IF;
+
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %s WHERE %I IS NULL)', p_tabela, p_coluna) INTO v_nulos;
+
+    -- FKs que apontam para a tabela: registradas e removidas (ver cabeçalho)
+    FOR v_registro IN
+        SELECT oid, conname, conrelid::regclass AS tabela FROM pg_constraint
+        WHERE confrelid = p_tabela AND contype = 'f'
+    LOOP
+        INSERT INTO exa.particionamento_fks_removidas (tabela, restricao, definicao, alvo)
+        VALUES (v_registro.tabela::text, v_registro.conname, pg_get_constraintdef(v_registro.oid),
+                p_tabela::text);
+        RAISE NOTICE 'Removendo FK % de % (alvo particionado, chave única passa a incluir %)',
+                     v_registro.conname, v_registro.tabela, p_coluna;
+        EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', v_registro.tabela, v_registro.conname);
+    END LOOP;
+
+    -- FKs da própria tabela: recriadas na tabela particionada depois da anexação
+    CREATE TEMP TABLE IF NOT EXISTS tmp_fks_legado (nome text, definicao text) ON COMMIT DROP;
+    DELETE FROM tmp_fks_legado;
+    INSERT INTO tmp_fks_legado
+    SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+    WHERE conrelid = p_tabela AND contype = 'f';
+
+    -- Tabela atual -> partição legada, com os índices renomeados
+    EXECUTE format('ALTER TABLE %I.%I RENAME TO %I', v_esquema, v_nome, v_legado);
+    CREATE TEMP TABLE IF NOT EXISTS tmp_indices_legado (nome text, definicao text, unico boolean,
+                                                        primaria boolean, tem_coluna boolean,
+                                                        colunas text) ON COMMIT DROP;
+    DELETE FROM tmp_indices_legado;
+    FOR v_registro IN
+        SELECT ci.relname AS nome, pg_get_indexdef(i.indexrelid) AS definicao, i.indisunique AS unico,
+               i.indisprimary AS primaria,
+               EXISTS (SELECT 1 FROM pg_attribute a
+                       WHERE a.attrelid = i.indrelid AND a.attname = p_coluna
+                         AND a.attnum = ANY(i.indkey)) AS tem_coluna,
+               (SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY k.ordem)
+                FROM unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ordem)
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum) AS colunas
+        FROM pg_index i JOIN pg_class ci ON ci.oid = i.indexrelid
+        WHERE i.indrelid = p_tabela
+    LOOP
+        EXECUTE format('ALTER INDEX %I.%I RENAME TO %I', v_esquema, v_registro.nome,
+                       left(v_registro.nome, 56) || '_legado');
+        INSERT INTO tmp_indices_legado VALUES (v_registro.nome, v_registro.definicao, v_registro.unico,
+                                               v_registro.primaria, v_registro.tem_coluna,
+                                               v_registro.colunas);
+    END LOOP;
+
+    EXECUTE format('CREATE TABLE %I.%I (LIKE %I.%I INCLUDING DEFAULTS INCLUDING GENERATED '
+                   'INCLUDING IDENTITY INCLUDING CONSTRAINTS INCLUDING STORAGE INCLUDING COMMENTS) '
+                   'PARTITION BY RANGE (%I)', v_esquema, v_nome, v_esquema, v_legado, p_coluna);
+
+    -- Mesmos índices na tabela particionada (na anexação, os da legada são
+    -- reaproveitados e os da nova chave única, criados nela)
+    FOR v_registro IN SELECT * FROM tmp_indices_legado LOOP
+        IF v_registro.primaria AND NOT v_registro.tem_coluna AND NOT v_nulos THEN
+            EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I PRIMARY KEY (%s, %I)',
+                           v_esquema, v_nome, v_registro.nome, v_registro.colunas, p_coluna);
+        ELSIF (v_registro.primaria OR v_registro.unico) AND NOT v_registro.tem_coluna THEN
+            IF v_registro.primaria THEN
+                RAISE NOTICE '%.% tem nulos: chave (%, %) criada como UNIQUE, não PRIMARY KEY',
+                             v_esquema, v_nome, v_registro.colunas, p_coluna;
+            END IF;
+            EXECUTE format('CREATE UNIQUE INDEX %I ON %I.%I (%s, %I)',
+                           v_registro.nome, v_esquema, v_nome, v_registro.colunas, p_coluna);
+        ELSIF v_registro.primaria THEN
+            EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I PRIMARY KEY (%s)',
+                           v_esquema, v_nome, v_registro.nome, v_registro.colunas);
+        ELSE
+            EXECUTE replace(v_registro.definicao,
+                            format(' ON %I.%I ', v_esquema, v_legado),
+                            format(' ON %I.%I ', v_esquema, v_nome));
+        END IF;
+        IF (v_registro.primaria OR v_registro.unico) AND NOT v_registro.tem_coluna THEN
+            -- Buscas só pelas colunas originais (ex.: log por id)
+            EXECUTE format('CREATE INDEX %I ON %I.%I (%s)',
+                           left('ix_' || v_nome || '_' || replace(v_registro.colunas, ', ', '_'), 63),
+                           v_esquema, v_nome, v_registro.colunas);
+        END IF;
+    END LOOP;
+
+    EXECUTE format('CREATE TABLE %I.%I PARTITION OF %I.%I DEFAULT',
+                   v_esquema, v_nome || '_padrao', v_esquema, v_nome);
+
+    -- Sequências (serial) passam a pertencer à tabela particionada: a
+    -- partição legada pode ser descartada pela retenção
+    FOR v_registro IN
+        SELECT a.attname, pg_get_serial_sequence(format('%I.%I', v_esquema, v_legado), a.attname) AS sequencia
+        FROM pg_attribute a
+        WHERE a.attrelid = p_tabela AND a.attnum > 0 AND NOT a.attisdropped AND a.attidentity = ''
+    LOOP
+        IF v_registro.sequencia IS NOT NULL THEN
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.%I.%I', v_registro.sequencia,
+                           v_esquema, v_nome, v_registro.attname);
+        END IF;
+    END LOOP;
+
+    -- Colunas identity ganharam sequência nova na tabela particionada: continua do maior valor
+    FOR v_registro IN
+        SELECT a.attname FROM pg_attribute a
+        WHERE a.attrelid = p_tabela AND a.attnum > 0 AND NOT a.attisdropped AND a.attidentity <> ''
+    LOOP
+        EXECUTE format('SELECT setval(%L, COALESCE((SELECT max(%I) FROM %I.%I), 0) + 1, false)',
+                       pg_get_serial_sequence(format('%I.%I', v_esquema, v_nome), v_registro.attname),
+                       v_registro.attname, v_esquema, v_legado);
+    END LOOP;
+
+    -- Linhas sem valor na coluna vão para a partição padrão
+    SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO v_colunas
+    FROM pg_attribute
+    WHERE attrelid = p_tabela AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+    IF v_nulos THEN
+        EXECUTE format('WITH movidas AS (DELETE FROM %I.%I WHERE %I IS NULL RETURNING %s) '
+                       'INSERT INTO %I.%I (%s) SELECT %s FROM movidas',
+                       v_esquema, v_legado, p_coluna, v_colunas, v_esquema, v_nome, v_colunas, v_colunas);
+    END IF;
+
+    -- CHECK equivalente à faixa: a anexação (e o NOT NULL exigido pela
+    -- chave primária) não precisa varrer a tabela de novo
+    EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I CHECK (%I IS NOT NULL AND %I < %L) NOT VALID',
+                   v_esquema, v_legado, v_legado || '_faixa', p_coluna, p_coluna, v_limite);
+    EXECUTE format('ALTER TABLE %I.%I VALIDATE CONSTRAINT %I', v_esquema, v_legado, v_legado || '_faixa');
+    IF NOT v_nulos THEN
+        EXECUTE format('ALTER TABLE %I.%I ALTER COLUMN %I SET NOT NULL', v_esquema, v_legado, p_coluna);
+    END IF;
+    EXECUTE format('ALTER TABLE %I.%I ATTACH PARTITION %I.%I FOR VALUES FROM (MINVALUE) TO (%L)',
+                   v_esquema, v_nome, v_esquema, v_legado, v_limite);
+    EXECUTE format('ALTER TABLE %I.%I DROP CONSTRAINT %I', v_esquema, v_legado, v_legado || '_faixa');
+
+    -- FKs na tabela particionada (a equivalente da partição legada é reaproveitada)
+    FOR v_registro IN SELECT * FROM tmp_fks_legado LOOP
+        EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I %s',
+                       v_esquema, v_nome, v_registro.nome, v_registro.definicao);
+    END LOOP;
+
+    PERFORM exa.fn_criar_particoes_mensais(format('%I.%I', v_esquema, v_nome)::regclass, p_meses);
+END;
+$$;
+
+SELECT exa.fn_particionar_por_mes('exa.exames', 'dthrcoleta');
+SELECT exa.fn_particionar_por_mes('exa.log_envio_hl7', 'data_envio');
+
+-- Índices das consultas quentes na tabela particionada (o 009 os criou na
+-- tabela anterior; aqui valem para as partições novas)
+SELECT exa.fn_garantir_indice('exa.exames', ARRAY['dthrcoleta'],
+    'CREATE INDEX ix_exames_dthrcoleta ON exa.exames (dthrcoleta)');
+SELECT exa.fn_garantir_indice('exa.exames', ARRAY['adm_id', 'idexame', 'dthrcoleta'],
+    'CREATE UNIQUE INDEX ux_exames_chave ON exa.exames (adm_id, idexame, dthrcoleta)', true);
@@ -0,0 +1,16 @@
+-- =====================================================================
+-- 011 — Índices da retenção de logs (retencao.py)
+--
+-- Tabelas purgadas por linha (sem partições que possam ser descartadas
+-- inteiras): a exclusão em lotes por data precisa do índice na coluna.
+-- exa.log_envio_hl7 já é particionada por data_envio (010).
+-- =====================================================================
+
+SELECT exa.fn_garantir_indice('public.log_envio_hl7', ARRAY['data_envio'],
+    'CREATE INDEX ix_log_envio_hl7_data_envio ON public.log_envio_hl7 (data_envio)');
+
+SELECT exa.fn_garantir_indice('exa.log_execucoes', ARRAY['data_execucao'],
+    'CREATE INDEX ix_log_execucoes_data_execucao ON exa.log_execucoes (data_execucao)');
+
+SELECT exa.fn_garantir_indice('exa.controle_processamento', ARRAY['data_inicio'],
+    'CREATE INDEX ix_controle_processamento_data_inicio ON exa.controle_processamento (data_inicio)');
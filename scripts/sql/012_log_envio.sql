@@ -0,0 +1,13 @@
+-- =====================================================================
+-- 012 — Colunas do log de envio HL7 de exames (log_envio.py)
+--
+-- O envio de exames passa a registrar mensagem e resposta na própria
+-- exa.log_envio_hl7 (antes o UPDATE ia para exa.log_exames_hl7), com a
+-- chave do exame como entidade. Na tabela particionada (010) o ALTER no
+-- pai propaga para as partições.
+-- =====================================================================
+
+ALTER TABLE exa.log_envio_hl7
+    ADD COLUMN IF NOT EXISTS chave    varchar(200),
+    ADD COLUMN IF NOT EXISTS mensagem text,
+    ADD COLUMN IF NOT EXISTS resposta text;
@@ -0,0 +1,34 @@
+-- =====================================================================
+-- 013 — Mensagens e respostas HL7 compactadas nos logs de envio
+--
+-- log_envio.py passa a gravar mensagem e resposta compactadas
+-- (compactacao_hl7.py) em mensagem_z / resposta_z. As colunas em texto
+-- ficam para as linhas antigas até a conversão em lotes
+-- (python log_envio.py migrar), que as esvazia.
+-- * STORAGE EXTERNAL: o valor já vem compactado; o TOAST não tenta
+--   compactá-lo de novo;
+-- * exa.dicionarios_hl7: dicionários de compactação, referenciados pelo
+--   id gravado no cabeçalho de cada valor — nunca remover linhas.
+-- =====================================================================
+
+CREATE TABLE IF NOT EXISTS exa.dicionarios_hl7 (
+    id          serial PRIMARY KEY,
+    algoritmo   smallint NOT NULL CHECK (algoritmo IN (1, 2)),  -- 1 = zlib, 2 = zstd
+    conteudo    bytea NOT NULL,
+    amostras    integer NOT NULL,
+    criado_em   timestamp NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE exa.log_envio_hl7
+    ADD COLUMN IF NOT EXISTS mensagem_z bytea,
+    ADD COLUMN IF NOT EXISTS resposta_z bytea;
+ALTER TABLE exa.log_envio_hl7
+    ALTER COLUMN mensagem_z SET STORAGE EXTERNAL,
+    ALTER COLUMN resposta_z SET STORAGE EXTERNAL;
+
+ALTER TABLE public.log_envio_hl7
+    ADD COLUMN IF NOT EXISTS mensagem_z bytea,
+    ADD COLUMN IF NOT EXISTS resposta_z bytea;
+ALTER TABLE public.log_envio_hl7
+    ALTER COLUMN mensagem_z SET STORAGE EXTERNAL,
+    ALTER COLUMN resposta_z SET STORAGE EXTERNAL;
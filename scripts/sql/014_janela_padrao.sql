@@ -0,0 +1,31 @@
+-- =====================================================================
+-- 014 — Janela padrão de exames sem a linha '*'
+--
+-- obter_exames_aghu usa a janela da sigla, senão a da linha '*' e, sem
+-- ela, a padrão de 001 (4 horas antes, 24 horas depois). A faixa
+-- pré-calculada em exa.admissoes.janela_exames passa a considerar a mesma
+-- janela padrão quando a linha '*' não existe; as faixas já gravadas são
+-- recalculadas só nesse caso.
+-- =====================================================================
+
+CREATE OR REPLACE FUNCTION exa.fn_janela_admissao(p_unitadmissiondatetime timestamp)
+RETURNS tsrange
+LANGUAGE sql STABLE AS $$
+    SELECT tsrange(p_unitadmissiondatetime - MAX(antes),
+                   p_unitadmissiondatetime + MAX(depois), '[]')
+    FROM (
+        SELECT antes, depois FROM exa.janelas_exame
+        UNION ALL
+        SELECT INTERVAL '4 hours', INTERVAL '24 hours'
+        WHERE NOT EXISTS (SELECT 1 FROM exa.janelas_exame WHERE sigla = '*')
+    ) janelas;
+$$;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM exa.janelas_exame WHERE sigla = '*') THEN
+        UPDATE exa.admissoes
+           SET janela_exames = exa.fn_janela_admissao(unitadmissiondatetime::timestamp);
+    END IF;
+END;
+$$;
@@ -0,0 +1,15 @@
+-- =====================================================================
+-- AGHU 001 — Índice do journal de leitos (aplicar no banco do AGHU)
+--
+-- As rotinas só leem o AGHU; este script é aplicado pelo DBA do AGHU.
+-- * (lto_id, ind_situacao, jn_date_time DESC): data mais recente de
+--   ativação/inativação de cada leito (verificar_leitos.obter_data_*);
+-- * (jn_date_time): MAX da impressão das origens.
+-- migracoes.py verifica a presença dos índices a cada execução.
+-- =====================================================================
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ain_leitos_jn_lto_situacao_data
+    ON agh.ain_leitos_jn (lto_id, ind_situacao, jn_date_time DESC);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ain_leitos_jn_data
+    ON agh.ain_leitos_jn (jn_date_time);
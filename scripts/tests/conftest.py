@@ -0,0 +1,22 @@
+import os
+import shutil
+import sys
+import tempfile
+
+# Os scripts importam os módulos irmãos pelo nome (python scripts/<módulo>.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Logs, índices e arquivos das rotinas num diretório temporário: alguns
+# módulos criam handlers e diretórios ao serem importados
+_BASE = tempfile.mkdtemp(prefix="epimed_testes_")
+os.environ.update({
+    "EPIMED_BASE_DIR": _BASE,
+    "EPIMED_LOG_DIR": os.path.join(_BASE, "logs"),
+    "EPIMED_DIR_RASTREIO": os.path.join(_BASE, "logs", "consultas"),
+    "EPIMED_DIR_INDICE": os.path.join(_BASE, "indice"),
+    "EPIMED_DIR_LOG_ENVIO": os.path.join(_BASE, "log_envio"),
+    "EPIMED_DIR_ARQUIVO": os.path.join(_BASE, "arquivo"),
+})
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_BASE, ignore_errors=True)
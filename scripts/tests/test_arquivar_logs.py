@@ -0,0 +1,71 @@
+"""Arquivamento dos logs: só arquivos fechados e de dias anteriores, fora os ocultos, com manifesto."""
+import gzip
+import json
+import os
+import time
+
+import pytest
+
+import arquivar_logs
+
+ONTEM = time.time() - 2 * 86400
+
+@pytest.fixture
+def diretorios(tmp_path, monkeypatch):
+    log_dir, backup_dir = tmp_path / "logs", tmp_path / "backup"
+    log_dir.mkdir()
+    backup_dir.mkdir()
+    monkeypatch.setattr(arquivar_logs, "LOG_DIR", str(log_dir))
+    monkeypatch.setattr(arquivar_logs, "BACKUP_DIR", str(backup_dir))
+    monkeypatch.setattr(arquivar_logs, "MANIFESTO", str(backup_dir / "manifesto.json"))
+    return log_dir, backup_dir
+
+def criar(caminho, conteudo, mtime=None):
+    caminho.parent.mkdir(parents=True, exist_ok=True)
+    caminho.write_bytes(conteudo)
+    if mtime is not None:
+        os.utime(caminho, (mtime, mtime))
+    return caminho
+
+def test_arquiva_so_os_fechados(diretorios):
+    log_dir, backup_dir = diretorios
+    antigo = criar(log_dir / "sincronizar_exames_2000-01-01_000000.log", b"antigo\n", ONTEM)
+    rotacionado = criar(log_dir / "sincronizar_leitos_2000-01-01_000000.log.gz", gzip.compress(b"rot\n"))
+    hoje = criar(log_dir / "sincronizar_exames.log", b"hoje\n")
+    aberto = criar(log_dir / "consultas" / "consultas_2000-01-01.jsonl", b"{}\n", ONTEM)
+    marca = criar(log_dir / "consultas" / "planos" / ".capturados" / "abc", b"", ONTEM)
+    trava = criar(log_dir / ".sincronizar_exames.log.lock", b"", ONTEM)
+
+    with open(aberto, "rb"):
+        arquivados, repetidos, erros = arquivar_logs.arquivar_logs()
+
+    assert (arquivados, repetidos, erros) == (2, 0, 0)
+    assert not antigo.exists() and not rotacionado.exists()
+    assert hoje.exists() and aberto.exists() and marca.exists() and trava.exists()
+
+    with open(backup_dir / "manifesto.json", encoding="utf-8") as arquivo:
+        manifesto = json.load(arquivo)
+    assert sorted(e["origem"] for e in manifesto.values()) == [
+        "sincronizar_exames_2000-01-01_000000.log", "sincronizar_leitos_2000-01-01_000000.log.gz",
+    ]
+    for destino, entrada in manifesto.items():
+        assert (backup_dir / destino).exists()
+        assert entrada["tamanho"] in (len(b"antigo\n"), len(gzip.compress(b"rot\n")))
+
+def test_arquivo_ja_arquivado_nao_e_copiado_de_novo(diretorios):
+    log_dir, backup_dir = diretorios
+    criar(log_dir / "a.log", b"mesmo conteudo\n", ONTEM)
+    assert arquivar_logs.arquivar_logs() == (1, 0, 0)
+
+    repetido = criar(log_dir / "b.log", b"mesmo conteudo\n", ONTEM)
+    assert arquivar_logs.arquivar_logs() == (0, 1, 0)
+    assert not repetido.exists()
+    with open(backup_dir / "manifesto.json", encoding="utf-8") as arquivo:
+        assert len(json.load(arquivo)) == 1
+
+def test_simulacao_nao_altera_nada(diretorios):
+    log_dir, backup_dir = diretorios
+    antigo = criar(log_dir / "a.log", b"antigo\n", ONTEM)
+    assert arquivar_logs.arquivar_logs(simular=True) == (1, 0, 0)
+    assert antigo.exists()
+    assert not (backup_dir / "manifesto.json").exists()
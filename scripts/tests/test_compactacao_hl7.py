@@ -0,0 +1,71 @@
+"""Compactação dos logs HL7: ida e volta com e sem dicionário, em zlib e zstd."""
+import pytest
+
+import compactacao_hl7
+from compactacao_hl7 import ZLIB, ZSTD, Compactador
+
+ALGORITMOS = [ZLIB] + ([ZSTD] if compactacao_hl7.zstandard is not None else [])
+
+def mensagem(i):
+    return (f"MSH|^~&|HUAP||EPIMED||20250101{i % 24:02d}0000||ORU^R01|{i:08d}_ORU|P|2.5|||||BR|ASCII\n"
+            f"PID|1|{100000 + i}|1235||^Integração HL7 Brasil||19910408000000|M|\n"
+            f"PV1|1||||||||||||||||||{500000 + i}||||||||||||||||||||||||||\n"
+            f"OBR|1|||||||||||||||||||||||||||\n"
+            f"OBX|1|NM|HB{i % 7}^Hemoglobina||{10 + i % 9}.{i % 10}|g/dL|||||F|||2025-01-01 00:{i % 60:02d}:00")
+
+AMOSTRAS = [mensagem(i) for i in range(400)]
+
+@pytest.fixture
+def dicionarios(monkeypatch):
+    """Dicionários em cache (id -> (algoritmo, conteúdo)), sem ida ao banco."""
+    cache = {}
+    monkeypatch.setattr(compactacao_hl7, "_dicionarios", cache)
+    return cache
+
+@pytest.mark.parametrize("algoritmo", ALGORITMOS)
+def test_ida_e_volta_sem_dicionario(algoritmo, dicionarios):
+    compactador = Compactador(algoritmo)
+    for texto in (AMOSTRAS[0], "", "ç|ã|\r\n"):
+        valor = compactador.compactar(texto)
+        assert valor[0] == algoritmo and valor[1:5] == b"\0\0\0\0"
+        assert compactacao_hl7.descompactar(None, valor) == texto
+    assert compactador.compactar(None) is None
+    assert compactacao_hl7.descompactar(None, None) is None
+
+@pytest.mark.parametrize("algoritmo", ALGORITMOS)
+def test_ida_e_volta_com_dicionario(algoritmo, dicionarios):
+    conteudo = compactacao_hl7.treinar(AMOSTRAS[:300], algoritmo)
+    assert 0 < len(conteudo) <= compactacao_hl7.TAMANHO_DICIONARIO[algoritmo]
+    dicionarios[42] = (algoritmo, conteudo)
+
+    com_dicionario = Compactador(algoritmo, 42, conteudo)
+    sem_dicionario = Compactador(algoritmo)
+    for texto in AMOSTRAS[300:]:
+        valor = com_dicionario.compactar(texto)
+        assert int.from_bytes(valor[1:5], "big") == 42
+        assert compactacao_hl7.descompactar(None, memoryview(valor)) == texto
+
+    total_com = sum(len(com_dicionario.compactar(t)) for t in AMOSTRAS[300:])
+    total_sem = sum(len(sem_dicionario.compactar(t)) for t in AMOSTRAS[300:])
+    assert total_com < total_sem
+
+def test_dicionario_ausente(dicionarios):
+    class ConexaoSemDicionario:
+        def cursor(self):
+            return self
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *_):
+            return False
+
+        def execute(self, *_):
+            pass
+
+        def fetchone(self):
+            return None
+
+    valor = Compactador(ZLIB, 7, b"PID|1|").compactar(AMOSTRAS[0])
+    with pytest.raises(LookupError):
+        compactacao_hl7.descompactar(ConexaoSemDicionario(), valor)
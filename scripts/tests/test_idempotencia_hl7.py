@@ -0,0 +1,88 @@
+"""Registro de idempotência: decisão de envio pelo hash do conteúdo e estado do último envio."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import idempotencia_hl7
+from idempotencia_hl7 import ENVIAR, IGNORAR, REENVIAR
+
+class ConexaoFalsa:
+    """Tabela idempotencia_hl7 em memória, com os comandos usados pelo módulo."""
+
+    def __init__(self, registros=None):
+        self.registros = dict(registros or {})
+        self.commits = 0
+        self._linha = None
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def execute(self, sql, parametros):
+        comando = sql.split()[0]
+        if comando == "SELECT":
+            self._linha = self.registros.get(parametros)
+        elif comando == "INSERT":
+            entidade, chave, hash_atual, controle = parametros
+            self.registros[(entidade, chave)] = (hash_atual, controle, "pendente")
+        elif comando == "UPDATE":
+            entidade, chave, controle = parametros
+            hash_atual, controle_gravado, _ = self.registros[(entidade, chave)]
+            if controle_gravado == controle:
+                self.registros[(entidade, chave)] = (hash_atual, controle, "aceito")
+
+    def fetchone(self):
+        return self._linha
+
+    def commit(self):
+        self.commits += 1
+
+def test_conteudo_novo_grava_pendente_antes_do_envio():
+    conn = ConexaoFalsa()
+    decisao, controle = idempotencia_hl7.preparar_envio(conn, "exame", "1|HB|x", "h1")
+    assert decisao == ENVIAR
+    assert conn.registros[("exame", "1|HB|x")] == ("h1", controle, "pendente")
+    assert conn.commits == 1
+
+def test_mesmo_conteudo_sem_aceite_reenvia_com_o_mesmo_msh10():
+    conn = ConexaoFalsa()
+    _, controle = idempotencia_hl7.preparar_envio(conn, "exame", "k", "h1")
+    assert idempotencia_hl7.preparar_envio(conn, "exame", "k", "h1") == (REENVIAR, controle)
+
+def test_mesmo_conteudo_aceito_e_ignorado():
+    conn = ConexaoFalsa()
+    _, controle = idempotencia_hl7.preparar_envio(conn, "exame", "k", "h1")
+    idempotencia_hl7.registrar_aceite(conn, "exame", "k", controle)
+    assert idempotencia_hl7.preparar_envio(conn, "exame", "k", "h1") == (IGNORAR, controle)
+
+def test_conteudo_alterado_envia_com_novo_msh10():
+    conn = ConexaoFalsa()
+    _, controle = idempotencia_hl7.preparar_envio(conn, "exame", "k", "h1")
+    idempotencia_hl7.registrar_aceite(conn, "exame", "k", controle)
+    decisao, novo = idempotencia_hl7.preparar_envio(conn, "exame", "k", "h2")
+    assert decisao == ENVIAR and novo != controle
+    assert conn.registros[("exame", "k")] == ("h2", novo, "pendente")
+
+def test_aceite_de_msh10_antigo_nao_confirma_o_conteudo_novo():
+    conn = ConexaoFalsa()
+    _, antigo = idempotencia_hl7.preparar_envio(conn, "exame", "k", "h1")
+    idempotencia_hl7.preparar_envio(conn, "exame", "k", "h2")
+    idempotencia_hl7.registrar_aceite(conn, "exame", "k", antigo)
+    assert idempotencia_hl7.preparar_envio(conn, "exame", "k", "h2")[0] == REENVIAR
+
+def test_hash_payload_distingue_campos():
+    assert idempotencia_hl7.hash_payload("a", None, 1) == idempotencia_hl7.hash_payload("a", "", "1")
+    assert idempotencia_hl7.hash_payload("a", "b") != idempotencia_hl7.hash_payload("b", "a")
+
+@pytest.mark.parametrize("coleta", [
+    datetime(2025, 1, 2, 3, 4, 5),
+    datetime(2025, 1, 2, 3, 4, 5, 999),
+    datetime(2025, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=-3))),
+])
+def test_chave_exame_sem_fuso_e_microssegundos(coleta):
+    assert idempotencia_hl7.chave_exame(7, "HB", coleta) == "7|HB|20250102030405"
@@ -0,0 +1,99 @@
+"""Índice de chaves em disco: cauda, par incompleto, último valor, compactação e reconstrução."""
+from datetime import datetime
+
+import pytest
+
+import indice_chaves
+from indice_chaves import IndiceChaves
+from registros import Exame, Internacao
+
+def exame(idexame, impressao, minuto=0):
+    return Exame(1, 100000, 500000, 1, idexame, f"Exame {idexame}", "1", "N", "mg/dL",
+                 idexame, 1, "N", datetime(2025, 1, 1, 0, minuto), impressao)
+
+@pytest.fixture
+def caminho(tmp_path):
+    caminho = str(tmp_path / "exames.idx")
+    indice_chaves.reconstruir(caminho, [exame("HB", "a"), exame("K", "b")])
+    return caminho
+
+def test_cauda_relida_na_abertura(caminho):
+    with IndiceChaves(caminho) as indice:
+        assert indice.acrescentar([exame("NA", "c")]) == 1
+
+    with IndiceChaves(caminho) as indice:
+        assert indice.ordenados == 2
+        assert indice.contem(exame("NA", "c"))
+        assert not indice.alterado(exame("NA", "c"))
+        assert len(indice) == 3
+
+def test_par_incompleto_no_fim_e_ignorado(caminho):
+    with IndiceChaves(caminho) as indice:
+        indice.acrescentar([exame("NA", "c")])
+    with open(caminho, "ab") as arquivo:
+        arquivo.write(b"\x01" * 11)
+
+    with IndiceChaves(caminho) as indice:
+        assert len(indice) == 3
+        assert indice.contem(exame("NA", "c"))
+
+def test_vale_o_ultimo_valor(caminho):
+    with IndiceChaves(caminho) as indice:
+        indice.acrescentar([exame("HB", "a2")])
+        indice.acrescentar([exame("HB", "a3")])
+
+    with IndiceChaves(caminho) as indice:
+        assert len(indice) == 2
+        assert not indice.alterado(exame("HB", "a3"))
+        assert indice.alterado(exame("HB", "a2"))
+        assert indice.alterado(exame("HB", "a"))
+
+def test_compactacao_incorpora_a_cauda(caminho):
+    with IndiceChaves(caminho) as indice:
+        indice.acrescentar([exame("HB", "a2"), exame("NA", "c"), exame("ZZ", "d", 5)])
+        indice.compactar()
+        assert indice.ordenados == 4
+        assert indice.cauda == {}
+
+    with IndiceChaves(caminho) as indice:
+        assert indice.ordenados == 4 and not indice.cauda
+        assert list(indice._chaves) == sorted(indice._chaves)
+        for registro in (exame("HB", "a2"), exame("K", "b"), exame("NA", "c"), exame("ZZ", "d", 5)):
+            assert indice.contem(registro) and not indice.alterado(registro)
+
+def test_compactacao_preserva_acrescimos_de_outro_processo(caminho):
+    compactador = IndiceChaves(caminho)
+    outro = IndiceChaves(caminho)
+    try:
+        outro.acrescentar([exame("NA", "c")])
+        compactador.acrescentar([exame("HB", "a2")])
+        compactador.compactar()
+    finally:
+        outro.fechar(compactar=False)
+        compactador.fechar(compactar=False)
+
+    with IndiceChaves(caminho) as indice:
+        assert indice.ordenados == 3
+        assert indice.contem(exame("NA", "c"))
+        assert not indice.alterado(exame("HB", "a2"))
+
+@pytest.mark.parametrize("conteudo", [b"", b"EPIDX0", b"EPIDX001" + bytes(24)])
+def test_assinatura_de_outra_versao_reconstroi(tmp_path, conteudo):
+    caminho = str(tmp_path / "internacoes.idx")
+    with open(caminho, "wb") as arquivo:
+        arquivo.write(conteudo)
+    with pytest.raises(ValueError):
+        IndiceChaves(caminho)
+
+    internacao = Internacao("H1", "P1", datetime(2025, 1, 1), None)
+    indice = indice_chaves.abrir(caminho, lambda: [internacao])
+    try:
+        assert indice.ordenados == 1
+        assert indice.contem(internacao)
+    finally:
+        indice.fechar()
+
+def test_acrescentar_existente_sem_indice_nao_cria_arquivo(tmp_path, monkeypatch):
+    monkeypatch.setattr(indice_chaves, "DIR_INDICE", str(tmp_path))
+    assert indice_chaves.acrescentar_existente("exames", [exame("HB", "a")]) == 0
+    assert not (tmp_path / "exames.idx").exists()
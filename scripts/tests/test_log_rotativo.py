@@ -0,0 +1,78 @@
+"""Rotação do log por tamanho, por dia e entre processos; limite total do diretório."""
+import gzip
+import logging
+import os
+from datetime import datetime
+
+import log_rotativo
+from log_rotativo import ArquivoLogRotativo
+
+def registro(mensagem="x" * 60):
+    return logging.makeLogRecord({"msg": mensagem, "levelno": logging.INFO, "levelname": "INFO"})
+
+def rotacionados(diretorio, extensao=".log.gz"):
+    return sorted(n for n in os.listdir(diretorio)
+                  if log_rotativo.ROTACIONADO.search(n) and n.endswith(extensao))
+
+def test_rotacao_por_tamanho(tmp_path):
+    caminho = str(tmp_path / "rotina.log")
+    handler = ArquivoLogRotativo(caminho, max_bytes=300, limite_total=0)
+    for i in range(20):
+        handler.emit(registro(f"{i:02d}" + "x" * 58))
+    handler.close()
+
+    arquivos = rotacionados(tmp_path)
+    assert len(arquivos) >= 3
+    assert os.path.getsize(caminho) < 300 + 62
+    linhas = []
+    for nome in arquivos:
+        with gzip.open(tmp_path / nome, "rt", encoding="utf-8") as arquivo:
+            linhas += arquivo.read().splitlines()
+    with open(caminho, encoding="utf-8") as arquivo:
+        linhas += arquivo.read().splitlines()
+    assert sorted(linhas) == [f"{i:02d}" + "x" * 58 for i in range(20)]
+
+def test_rotacao_na_virada_do_dia(tmp_path):
+    caminho = str(tmp_path / "rotina.log")
+    handler = ArquivoLogRotativo(caminho, max_bytes=0, limite_total=0)
+    handler.emit(registro("ontem"))
+    handler._inicio = datetime(2000, 1, 1, 23, 59, 59)
+    handler.emit(registro("hoje"))
+    handler.close()
+
+    assert rotacionados(tmp_path) == ["rotina_2000-01-01_235959.log.gz"]
+    with open(caminho, encoding="utf-8") as arquivo:
+        assert arquivo.read() == "hoje\n"
+
+def test_rotacao_por_outro_processo_reabre_o_arquivo(tmp_path):
+    caminho = str(tmp_path / "rotina.log")
+    primeiro = ArquivoLogRotativo(caminho, max_bytes=0, limite_total=0)
+    segundo = ArquivoLogRotativo(caminho, max_bytes=0, limite_total=0)
+    primeiro.emit(registro("antes"))
+    primeiro._inicio = datetime(2000, 1, 1)
+    primeiro.emit(registro("primeiro"))
+
+    # O segundo ainda tem aberto o arquivo renomeado: reabre o caminho, sem rotacionar de novo
+    segundo._inicio = datetime(2000, 1, 1)
+    segundo.emit(registro("segundo"))
+    primeiro.close()
+    segundo.close()
+
+    assert rotacionados(tmp_path) == ["rotina_2000-01-01_000000.log.gz"]
+    with open(caminho, encoding="utf-8") as arquivo:
+        assert arquivo.read().splitlines() == ["primeiro", "segundo"]
+
+def test_limite_total_remove_os_mais_antigos(tmp_path):
+    for dia in range(1, 6):
+        antigo = tmp_path / f"rotina_2000-01-0{dia}_000000.log.gz"
+        antigo.write_bytes(b"z" * 100)
+        mtime = datetime(2000, 1, dia).timestamp()
+        os.utime(antigo, (mtime, mtime))
+    (tmp_path / "outro.txt").write_bytes(b"o" * 50)
+
+    handler = ArquivoLogRotativo(str(tmp_path / "rotina.log"), max_bytes=0, limite_total=300)
+    handler._aplicar_limite()
+    handler.close()
+
+    assert rotacionados(tmp_path) == ["rotina_2000-01-04_000000.log.gz", "rotina_2000-01-05_000000.log.gz"]
+    assert (tmp_path / "outro.txt").exists()
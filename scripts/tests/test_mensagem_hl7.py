@@ -0,0 +1,22 @@
+"""Mensagem HL7 de exames: OBX-5 leva o resultado e OBX-2 o tipo dele."""
+from datetime import datetime
+
+import pytest
+
+from registros import Exame
+from verificar_exames import gerar_mensagem_hl7
+
+def obx(mensagem):
+    return next(s for s in mensagem.split("\n") if s.startswith("OBX|")).split("|")
+
+@pytest.mark.parametrize("tipo, valor, obx2", [("N", "13.5", "NM"), ("A", "Reagente", "ST"), (None, "x", "ST")])
+@pytest.mark.parametrize("status", ["F", "C", "D"])
+def test_obx_leva_o_valor_e_o_status(tipo, valor, obx2, status):
+    exame = Exame(1, 100000, 500000, 7, "HB", "Hemoglobina", valor, tipo, "g/dL", "HB", 1, "N",
+                  datetime(2025, 1, 1), "imp")
+    campos = obx(gerar_mensagem_hl7(exame, "MSG1", status))
+    assert campos[2] == obx2
+    assert campos[3] == "HB^Hemoglobina"
+    assert campos[5] == valor
+    assert campos[6] == "g/dL"
+    assert campos[11] == status
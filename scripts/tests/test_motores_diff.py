@@ -0,0 +1,91 @@
+"""Os motores de comparação de exames (EPIMED_MOTOR_DIFF) devem dar o mesmo resultado."""
+from datetime import datetime
+
+import pytest
+
+import indice_chaves
+from bench_diff import gerar_lados
+from diff_colunar import classificar_exames_colunar
+from diff_ordenado import chave_texto
+from registros import Exame
+from verificar_exames import classificar_exames, classificar_exames_indice, classificar_exames_ordenado
+
+def _conjunto(origem, destino, _):
+    return classificar_exames(origem, destino)
+
+def _ordenado(origem, destino, _):
+    return classificar_exames_ordenado(sorted(origem, key=chave_texto), sorted(destino, key=chave_texto))
+
+def _numpy(origem, destino, _):
+    return classificar_exames_colunar(origem, destino)
+
+def _indice(origem, destino, tmp_path):
+    caminho = str(tmp_path / "exames.idx")
+    indice_chaves.reconstruir(caminho, destino)
+    with indice_chaves.IndiceChaves(caminho) as indice:
+        return classificar_exames_indice(origem, indice)
+
+MOTORES = {"conjunto": _conjunto, "ordenado": _ordenado, "numpy": _numpy, "indice": _indice}
+
+def _resumo(resultado):
+    """(novos, corrigidos, anulados) independente da ordem de cada lista."""
+    return tuple(
+        sorted((chave_texto(e), e.impressao, e.ind_anulacao_laudo) for e in lista)
+        for lista in resultado
+    )
+
+def exame(adm_id, idexame, minuto, impressao, anulado="N"):
+    coleta = None if minuto is None else datetime(2025, 1, 1, 0, minuto)
+    return Exame(adm_id, 100000, 500000, 1, idexame, f"Exame {idexame}", "1", "N", "mg/dL",
+                 idexame, 1, anulado, coleta, impressao)
+
+def _casos_de_borda():
+    origem = [
+        # chave repetida na origem: prevalece o laudo não anulado
+        exame(1, "HB", 0, "a1", "S"),
+        exame(1, "HB", 0, "a2"),
+        # anulação repetida: uma só, para a chave já gravada
+        exame(1, "K", 1, "b1", "S"),
+        exame(1, "K", 1, "b2", "S"),
+        # anulado sem linha local: não é enviado
+        exame(1, "NA", 2, "c1", "S"),
+        # repetida sem anulação: vale a primeira
+        exame(2, "HB", 3, "d1"),
+        exame(2, "HB", 3, "d2"),
+        # partes da chave nulas
+        exame(None, "HB", 4, "e1"),
+        exame(3, "HB", None, "f1"),
+        exame(3, "K", None, "e2"),
+        # sem alteração
+        exame(4, "HB", 5, "ee"),
+    ]
+    destino = [
+        exame(1, "HB", 0, "aa"),
+        exame(1, "K", 1, "bb"),
+        exame(3, "HB", None, "f0"),
+        exame(4, "HB", 5, "ee"),
+    ]
+    return origem, destino
+
+CASOS = {
+    "bench_diff": lambda: gerar_lados(5000),
+    "borda": _casos_de_borda,
+}
+
+@pytest.mark.parametrize("caso", CASOS)
+@pytest.mark.parametrize("motor", [m for m in MOTORES if m != "conjunto"])
+def test_motor_igual_ao_conjunto(caso, motor, tmp_path):
+    origem, destino = CASOS[caso]()
+    esperado = _resumo(_conjunto(origem, destino, tmp_path))
+    assert _resumo(MOTORES[motor](origem, destino, tmp_path)) == esperado
+
+def test_casos_de_borda_resultado():
+    novos, corrigidos, anulados = _resumo(classificar_exames(*_casos_de_borda()))
+    assert [c for c, _, _ in novos] == sorted([
+        chave_texto(exame(2, "HB", 3, "")), chave_texto(exame(None, "HB", 4, "")),
+        chave_texto(exame(3, "K", None, "")),
+    ])
+    assert [(c, i) for c, i, _ in corrigidos] == sorted([
+        (chave_texto(exame(1, "HB", 0, "")), "a2"), (chave_texto(exame(3, "HB", None, "")), "f1"),
+    ])
+    assert [(c, i) for c, i, _ in anulados] == [(chave_texto(exame(1, "K", 1, "")), "b1")]
@@ -0,0 +1,36 @@
+"""Partição de leitos por pertence(): exatamente uma partição por valor, a mesma em qualquer processo."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+from particionamento import condicao, pertence
+
+VALORES = [f"{bloco}{numero:03d}" for bloco in "ABCDEFGH" for numero in range(125)] + list(range(200))
+
+@pytest.mark.parametrize("total", [1, 2, 3, 8])
+def test_cada_valor_em_uma_so_particao(total):
+    for valor in VALORES:
+        assert sum(pertence(valor, (i, total)) for i in range(total)) == 1
+
+def test_distribuicao_equilibrada():
+    total = 4
+    contagem = [sum(pertence(v, (i, total)) for v in VALORES) for i in range(total)]
+    assert min(contagem) > len(VALORES) / total * 0.8
+
+def test_mesma_particao_em_outro_processo():
+    """Não depende do hash aleatório do Python (PYTHONHASHSEED) nem do tipo do valor."""
+    codigo = ("import sys; sys.path.insert(0, sys.argv[1]); from particionamento import pertence; "
+              "print(''.join(str(int(pertence(v, (1, 3)))) for v in sys.argv[2:]))")
+    amostra = [str(v) for v in VALORES[:50]]
+    diretorio = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    saida = subprocess.run([sys.executable, "-c", codigo, diretorio, *amostra], check=True, capture_output=True,
+                           text=True, env=dict(os.environ, PYTHONHASHSEED="123")).stdout.strip()
+    assert saida == "".join(str(int(pertence(v, (1, 3)))) for v in VALORES[:50])
+    assert pertence(7, (1, 3)) == pertence("7", (1, 3))
+
+def test_condicao_sql():
+    sql, parametros = condicao("a.hospitaladmissionnumber", (2, 4))
+    assert sql == "(hashtext(a.hospitaladmissionnumber::text)::bigint %% %s + %s) %% %s = %s"
+    assert parametros == (4, 4, 4, 2)
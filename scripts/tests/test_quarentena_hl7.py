@@ -0,0 +1,82 @@
+"""Quarentena no envio de exames: suprime o conteúdo rejeitado, registra AE/AR e remove no AA."""
+from datetime import datetime
+
+import pytest
+
+import idempotencia_hl7
+import log_envio
+import quarentena_hl7
+import verificar_exames
+from registros import Exame
+
+class GravadorFalso:
+    def reservar_id(self):
+        return 1
+
+    def registrar_envio(self, *args):
+        pass
+
+    def registrar_resposta(self, *args):
+        pass
+
+@pytest.fixture
+def envio(monkeypatch):
+    """Estado da quarentena e chamadas feitas pelo envio, com o ACK escolhido pelo teste."""
+    estado = {"quarentena": set(), "chamadas": [], "ack": "AA", "enviadas": 0}
+
+    def em_quarentena(conn, entidade, chave, hash_atual):
+        return (entidade, chave, hash_atual) in estado["quarentena"]
+
+    def registrar_rejeicao(conn, entidade, chave, hash_atual, codigo_ack, detalhes_erro=None):
+        estado["quarentena"] = {q for q in estado["quarentena"] if q[:2] != (entidade, chave)}
+        estado["quarentena"].add((entidade, chave, hash_atual))
+        estado["chamadas"].append(("rejeicao", codigo_ack))
+
+    def remover_quarentena(conn, entidade, chave):
+        estado["quarentena"] = {q for q in estado["quarentena"] if q[:2] != (entidade, chave)}
+        estado["chamadas"].append(("remocao",))
+
+    def enviar(mensagem):
+        estado["enviadas"] += 1
+        return estado["ack"]
+
+    monkeypatch.setattr(quarentena_hl7, "em_quarentena", em_quarentena)
+    monkeypatch.setattr(quarentena_hl7, "registrar_rejeicao", registrar_rejeicao)
+    monkeypatch.setattr(quarentena_hl7, "remover_quarentena", remover_quarentena)
+    monkeypatch.setattr(idempotencia_hl7, "preparar_envio", lambda *a: (idempotencia_hl7.ENVIAR, "M1"))
+    monkeypatch.setattr(idempotencia_hl7, "registrar_aceite",
+                        lambda *a: estado["chamadas"].append(("aceite",)))
+    monkeypatch.setattr(log_envio, "gravador", lambda tabela: GravadorFalso())
+    monkeypatch.setattr(verificar_exames, "enviar_mensagem_hl7", enviar)
+    return estado
+
+def exame(valor="13.5"):
+    return Exame(1, 100000, 500000, 7, "HB", "Hemoglobina", valor, "N", "g/dL", "HB", 1, "N",
+                 datetime(2025, 1, 1), "imp")
+
+@pytest.mark.parametrize("ack", quarentena_hl7.CODIGOS_REJEICAO)
+def test_rejeicao_coloca_em_quarentena_e_suprime_o_mesmo_conteudo(envio, ack):
+    envio["ack"] = ack
+    assert verificar_exames.enviar_exame_hl7(None, exame()) == ack
+    assert envio["chamadas"] == [("rejeicao", ack)]
+
+    assert verificar_exames.enviar_exame_hl7(None, exame()) == quarentena_hl7.EM_QUARENTENA
+    assert envio["enviadas"] == 1
+
+def test_conteudo_alterado_sai_da_quarentena_quando_aceito(envio):
+    envio["ack"] = "AE"
+    verificar_exames.enviar_exame_hl7(None, exame())
+
+    envio["ack"] = "AA"
+    assert verificar_exames.enviar_exame_hl7(None, exame("14.0")) == "AA"
+    assert envio["chamadas"][1:] == [("aceite",), ("remocao",)]
+    assert not envio["quarentena"]
+    assert verificar_exames.enviar_exame_hl7(None, exame()) == "AA"
+    assert envio["enviadas"] == 3
+
+def test_outros_acks_nao_entram_em_quarentena(envio):
+    envio["ack"] = "TIMEOUT"
+    assert verificar_exames.enviar_exame_hl7(None, exame()) == "TIMEOUT"
+    assert envio["chamadas"] == []
+    assert verificar_exames.enviar_exame_hl7(None, exame()) == "TIMEOUT"
+    assert envio["enviadas"] == 2
@@ -0,0 +1,56 @@
+"""Retenção de tabelas particionadas: partições abaixo do corte descartadas, a padrão purgada por linha."""
+from datetime import datetime, timedelta
+
+import retencao
+
+class ConexaoParticoes:
+    """Responde à consulta de pg_inherits com as faixas informadas."""
+
+    def __init__(self, faixas):
+        self.faixas = faixas
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def execute(self, *_):
+        pass
+
+    def fetchall(self):
+        return self.faixas
+
+def test_particoes_inclui_a_padrao():
+    conn = ConexaoParticoes([
+        ("exa.log_envio_hl7_202501", "FOR VALUES FROM ('2025-01-01 00:00:00') TO ('2025-02-01 00:00:00')"),
+        ("exa.log_envio_hl7_padrao", "DEFAULT"),
+        ("exa.log_envio_hl7_legado", "FOR VALUES FROM (MINVALUE) TO ('2025-01-01 00:00:00')"),
+    ])
+    assert retencao.particoes(conn, "exa.log_envio_hl7") == [
+        ("exa.log_envio_hl7_padrao", None, None),
+        ("exa.log_envio_hl7_legado", None, datetime(2025, 1, 1)),
+        ("exa.log_envio_hl7_202501", datetime(2025, 1, 1), datetime(2025, 2, 1)),
+    ]
+
+def test_politica_purga_a_padrao_por_linha(monkeypatch):
+    hoje = datetime.combine(datetime.now().date(), datetime.min.time())
+    antiga, recente = hoje - timedelta(days=400), hoje - timedelta(days=10)
+    lista = [
+        ("t_padrao", None, None),
+        ("t_legado", None, antiga),
+        ("t_antiga", antiga, antiga + timedelta(days=31)),
+        ("t_recente", recente, recente + timedelta(days=31)),
+    ]
+    chamadas = []
+    monkeypatch.setattr(retencao, "particoes", lambda conn, tabela: lista)
+    monkeypatch.setattr(retencao, "descartar_particao",
+                        lambda conn, tabela, particao, fim, simular: chamadas.append(("descartar", particao)))
+    monkeypatch.setattr(retencao, "purgar_linhas",
+                        lambda conn, tabela, coluna, corte, condicao, simular: chamadas.append(("purgar", tabela)) or 2)
+
+    assert retencao.aplicar_politica(None, "t", "data_envio", 180) == 2 + 1 + 1
+    assert chamadas == [("purgar", "t_padrao"), ("descartar", "t_legado"), ("descartar", "t_antiga")]
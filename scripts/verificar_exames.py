@@ -1,40 +1,45 @@
 import os
-import psycopg2
-import requests
 import logging
-import traceback
-import xml.etree.ElementTree as ET
-from psycopg2.extras import RealDictCursor
-from datetime import datetime
-from dotenv import load_dotenv
-
-# Configurações do banco de dados
-load_dotenv()
-
-EPIMED_DB_CONFIG = {
-    'dbname': os.getenv("epimed_dbname"),
-    'user': os.getenv("epimed_user"),
-    'password': os.getenv("epimed_password"),
-    'host': os.getenv("epimed_host"),
-    'port': os.getenv("epimed_port")
-}
-
-AGHU_DB_CONFIG = {
-    'dbname': os.getenv("aghu_dbname"),
-    'user': os.getenv("aghu_user"),
-    'password': os.getenv("aghu_password"),
-    'host': os.getenv("aghu_host"),
-    'port': os.getenv("aghu_port")
-}
-
-LOG_DIR = "/var/www/html/epimed/logs"
-os.makedirs(LOG_DIR, exist_ok=True)
-
-data_hoje = datetime.now().strftime("%Y-%m-%d")
-LOG_NAME = f"sincronizar_exames_{data_hoje}.log"
-LOG_PATH = os.path.join(LOG_DIR, LOG_NAME)
-
-handler = logging.FileHandler(LOG_PATH, mode='a', encoding='utf-8')
+from psycopg2.extras import RealDictCursor, execute_values
+from datetime import datetime, timedelta
+
+import banco
+import estado_sincronizacao
+import idempotencia_hl7
+import indice_chaves
+import log_envio
+import log_rotativo
+import migracoes
+import particionamento
+import quarentena_hl7
+from diff_ordenado import ALTERAR, INSERIR, ErroOrdenacao, diff_ordenado, mesclar, ordem_sql
+from registros import Admissao, Exame, Internacao, consultar_registros, iterar_registros
+
+# Motor de comparação origem x base local: "ordenado" (merge de fluxos ordenados,
+# memória constante), "conjunto" (listas completas em memória), "numpy"
+# (exames em arrays colunares; internações e admissões seguem por conjuntos)
+# ou "indice" (chaves locais no índice em disco, sem ler as tabelas exa.*)
+MOTOR_DIFF = os.getenv("EPIMED_MOTOR_DIFF", "ordenado")
+
+# Log dos envios HL7 de exames (gravado em lote por log_envio)
+TABELA_LOG_ENVIO = "exa.log_envio_hl7"
+
+# Exames são comparados desde (marca d'água - JANELA_CORRECOES): correções e
+# anulações de laudo feitas depois da coleta continuam visíveis por esse prazo
+JANELA_CORRECOES = timedelta(days=int(os.getenv("EPIMED_JANELA_CORRECOES_DIAS", "7")))
+
+# Impressão das origens: após este prazo a rotina roda mesmo sem alterações
+VALIDADE_IMPRESSAO_ORIGENS = timedelta(hours=int(os.getenv("EPIMED_VALIDADE_IMPRESSAO_HORAS", "6")))
+
+# migracoes.preparar (partições futuras, alertas do esquema) roda no máximo uma vez por este prazo
+VALIDADE_PREPARACAO = timedelta(hours=int(os.getenv("EPIMED_VALIDADE_PREPARACAO_HORAS", "24")))
+
+LOG_DIR = os.getenv("EPIMED_LOG_DIR", "/var/www/html/epimed/logs")
+
+# Arquivo ativo de nome fixo, rotacionado por dia e por tamanho (log_rotativo)
+LOG_PATH = os.path.join(LOG_DIR, "sincronizar_exames.log")
+
+handler = log_rotativo.ArquivoLogRotativo(LOG_PATH)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 
@@ -43,15 +48,7 @@ logger.setLevel(logging.INFO)
 logger.addHandler(handler)
 logger.propagate = False
 
-logging.basicConfig(
-    filename=LOG_PATH,
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    encoding='utf-8'
-)
-
-def conectar_db(config):
-    return psycopg2.connect(**config)
+logging.basicConfig(level=logging.INFO, handlers=[handler])
 
 def registrar_log(mensagem, nivel="info"):
     print(f"[{nivel.upper()}] {datetime.now():%Y-%m-%d %H:%M:%S} - {mensagem}")
@@ -62,37 +59,6 @@ def registrar_log(mensagem, nivel="info"):
     elif nivel == "warning":
         logger.warning(mensagem)
         
-def salvar_log_envio(exame_id, conexao):
-    try:
-        with conexao.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO exa.log_envio_hl7 (exame_id, data_envio, status)
-                VALUES (%s, NOW(), 'pendente')
-                RETURNING id
-            """, (exame_id,))
-            log_id = cursor.fetchone()[0]
-        registrar_log(f"Log de envio criado para o exame {exame_id} com id {log_id}.", nivel="info")
-        return log_id
-    except Exception as e:
-        registrar_log(f"Erro ao salvar log de envio para o exame {exame_id}: {e}", nivel="error")
-        raise
-
-def salvar_log_resposta(log_id, mensagem, resposta, conexao):
-    try:
-        with conexao.cursor() as cursor:
-            cursor.execute(
-                """
-                UPDATE exa.log_exames_hl7
-                SET mensagem = %s, resposta = %s, status = %s
-                WHERE id = %s
-                """,
-                (mensagem, resposta, 'enviado', log_id)
-            )
-        registrar_log(f"Log de resposta atualizado para id {log_id}.", nivel="info")
-    except Exception as e:
-        registrar_log(f"Erro ao atualizar log de resposta para id {log_id}: {e}", nivel="error")
-        raise
-  
 def obter_data_ultimo_processamento(conn):
     with conn.cursor() as cur:
         cur.execute("""SELECT MAX(data_inicio) 
@@ -129,265 +95,388 @@ def registrar_auditoria(conn, novas_internacoes, novas_admissoes, novos_exames,
     conn.commit()
     registrar_log(f"Log de auditoria registrado: {status}")
 
-def obter_internacoes_baselocal(conn, data_referencia=None):
-    internacoes = []
+def calcular_impressao_origens(conn, desde):
+    """Impressão barata das origens da rotina (contagens e maiores datas, no servidor).
+
+    Cobre as internações, admissões e altas (public.vw_epimed) e os exames
+    (exa.vw_exames) com data a partir de desde, a configuração de janelas,
+    as liberações de quarentena e as pendências abertas da reconciliação.
+    Cada subconsulta das views do AGHU é limitada por desde, para não varrer
+    a view inteira numa execução ociosa.
+    """
     with conn.cursor() as cur:
-        if data_referencia:
-            cur.execute("""
-                SELECT hospitaladmissionnumber,
-                 medicalrecord,
-                 hospitaladmissiondate,
-                 medicaldischargedate
-                FROM exa.internacoes
-                WHERE hospitaladmissiondate >= %s;
-            """, (data_referencia,))
-        else:
-            cur.execute("""
-                SELECT hospitaladmissionnumber,
-                medicalrecord,
-                hospitaladmissiondate,
-                medicaldischargedate
-                FROM exa.internacoes;""")
-        for row in cur.fetchall():
-            internacoes.append({
-                "hospitaladmissionnumber": row[0],
-                "medicalrecord": row[1],
-                "hospitaladmissiondate": row[2],
-                "medicaldischargedate": row[3]
-            })
-    return internacoes
-
-def obter_internacoes_aghu(conn, data_referencia=None):
+        cur.execute("""
+            SELECT md5(concat_ws('|',
+                (SELECT concat_ws(',', COUNT(*), MAX(hospitaladmissiondate))
+                   FROM public.vw_epimed
+                  WHERE hospitaladmissiondate >= %(desde)s),
+                (SELECT concat_ws(',', COUNT(*), MAX(unitadmissiondatetime))
+                   FROM public.vw_epimed
+                  WHERE unitadmissiondatetime >= %(desde)s),
+                (SELECT concat_ws(',', COUNT(*), MAX(medicaldischargedate))
+                   FROM public.vw_epimed
+                  WHERE medicaldischargedate >= %(desde)s),
+                (SELECT concat_ws(',', COUNT(*), MAX(dthr_programada), MAX(dthr_liberacao),
+                                  COUNT(*) FILTER (WHERE ind_anulacao_laudo = 'S'))
+                   FROM exa.vw_exames
+                  WHERE dthr_programada >= %(desde)s),
+                (SELECT string_agg(concat_ws(',', sigla, antes, depois), ';' ORDER BY sigla)
+                   FROM exa.janelas_exame),
+                (SELECT MAX(liberado_em) FROM quarentena_hl7 WHERE entidade = 'exame'),
+                (SELECT concat_ws(',', COUNT(*), MAX(id))
+                   FROM exa.reconciliacao_pendencias
+                  WHERE processado_em IS NULL)
+            ));
+        """, {"desde": desde})
+        return cur.fetchone()[0]
+
+def obter_impressao_anterior(conn, ultima_data):
+    """Retorna (desde, impressão) da última execução completa, ainda na validade.
+
+    A impressão é gravada como "desde|md5" e recalculada com o mesmo desde,
+    para que a comparação não mude só porque a marca d'água avançou. Sem
+    impressão válida, desde = ultima_data - JANELA_CORRECOES.
+    """
+    valor = estado_sincronizacao.obter_estado(conn, "exames.impressao_origens", VALIDADE_IMPRESSAO_ORIGENS)
+    if valor and "|" in valor:
+        desde, impressao = valor.split("|", 1)
+        return datetime.fromisoformat(desde), impressao
+    return ultima_data - JANELA_CORRECOES, None
+
+def preparar_esquema(conn, forcar=False):
+    """migracoes.preparar, no máximo uma vez por VALIDADE_PREPARACAO (sempre com forcar)."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('estado_sincronizacao') IS NOT NULL")
+        existe_estado = cur.fetchone()[0]
+    if existe_estado and not forcar and estado_sincronizacao.obter_estado(
+            conn, "exames.preparacao", VALIDADE_PREPARACAO):
+        conn.commit()
+        return
+    for alerta in migracoes.preparar(conn):
+        registrar_log(alerta, nivel="warning")
+    if existe_estado:
+        estado_sincronizacao.salvar_estado(conn, "exames.preparacao", datetime.now().isoformat())
+    conn.commit()
+
+def _onde(sql, condicoes, parametros):
+    """Acrescenta as condições (fragmento, parâmetros) ao SQL, unidas por AND."""
+    if not condicoes:
+        return sql, None
+    sql += "\n        WHERE " + "\n          AND ".join(c for c, _ in condicoes)
+    return sql, tuple(p for _, ps in condicoes for p in ps) + tuple(parametros)
+
+def _condicoes(data_coluna, data_referencia, particao, coluna_particao="hospitaladmissionnumber"):
+    condicoes = []
+    if data_referencia:
+        condicoes.append((f"{data_coluna} >= %s", (data_referencia,)))
+    if particao is not None:
+        condicoes.append(particionamento.condicao(coluna_particao, particao))
+    return condicoes
+
+def _ler(conn, classe, sql, parametros, fluxo, ordem):
+    """Lista de registros ou, com fluxo=True, fluxo ordenado pela chave (cursor no servidor)."""
+    if fluxo:
+        return iterar_registros(conn, classe, f"{sql}\n{ordem}", parametros)
+    return consultar_registros(conn, classe, sql, parametros)
+
+ORDEM_INTERNACOES = ordem_sql("medicalrecord", "hospitaladmissionnumber")
+ORDEM_ADMISSOES = ordem_sql("hospitaladmissionnumber", "unitcode", "bedcode", "unitadmissiondatetime",
+                            datas=("unitadmissiondatetime",))
+
+def obter_internacoes_baselocal(conn, data_referencia=None, fluxo=False, particao=None):
+    sql, parametros = _onde("""
+        SELECT hospitaladmissionnumber,
+         medicalrecord,
+         hospitaladmissiondate,
+         medicaldischargedate
+        FROM exa.internacoes""", _condicoes("hospitaladmissiondate", data_referencia, particao), ())
+    return _ler(conn, Internacao, sql, parametros, fluxo, ORDEM_INTERNACOES)
+
+def obter_internacoes_aghu(conn, data_referencia=None, fluxo=False, particao=None):
     """Obtém internações do AGHU (via view no banco Epimed), filtrando por data se informado."""
-    internacoes = []
+    condicoes = _condicoes("hospitaladmissiondate", data_referencia, particao)
+    if data_referencia:
+        condicoes.append(("medicaldischargedate is null", ()))
+    sql, parametros = _onde("""
+        SELECT 
+            medicalrecord,
+            hospitaladmissionnumber,
+            hospitaladmissiondate,
+            medicaldischargedate
+        FROM public.vw_epimed""", condicoes, ())
+    return _ler(conn, Internacao, sql, parametros, fluxo, ORDEM_INTERNACOES)
+
+def obter_altas_aghu(conn, desde):
+    """Obtém as altas registradas no AGHU (via view no banco Epimed) a partir de uma data.
+
+    Inclui as internações com alta local a partir de desde: se a alta foi
+    cancelada no AGHU, a data volta como NULL.
+    """
     with conn.cursor() as cur:
-        if data_referencia:
-            cur.execute("""
-                SELECT 
-                    medicalrecord,
-                    hospitaladmissionnumber,
-                    hospitaladmissiondate,
-                    medicaldischargedate
-                FROM public.vw_epimed
-                WHERE hospitaladmissiondate >= %s
-                AND medicaldischargedate is null;
-            """, (data_referencia,))
-        else:
-            cur.execute("""
-                SELECT 
-                    medicalrecord,
-                    hospitaladmissionnumber,
-                    hospitaladmissiondate,
-                    medicaldischargedate
-                FROM public.vw_epimed;
-            """)
-
-        for row in cur.fetchall():
-            internacoes.append({
-                "medicalrecord": row[0],
-                "hospitaladmissionnumber": row[1],
-                "hospitaladmissiondate": row[2],
-                "medicaldischargedate": row[3]
-
-            })
-    return internacoes
-
-def obter_admissoes_baselocal(conn, data_referencia=None):
-    admissoes = []
+        cur.execute("""
+            SELECT hospitaladmissionnumber,
+                   MAX(medicaldischargedate) AS medicaldischargedate
+            FROM public.vw_epimed
+            WHERE medicaldischargedate >= %s
+               OR hospitaladmissionnumber IN (
+                      SELECT hospitaladmissionnumber
+                      FROM exa.internacoes
+                      WHERE medicaldischargedate >= %s)
+            GROUP BY hospitaladmissionnumber;
+        """, (desde, desde))
+        return cur.fetchall()
+
+def obter_marca_altas(conn):
+    """Marca d'água da sincronização de altas.
+
+    Na primeira execução usa a data da internação aberta mais antiga, já que
+    nenhuma alta pendente pode ser anterior a ela.
+    """
+    marca = estado_sincronizacao.obter_data(conn, "exames.altas")
+    if marca:
+        return marca
     with conn.cursor() as cur:
-        if data_referencia:
-            cur.execute("""
-                SELECT id, hospitaladmissionnumber, unitcode, bedcode, unitadmissiondatetime
-                FROM exa.admissoes
-                WHERE unitadmissiondatetime >= %s;
-            """, (data_referencia,))
-        else:
-            cur.execute("SELECT id, hospitaladmissionnumber, unitcode, bedcode, unitadmissiondatetime FROM exa.admissoes;")
-        for row in cur.fetchall():
-            admissoes.append({
-                "id": row[0],
-                "hospitaladmissionnumber": row[1],
-                "unitcode": row[2],
-                "bedcode": row[3],
-                "unitadmissiondatetime": row[4]
-            })
-    return admissoes
-
-def obter_admissoes_aghu(conn, data_referencia=None):
-    """Obtém admissões do AGHU (via view no banco Epimed), filtrando por data."""
-    admissoes = []
+        cur.execute("""
+            SELECT MIN(hospitaladmissiondate)
+            FROM exa.internacoes
+            WHERE medicaldischargedate IS NULL;
+        """)
+        res = cur.fetchone()
+        return res[0] if res and res[0] else datetime(2025, 1, 1)
+
+def atualizar_altas(conn, altas, tamanho_lote=1000):
+    """Aplica as datas de alta em exa.internacoes com UPDATE … FROM (VALUES …) em lote."""
+    count = 0
     with conn.cursor() as cur:
-        if data_referencia:
-            cur.execute("""
-                SELECT 
-                    hospitaladmissionnumber,
-                    unitcode,
-                    bedcode,
-                    unitadmissiondatetime
-                FROM public.vw_epimed
-                WHERE unitadmissiondatetime >= %s;
-            """, (data_referencia,))
-        else:
-            cur.execute("""
-                SELECT 
-                    hospitaladmissionnumber,
-                    unitcode,
-                    bedcode,
-                    unitadmissiondatetime
-                FROM public.vw_epimed;
-            """)
-
-        for row in cur.fetchall():
-            admissoes.append({
-                "hospitaladmissionnumber": row[0],
-                "unitcode": row[1],
-                "bedcode": row[2],
-                "unitadmissiondatetime": row[3]
-            })
-    return admissoes
-
-def obter_exames_baselocal(conn, data_referencia=None):
-    exames = []
+        for inicio in range(0, len(altas), tamanho_lote):
+            execute_values(cur, """
+                UPDATE exa.internacoes AS i
+                SET medicaldischargedate = v.medicaldischargedate
+                FROM (VALUES %s) AS v (hospitaladmissionnumber, medicaldischargedate)
+                WHERE i.hospitaladmissionnumber = v.hospitaladmissionnumber
+                  AND i.medicaldischargedate IS DISTINCT FROM v.medicaldischargedate;
+            """, altas[inicio:inicio + tamanho_lote], template="(%s, %s::timestamp)", page_size=tamanho_lote)
+            count += cur.rowcount
+    return count
+
+def sincronizar_altas(conn):
+    """Propaga para exa.internacoes as altas ocorridas desde a última marca d'água.
+
+    A marca é a maior data de alta já vista; a leitura recomeça em
+    marca - JANELA_CORRECOES, como a de exames, para pegar altas lançadas
+    com atraso (data anterior à marca) e altas canceladas.
+    """
+    marca = obter_marca_altas(conn)
+    desde = marca - JANELA_CORRECOES
+    registrar_log(f"Buscando altas AGHU desde {desde} (marca {marca})…")
+    altas = obter_altas_aghu(conn, desde)
+
+    if not altas:
+        registrar_log("Nenhuma nova alta para atualizar.")
+        return 0
+
+    with conn:
+        count = atualizar_altas(conn, altas)
+        nova_marca = max([marca] + [a[1] for a in altas if a[1] is not None])
+        estado_sincronizacao.salvar_data(conn, "exames.altas", nova_marca)
+
+    registrar_log(f"Altas obtidas: {len(altas)}; internações atualizadas: {count}. Nova marca: {nova_marca}")
+    return count
+
+def obter_admissoes_baselocal(conn, data_referencia=None, fluxo=False, particao=None):
+    sql, parametros = _onde("""
+        SELECT id, hospitaladmissionnumber, unitcode, bedcode, unitadmissiondatetime
+        FROM exa.admissoes""", _condicoes("unitadmissiondatetime", data_referencia, particao), ())
+    return _ler(conn, Admissao, sql, parametros, fluxo, ORDEM_ADMISSOES)
+
+def obter_admissoes_aghu(conn, data_referencia=None, fluxo=False, particao=None):
+    """Obtém admissões do AGHU (via view no banco Epimed), filtrando por data."""
+    sql, parametros = _onde("""
+        SELECT 
+            hospitaladmissionnumber,
+            unitcode,
+            bedcode,
+            unitadmissiondatetime
+        FROM public.vw_epimed""", _condicoes("unitadmissiondatetime", data_referencia, particao), ())
+    return _ler(conn, Admissao, sql, parametros, fluxo, ORDEM_ADMISSOES)
+
+def obter_exames_baselocal(conn, data_referencia=None, fluxo=False, adm_ids=None, data_limite=None,
+                           particao=None):
+    """Exames da base local desde a data de referência (até data_limite, exclusive) e, se
+    informado, todos os das admissões adm_ids."""
+    condicoes = []
+    if data_referencia and adm_ids:
+        condicoes.append(("(dthrcoleta >= %s OR adm_id = ANY(%s))", (data_referencia, list(adm_ids))))
+    elif data_referencia:
+        condicoes.append(("dthrcoleta >= %s", (data_referencia,)))
+        if data_limite:
+            condicoes.append(("dthrcoleta < %s", (data_limite,)))
+    if particao is not None:
+        condicao, parametros_particao = particionamento.condicao("hospitaladmissionnumber", particao)
+        condicoes.append((f"adm_id IN (SELECT id FROM exa.admissoes WHERE {condicao})", parametros_particao))
+    sql, parametros = _onde("""
+        SELECT adm_id, idexame, dthrcoleta, nome_exame, valor, tipo_inf_valor,
+               result_sigla_exa, result_material_exa_cod, ind_anulacao_laudo, impressao
+        FROM exa.exames""", condicoes, ())
+    return _ler(conn, Exame, sql, parametros, fluxo,
+                ordem_sql("adm_id", "idexame", "dthrcoleta", datas=("dthrcoleta",)))
+
+# Exames do AGHU na janela da última admissão de cada internação ({filtro}:
+# condições adicionais do WHERE; {filtro_admissoes}: WHERE de exa.admissoes
+# dentro da CTE, onde o && na faixa usa o índice GiST). Usada também pela
+# reconciliação.
+SQL_EXAMES_AGHU = """
+            WITH ultima_admissao AS (
+                SELECT DISTINCT ON (hospitaladmissionnumber)
+                       id,
+                       hospitaladmissionnumber,
+                       unitcode,
+                       unitadmissiondatetime,
+                       janela_exames
+                FROM exa.admissoes{filtro_admissoes}
+                ORDER BY hospitaladmissionnumber, unitadmissiondatetime DESC
+            )
+            SELECT 
+                a.id AS adm_id,
+                a.hospitaladmissionnumber,
+                a.unitcode,
+                ve.prontuario AS medicalrecord,
+                ve.ise_soe_seq AS soe_seq,
+                ve.sigla AS idexame,
+                ve.descricao_usual AS nome_exame,
+                ve.are_valor AS valor,
+                ve.tipo_inf_valor,
+                ve.unidade,
+                ve.result_sigla_exa,
+                ve.result_material_exa_cod,
+                ve.ind_anulacao_laudo,
+                ve.dthr_programada AS dthrcoleta,
+                ve.dthr_liberacao,
+                exa.fn_impressao_exame(ve.are_valor::text, ve.tipo_inf_valor::text,
+                                       ve.result_sigla_exa::text, ve.ind_anulacao_laudo::text) AS impressao
+            FROM exa.internacoes i
+            JOIN ultima_admissao a 
+                ON a.hospitaladmissionnumber = i.hospitaladmissionnumber
+            JOIN exa.vw_exames ve 
+                ON ve.prontuario = i.prontuario
+               AND ve.dthr_programada >= lower(a.janela_exames)
+               AND ve.dthr_programada <= upper(a.janela_exames)
+               AND ve.dthr_programada <@ a.janela_exames
+            LEFT JOIN exa.janelas_exame jp
+                ON jp.sigla = '*'
+            LEFT JOIN exa.janelas_exame j
+                ON j.sigla = ve.sigla
+            WHERE ve.dthr_programada
+                  BETWEEN a.unitadmissiondatetime - COALESCE(j.antes, jp.antes, INTERVAL '4 hours')
+                      AND a.unitadmissiondatetime + COALESCE(j.depois, jp.depois, INTERVAL '24 hours'){filtro}"""
+
+def obter_exames_aghu(conn, data_referencia=None, adm_ids=None, fluxo=False, data_limite=None, particao=None):
+    """Obtém exames dentro da janela (exa.janelas_exame) da última admissão de cada internação.
+
+    A faixa pré-calculada em exa.admissoes.janela_exames e a chave tipada
+    exa.internacoes.prontuario permitem que o JOIN com exa.vw_exames seja
+    uma busca por faixa no índice (prontuario, dthr_programada).
+    Se adm_ids for informado, busca apenas os exames dessas admissões, sem
+    filtro de data (usado para admissões criadas na própria execução).
+    data_limite (exclusive) fecha o período, para cargas históricas em blocos.
+    Laudos anulados também são retornados, para detecção de anulações.
+    """
+
+    filtro = filtro_admissoes = ""
+    parametros = ()
+    if adm_ids is not None:
+        filtro = """
+              AND a.id = ANY(%s)"""
+        parametros = (list(adm_ids),)
+    elif data_referencia:
+        # Só admissões cuja janela alcança a referência; todas as janelas têm
+        # a mesma duração, então a última admissão da internação está entre elas.
+        # Internações com alta anterior à referência saem do conjunto ativo
+        filtro_admissoes = """
+                WHERE janela_exames && tsrange(%s, NULL)"""
+        filtro = """
+              AND (i.medicaldischargedate IS NULL OR i.medicaldischargedate >= %s)
+              AND ve.dthr_programada >= %s"""
+        parametros = (data_referencia, data_referencia, data_referencia)
+        if data_limite:
+            filtro += """
+              AND ve.dthr_programada < %s"""
+            parametros += (data_limite,)
+    if particao is not None:
+        condicao, parametros_particao = particionamento.condicao("a.hospitaladmissionnumber", particao)
+        filtro += f"""
+              AND {condicao}"""
+        parametros += parametros_particao
+
+    sql = SQL_EXAMES_AGHU.format(filtro=filtro, filtro_admissoes=filtro_admissoes)
+
+    if fluxo:
+        # Ordem da chave (adm_id, idexame, dthrcoleta) para o merge em diff_ordenado
+        return iterar_registros(conn, Exame, sql + "\n            " + ordem_sql(
+            "a.id", "ve.sigla", "ve.dthr_programada", datas=("ve.dthr_programada",)), parametros)
+    return consultar_registros(conn, Exame, sql + "\n            ORDER BY ve.dthr_programada", parametros)
+
+def obter_pendencias_reconciliacao(conn, particao=None):
+    """adm_ids com exames pendentes apontados pela reconciliação (reconciliar.py)."""
+    filtro, parametros = "", None
+    if particao is not None:
+        condicao, parametros = particionamento.condicao("hospitaladmissionnumber", particao)
+        filtro = f"\n              AND adm_id IN (SELECT id FROM exa.admissoes WHERE {condicao})"
     with conn.cursor() as cur:
-        if data_referencia:
-            cur.execute("""
-                SELECT adm_id, idexame, dthrcoleta, nome_exame, valor, tipo_inf_valor,
-                       result_sigla_exa, result_material_exa_cod, ind_anulacao_laudo
-                FROM exa.exames
-                WHERE dthrcoleta >= %s;
-            """, (data_referencia,))
-        else:
-            cur.execute("""
-                SELECT adm_id, idexame, dthrcoleta, nome_exame, valor, tipo_inf_valor,
-                       result_sigla_exa, result_material_exa_cod, ind_anulacao_laudo
-                FROM exa.exames;
-            """)
-        for row in cur.fetchall():
-            exames.append({
-                "adm_id": row[0],
-                "idexame": row[1],
-                "dthrcoleta": row[2],
-                "nome_exame": row[3],
-                "valor": row[4],
-                "tipo_inf_valor": row[5],
-                "result_sigla_exa": row[6],
-                "result_material_exa_cod": row[7],
-                "ind_anulacao_laudo": row[8]
-            })
-    return exames
-
-def obter_exames_aghu(conn, data_referencia=None):
-    """Obtém exames dentro do intervalo de ±4h da última admissão de cada internação."""
-
-    exames = []
+        cur.execute(f"""
+            SELECT DISTINCT adm_id
+            FROM exa.reconciliacao_pendencias
+            WHERE entidade = 'exames' AND processado_em IS NULL AND adm_id IS NOT NULL{filtro}
+        """, parametros)
+        return [row[0] for row in cur.fetchall()]
+
+def concluir_pendencias_reconciliacao(conn, adm_ids):
     with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE exa.reconciliacao_pendencias
+            SET processado_em = NOW()
+            WHERE entidade = 'exames' AND processado_em IS NULL AND adm_id = ANY(%s)
+        """, (list(adm_ids),))
+    conn.commit()
 
-        if data_referencia:
-            cur.execute("""
-                WITH ultima_admissao AS (
-                    SELECT DISTINCT ON (hospitaladmissionnumber)
-                           id,
-                           hospitaladmissionnumber,
-                           unitcode,
-                           unitadmissiondatetime
-                    FROM exa.admissoes
-                    ORDER BY hospitaladmissionnumber, unitadmissiondatetime DESC
-                )
-                SELECT 
-                    a.id AS adm_id,
-                    a.hospitaladmissionnumber,
-                    ve.prontuario,
-                    ve.ise_soe_seq AS soe_seq,
-                    ve.sigla AS idexame,
-                    ve.descricao_usual AS nome_exame,
-                    ve.are_valor AS valor,
-                    ve.tipo_inf_valor,
-                    ve.unidade,
-                    ve.result_sigla_exa,
-                    ve.result_material_exa_cod,
-                    ve.ind_anulacao_laudo,
-                    ve.dthr_programada,
-                    ve.dthr_liberacao
-                FROM exa.internacoes i
-                JOIN ultima_admissao a 
-                    ON a.hospitaladmissionnumber = i.hospitaladmissionnumber
-                JOIN exa.vw_exames ve 
-                    ON ve.prontuario = i.medicalrecord
-                   AND ve.dthr_programada BETWEEN a.unitadmissiondatetime - INTERVAL '4 hours'
-                                       AND a.unitadmissiondatetime + INTERVAL '24 hours'
-                WHERE ve.ind_anulacao_laudo <> 'S'
-                  AND ve.dthr_programada >= %s
-                ORDER BY ve.dthr_programada;
-            """, (data_referencia,))
-        
-        else:
-            cur.execute("""
-                WITH ultima_admissao AS (
-                    SELECT DISTINCT ON (hospitaladmissionnumber)
-                           id,
-                           hospitaladmissionnumber,
-                           unitcode,
-                           unitadmissiondatetime
-                    FROM exa.admissoes
-                    ORDER BY hospitaladmissionnumber, unitadmissiondatetime DESC
-                )
-                SELECT 
-                    a.id AS adm_id,
-                    a.hospitaladmissionnumber,
-                    ve.prontuario,
-                    ve.ise_soe_seq AS soe_seq,
-                    ve.sigla AS idexame,
-                    ve.descricao_usual AS nome_exame,
-                    ve.are_valor AS valor,
-                    ve.tipo_inf_valor,
-                    ve.unidade,
-                    ve.result_sigla_exa,
-                    ve.result_material_exa_cod,
-                    ve.ind_anulacao_laudo,
-                    ve.dthr_programada,
-                    ve.dthr_liberacao
-                FROM exa.internacoes i
-                JOIN ultima_admissao a 
-                    ON a.hospitaladmissionnumber = i.hospitaladmissionnumber
-                JOIN exa.vw_exames ve 
-                    ON ve.prontuario::varchar = i.medicalrecord
-                   AND ve.dthr_programada BETWEEN a.unitadmissiondatetime - INTERVAL '4 hours'
-                                       AND a.unitadmissiondatetime + INTERVAL '3 hours'
-                WHERE ve.ind_anulacao_laudo <> 'S'
-                ORDER BY ve.dthr_programada;
-            """)
-
-        for row in cur.fetchall():
-            exames.append({
-                "adm_id": row[0],
-                "hospitaladmissionnumber": row[1],
-                "medicalrecord": row[2],
-                "soe_seq": row[3],
-                "idexame": row[4],
-                "nome_exame": row[5],
-                "valor": row[6],
-                "tipo_inf_valor": row[7],
-                "unidade": row[8],
-                "result_sigla_exa": row[9],
-                "result_material_exa_cod": row[10],
-                "ind_anulacao_laudo": row[11],
-                "dthrcoleta": row[12]
-            })
-
-    return exames
-
-def gerar_mensagem_hl7(exame):
-    """Gera mensagem HL7 simulada"""
+LEITORES_INDICE = {
+    "internacoes": obter_internacoes_baselocal,
+    "admissoes": obter_admissoes_baselocal,
+    "exames": obter_exames_baselocal,
+}
+
+def abrir_indices(conn):
+    """Abre os índices de chaves locais, construindo a partir das tabelas os que ainda não existem."""
+    indices = {}
+    for entidade, leitor in LEITORES_INDICE.items():
+        caminho = indice_chaves.caminho_indice(entidade)
+        if not os.path.exists(caminho):
+            registrar_log(f"Índice {caminho} inexistente; construindo a partir da base local…")
+        indices[entidade] = indice_chaves.abrir(caminho, lambda leitor=leitor: leitor(conn, fluxo=True))
+    conn.commit()
+    return indices
+
+# OBX-2 (tipo do valor) pelo tipo_inf_valor do AGHU; os demais tipos vão como texto
+TIPOS_VALOR_OBX = {"N": "NM"}
+
+def tipo_valor_obx(exame):
+    return TIPOS_VALOR_OBX.get((exame.tipo_inf_valor or "").strip().upper(), "ST")
+
+def gerar_mensagem_hl7(exame, controle_msh10=None, status_resultado="F"):
+    """Gera mensagem HL7 simulada (OBX-11: F = final, C = correção, D = exclusão)"""
     #return f"HL7|{exame['medicalrecord']}|{exame['idexame']}|{exame['dthrexame']}"
 
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
 
-    msh = f"MSH|^~&|HUAP||EPIMED||{timestamp}||ORU^R01|20190409220503_ORU_65870_95936689|P|2.5|||||BR|ASCII"
-    pid = f"PID|1|{exame['medicalrecord']}|1235||^Integração HL7 Brasil||19910408000000|M|"
-    pv1 = f"PV1|1||||||||||||||||||{exame['hospitaladmissionnumber']}||||||||||||||||||||||||||"
-    orc = f"ORC|1|{exame['soe_seq']}|||||||||||||||||"
+    if not controle_msh10:
+        controle_msh10 = idempotencia_hl7.gerar_controle_msh10()
+
+    msh = f"MSH|^~&|HUAP||EPIMED||{timestamp}||ORU^R01|{controle_msh10}|P|2.5|||||BR|ASCII"
+    pid = f"PID|1|{exame.medicalrecord}|1235||^Integração HL7 Brasil||19910408000000|M|"
+    pv1 = f"PV1|1||||||||||||||||||{exame.hospitaladmissionnumber}||||||||||||||||||||||||||"
+    orc = f"ORC|1|{exame.soe_seq}|||||||||||||||||"
     obr = f"OBR|1|||||||||||||||||||||||||||"
-    obx = f"OBX|1|NM|{exame['idexame']}^{exame['nome_exame']}||{exame['tipo_inf_valor']}|{exame['unidade']}||||||||{exame['dthrcoleta']}"
+    obx = f"OBX|1|{tipo_valor_obx(exame)}|{exame.idexame}^{exame.nome_exame}||{exame.valor}|{exame.unidade}|||||{status_resultado}|||{exame.dthrcoleta}"
 
     return f"{msh}\n{pid}\n{pv1}\n{obr}\n{obx}"
 
@@ -396,6 +485,54 @@ def enviar_mensagem_hl7(mensagem):
     print(f"Enviando HL7: {mensagem}")
     return "AA"  # sucesso simulado
 
+def enviar_exame_hl7(conn, exame, status_resultado="F", limitador=None):
+    """Gera e envia a mensagem HL7 do exame, consultando o registro de idempotência.
+
+    Retorna o código do ACK ("AA" também quando o mesmo conteúdo já havia sido aceito).
+    """
+    chave = idempotencia_hl7.chave_exame(exame.adm_id, exame.idexame, exame.dthrcoleta)
+    hash_atual = idempotencia_hl7.hash_payload(
+        exame.medicalrecord, exame.hospitaladmissionnumber, exame.soe_seq,
+        exame.idexame, exame.nome_exame, exame.valor, exame.tipo_inf_valor,
+        exame.unidade, exame.dthrcoleta, exame.impressao, status_resultado
+    )
+
+    if quarentena_hl7.em_quarentena(conn, "exame", chave, hash_atual):
+        registrar_log(f"Exame {chave} em quarentena (rejeitado anteriormente com o mesmo conteúdo), envio suprimido.", nivel="warning")
+        return quarentena_hl7.EM_QUARENTENA
+
+    decisao, controle_msh10 = idempotencia_hl7.preparar_envio(conn, "exame", chave, hash_atual)
+
+    if decisao == idempotencia_hl7.IGNORAR:
+        registrar_log(f"Exame {chave}: conteúdo já aceito pelo Epimed (MSH-10 {controle_msh10}), envio ignorado.", nivel="warning")
+        return "AA"
+
+    if decisao == idempotencia_hl7.REENVIAR:
+        registrar_log(f"Exame {chave}: reenviando conteúdo sem confirmação com o MSH-10 {controle_msh10}.", nivel="warning")
+
+    registrar_log(f"Gerando HL7 para exame {exame.idexame}…")
+    mensagem = gerar_mensagem_hl7(exame, controle_msh10, status_resultado)
+
+    if limitador is not None:
+        limitador()
+
+    gravador_log = log_envio.gravador(TABELA_LOG_ENVIO)
+    log_id = gravador_log.reservar_id()
+    gravador_log.registrar_envio(log_id, chave, mensagem, exame.idexame)
+
+    registrar_log("Enviando HL7…")
+    ack = enviar_mensagem_hl7(mensagem)
+    gravador_log.registrar_resposta(log_id, ack)
+
+    if ack == "AA":
+        idempotencia_hl7.registrar_aceite(conn, "exame", chave, controle_msh10)
+        quarentena_hl7.remover_quarentena(conn, "exame", chave)
+    elif ack in quarentena_hl7.CODIGOS_REJEICAO:
+        quarentena_hl7.registrar_rejeicao(conn, "exame", chave, hash_atual, ack)
+        registrar_log(f"Exame {chave} colocado em quarentena (ACK {ack}).", nivel="warning")
+
+    return ack
+
 def inserir_internacoes(conn, internacoes):
     if not internacoes:
         registrar_log("Nenhuma nova internação para inserir.")
@@ -412,217 +549,514 @@ def inserir_internacoes(conn, internacoes):
                     criado_em
                 ) VALUES (%s, %s, %s, %s, NOW())
                 ON CONFLICT (hospitaladmissionnumber) DO NOTHING;
-            """, (i["hospitaladmissionnumber"], i["medicalrecord"], i["hospitaladmissiondate"], i["medicaldischargedate"]))
+            """, (i.hospitaladmissionnumber, i.medicalrecord, i.hospitaladmissiondate, i.medicaldischargedate))
+            count += cur.rowcount
         conn.commit()
-        count += 1
         
     return count
 
 def inserir_admissoes(conn, admissoes):
+    """Insere as admissões e retorna os ids efetivamente criados."""
     if not admissoes:
         registrar_log("Nenhuma nova admissão para inserir.")
-        return 0
-    count = 0
+        return []
+    adm_ids = []
     for a in admissoes:
         with conn.cursor() as cur:
             cur.execute("""
                 INSERT INTO exa.admissoes (
                     hospitaladmissionnumber, unitcode, bedcode, unitadmissiondatetime, criado_em
                 ) VALUES (%s, %s, %s, %s, NOW())
-                ON CONFLICT (hospitaladmissionnumber, unitcode, bedcode, unitadmissiondatetime) DO NOTHING;
-            """, (a["hospitaladmissionnumber"], a["unitcode"], a["bedcode"], a["unitadmissiondatetime"]))
+                ON CONFLICT (hospitaladmissionnumber, unitcode, bedcode, unitadmissiondatetime) DO NOTHING
+                RETURNING id;
+            """, (a.hospitaladmissionnumber, a.unitcode, a.bedcode, a.unitadmissiondatetime))
+            row = cur.fetchone()
+            if row:
+                adm_ids.append(row[0])
         conn.commit()
-        count += 1
        
-    return count
+    return adm_ids
 
 def inserir_exame(conn, exame):
     with conn.cursor() as cur:
         cur.execute("""
             INSERT INTO exa.exames (
                 adm_id, medicalrecord, idexame, dthrcoleta, nome_exame, valor, tipo_inf_valor,
-                result_sigla_exa, result_material_exa_cod, ind_anulacao_laudo, criado_em
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
+                result_sigla_exa, result_material_exa_cod, ind_anulacao_laudo, impressao, criado_em
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
             ON CONFLICT (adm_id, idexame, dthrcoleta) DO NOTHING;
-        """, (exame["adm_id"], exame["medicalrecord"], exame["idexame"], exame["dthrcoleta"], exame["nome_exame"],
-                exame["valor"], exame["tipo_inf_valor"], exame["result_sigla_exa"],
-                exame["result_material_exa_cod"], exame["ind_anulacao_laudo"]))
+        """, (exame.adm_id, exame.medicalrecord, exame.idexame, exame.dthrcoleta, exame.nome_exame,
+                exame.valor, exame.tipo_inf_valor, exame.result_sigla_exa,
+                exame.result_material_exa_cod, exame.ind_anulacao_laudo, exame.impressao))
     conn.commit()
     return True
 
-# =====================================================================
-# ROTINA PRINCIPAL
-# =====================================================================
-def verificar_e_enviar_exames():
-    registrar_log("INICIANDO ROTINA DE VERIFICAÇÃO DE INTERNAÇÕES, ADMISSÕES E EXAMES.")
+def atualizar_exame(conn, exame):
+    """Grava na base local o resultado corrigido/anulado já aceito pelo Epimed."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE exa.exames
+            SET valor = %s, tipo_inf_valor = %s, result_sigla_exa = %s,
+                ind_anulacao_laudo = %s, impressao = %s
+            WHERE adm_id = %s AND idexame = %s AND dthrcoleta = %s;
+        """, (exame.valor, exame.tipo_inf_valor, exame.result_sigla_exa,
+                exame.ind_anulacao_laudo, exame.impressao,
+                exame.adm_id, exame.idexame, exame.dthrcoleta))
+    conn.commit()
+    return True
 
-    inicio_total = datetime.now()
-    conn_epimed = conectar_db(EPIMED_DB_CONFIG)
-    conn_aghu = conectar_db(AGHU_DB_CONFIG)
+def enviar_exames(conn, novos_exames, exames_corrigidos, exames_anulados, limitador=None):
+    """Envia novos exames, correções (OBX-11 = C) e anulações (OBX-11 = D), gravando os aceitos.
 
-    qnt_internacoes = 0
-    qnt_admissoes = 0
+    Retorna (exames inseridos, envios pendentes, exames gravados na base local).
+    limitador, se informado, é chamado antes de cada envio efetivo (limite de taxa).
+    """
     qnt_exames = 0
-    status_execucao = 'SUCESSO'
-    mensagem_execucao = None
+    qnt_pendentes = 0
+    # Exames gravados na base local (cada gravação já faz commit)
+    exames_gravados = []
 
-    # === CONTROLE DE PROCESSAMENTO ===
-    registrar_log("Iniciando rotina de sincronização…")
+    with conn:
 
-    ultima_data = obter_data_ultimo_processamento(conn_epimed)
-    registrar_log(f"Último processamento bem-sucedido em: {ultima_data}")
+        if novos_exames:
+            registrar_log(f"Processando {len(novos_exames)} novos exames…")
 
-    id_proc = registrar_inicio_processamento(conn_epimed)
-    data_inicio = datetime.now()
-    registrar_log(f"Novo processamento iniciado às: {data_inicio}")
+            for e in novos_exames:
+                try:
+                    ack = enviar_exame_hl7(conn, e, limitador=limitador)
 
-    try:
-        # === ETAPA 1: COLETA DE DADOS ===
-        registrar_log("=== ETAPA 1 — COLETA DE DADOS ===")
-        registrar_log(f"Obtendo dados atualizados desde {ultima_data}")
+                    if ack == "AA":
+                        registrar_log(f"ACK=AA recebido. Inserindo exame {e.idexame}…")
+                        inserir_exame(conn, e)
+                        exames_gravados.append(e)
+                        qnt_exames += 1
+
+                    elif ack == quarentena_hl7.EM_QUARENTENA:
+                        pass
 
-        registrar_log("Buscando internações Epimed…")
-        internacoes_epimed = obter_internacoes_baselocal(conn_epimed, ultima_data)
-        registrar_log(f"Internações Epimed obtidas: {len(internacoes_epimed)}")
+                    else:
+                        qnt_pendentes += 1
+                        registrar_log(
+                            f"Exame {e.idexame} rejeitado (ACK={ack}).",
+                            nivel="error"
+                        )
 
-        registrar_log("Buscando internações AGHU…")
-        internacoes_aghu = obter_internacoes_aghu(conn_epimed, ultima_data)
-        registrar_log(f"Internações AGHU obtidas: {len(internacoes_aghu)}")
+                except Exception as erro:
+                    registrar_log(
+                        f"Erro ao processar exame {e.idexame}: {erro}",
+                        nivel="error"
+                    )
+                    raise
 
-        registrar_log("Buscando admissões Epimed…")
-        admissoes_epimed = obter_admissoes_baselocal(conn_epimed, ultima_data)
-        registrar_log(f"Admissões Epimed obtidas: {len(admissoes_epimed)}")
+            registrar_log("Todos os exames processados.")
+        else:
+            registrar_log("Nenhum novo exame para inserir.")
+
+        # --- CORREÇÕES (OBX-11 = C) E ANULAÇÕES (OBX-11 = D) ---
+        for lista, status_resultado, descricao in (
+            (exames_corrigidos, "C", "correção"),
+            (exames_anulados, "D", "exclusão"),
+        ):
+            for e in lista:
+                try:
+                    ack = enviar_exame_hl7(conn, e, status_resultado, limitador)
+
+                    if ack == "AA":
+                        registrar_log(f"ACK=AA recebido para {descricao} do exame {e.idexame}. Atualizando base local…")
+                        atualizar_exame(conn, e)
+                        exames_gravados.append(e)
+
+                    elif ack != quarentena_hl7.EM_QUARENTENA:
+                        qnt_pendentes += 1
+                        registrar_log(
+                            f"{descricao.capitalize()} do exame {e.idexame} rejeitada (ACK={ack}).",
+                            nivel="error"
+                        )
 
-        registrar_log("Buscando admissões AGHU…")
-        admissoes_aghu = obter_admissoes_aghu(conn_epimed, ultima_data)
-        registrar_log(f"Admissões AGHU obtidas: {len(admissoes_aghu)}")
+                except Exception as erro:
+                    registrar_log(
+                        f"Erro ao enviar {descricao} do exame {e.idexame}: {erro}",
+                        nivel="error"
+                    )
+                    raise
+
+    return qnt_exames, qnt_pendentes, exames_gravados
+
+def _origem_por_chave(exames_aghu):
+    """Um exame por chave; quando a origem repete a chave, prevalece o laudo não anulado."""
+    origem_por_chave = {}
+    for e in exames_aghu:
+        atual = origem_por_chave.get(e.chave)
+        if atual is None or (atual.ind_anulacao_laudo == "S" and e.ind_anulacao_laudo != "S"):
+            origem_por_chave[e.chave] = e
+    return origem_por_chave
+
+def classificar_exames(exames_aghu, exames_epimed):
+    """Compara origem e base local pela chave e pela impressão digital.
+
+    Retorna (novos, corrigidos, anulados). Quando a origem tem mais de uma
+    linha para a mesma chave, prevalece o laudo não anulado.
+    """
+    exames_epimed_por_chave = {e.chave: e for e in exames_epimed}
+
+    novos, corrigidos, anulados = [], [], []
+    for chave, e in _origem_por_chave(exames_aghu).items():
+        local = exames_epimed_por_chave.get(chave)
+        if local is None:
+            if e.ind_anulacao_laudo != "S":
+                novos.append(e)
+        elif local.impressao != e.impressao:
+            if e.ind_anulacao_laudo == "S":
+                anulados.append(e)
+            else:
+                corrigidos.append(e)
+
+    return novos, corrigidos, anulados
+
+def _prevalece_nao_anulado(exames):
+    return next((e for e in exames if e.ind_anulacao_laudo != "S"), exames[0])
+
+def classificar_exames_ordenado(exames_aghu, exames_epimed, contagem=None):
+    """Mesmo resultado de classificar_exames, por merge de fluxos ordenados pela chave."""
+    novos, corrigidos, anulados = [], [], []
+    for acao, e, _ in diff_ordenado(
+        exames_aghu, exames_epimed,
+        alterado=lambda origem, local: origem.impressao != local.impressao,
+        escolher=_prevalece_nao_anulado,
+        contagem=contagem,
+    ):
+        if acao == INSERIR:
+            if e.ind_anulacao_laudo != "S":
+                novos.append(e)
+        elif acao == ALTERAR:
+            (anulados if e.ind_anulacao_laudo == "S" else corrigidos).append(e)
+
+    return novos, corrigidos, anulados
+
+def classificar_exames_indice(exames_aghu, indice):
+    """Mesmo resultado de classificar_exames, consultando o índice local no lugar de exa.exames."""
+    novos, corrigidos, anulados = [], [], []
+    for e in _origem_por_chave(exames_aghu).values():
+        if not indice.contem(e):
+            if e.ind_anulacao_laudo != "S":
+                novos.append(e)
+        elif indice.alterado(e):
+            (anulados if e.ind_anulacao_laudo == "S" else corrigidos).append(e)
+
+    return novos, corrigidos, anulados
+
+def detectar_novos(conn, obter_aghu, obter_epimed, data_referencia, descricao, indice=None, particao=None):
+    """Registros do AGHU cuja chave não existe na base local (motor conforme MOTOR_DIFF)."""
+    if indice is not None:
+        aghu = obter_aghu(conn, data_referencia, particao=particao)
+        registrar_log(f"{descricao} AGHU obtidas: {len(aghu)} (base local pelo índice, {len(indice)} chaves)")
+        return [r for r in aghu if not indice.contem(r)]
+
+    if MOTOR_DIFF == "ordenado":
+        contagem = {}
+        try:
+            novos = [
+                r for acao, r, _ in diff_ordenado(
+                    obter_aghu(conn, data_referencia, fluxo=True, particao=particao),
+                    obter_epimed(conn, data_referencia, fluxo=True, particao=particao),
+                    contagem=contagem,
+                )
+                if acao == INSERIR
+            ]
+            registrar_log(
+                f"{descricao} comparadas em fluxo ordenado: AGHU {contagem.get('origem', 0)}, "
+                f"Epimed {contagem.get('destino', 0)}"
+            )
+            return novos
+        except ErroOrdenacao as erro:
+            registrar_log(f"{erro}; usando comparação por conjuntos.", nivel="warning")
+
+    locais = obter_epimed(conn, data_referencia, particao=particao)
+    registrar_log(f"{descricao} Epimed obtidas: {len(locais)}")
+    aghu = obter_aghu(conn, data_referencia, particao=particao)
+    registrar_log(f"{descricao} AGHU obtidas: {len(aghu)}")
+
+    chaves_locais = {r.chave for r in locais}
+    return [r for r in aghu if r.chave not in chaves_locais]
+
+def detectar_exames(conn, data_referencia, novos_adm_ids, indice=None, particao=None):
+    """Retorna (novos, corrigidos, anulados) comparando exames do AGHU com a base local.
+
+    Admissões criadas nesta execução podem ter exames anteriores à data de
+    referência (janela antes da admissão): seus exames entram pela busca por
+    adm_id, assim como os das admissões apontadas pela reconciliação.
+    Os dois lados são lidos desde data_referencia - JANELA_CORRECOES, para
+    que um resultado corrigido ou laudo anulado depois da marca d'água
+    ainda seja comparado.
+    """
+    if data_referencia:
+        data_referencia = data_referencia - JANELA_CORRECOES
+    if MOTOR_DIFF == "ordenado":
+        contagem = {}
+        try:
+            exames_aghu = obter_exames_aghu(conn, data_referencia, fluxo=True, particao=particao)
+            if novos_adm_ids:
+                exames_aghu = mesclar(exames_aghu, obter_exames_aghu(conn, adm_ids=novos_adm_ids, fluxo=True))
+            resultado = classificar_exames_ordenado(
+                exames_aghu, obter_exames_baselocal(conn, data_referencia, fluxo=True, adm_ids=novos_adm_ids,
+                                       particao=particao),
+                contagem
+            )
+            registrar_log(
+                f"Exames comparados em fluxo ordenado: AGHU {contagem.get('origem', 0)}, "
+                f"Epimed {contagem.get('destino', 0)}"
+            )
+            return resultado
+        except ErroOrdenacao as erro:
+            registrar_log(f"{erro}; usando comparação por conjuntos.", nivel="warning")
 
+    exames_epimed = []
+    if indice is None:
         registrar_log("Buscando exames Epimed…")
-        exames_epimed = obter_exames_baselocal(conn_epimed, ultima_data)
+        exames_epimed = obter_exames_baselocal(conn, data_referencia, adm_ids=novos_adm_ids, particao=particao)
         registrar_log(f"Exames Epimed obtidos: {len(exames_epimed)}")
 
-        registrar_log("Buscando exames AGHU…")
-        exames_aghu = obter_exames_aghu(conn_epimed, ultima_data)
-        registrar_log(f"Exames AGHU obtidos: {len(exames_aghu)}")
+    registrar_log("Buscando exames AGHU…")
+    exames_aghu = obter_exames_aghu(conn, data_referencia, particao=particao)
+    registrar_log(f"Exames AGHU obtidos: {len(exames_aghu)}")
 
-        # === ETAPA 2: INTERNACOES NOVAS ===
-        registrar_log("=== ETAPA 2 — INTERNACOES NOVAS ===")
+    if novos_adm_ids:
+        registrar_log(f"Buscando exames AGHU das {len(novos_adm_ids)} admissões criadas nesta execução…")
+        exames_novas_admissoes = obter_exames_aghu(conn, adm_ids=novos_adm_ids)
+        registrar_log(f"Exames AGHU das novas admissões obtidos: {len(exames_novas_admissoes)}")
 
-        chaves_internacoes_epimed = {
-            (i["medicalrecord"], i["hospitaladmissionnumber"])
-            for i in internacoes_epimed
-        }
+        exames_aghu.extend(exames_novas_admissoes)
 
-        novas_internacoes = [
-            i for i in internacoes_aghu
-            if (i["medicalrecord"], i["hospitaladmissionnumber"])
-            not in chaves_internacoes_epimed
-        ]
+    if indice is not None:
+        return classificar_exames_indice(exames_aghu, indice)
 
-        registrar_log(
-            f"Novas internações detectadas: {len(novas_internacoes)}"
-        )
+    if MOTOR_DIFF == "numpy":
+        try:
+            from diff_colunar import classificar_exames_colunar
+        except ImportError:
+            registrar_log("NumPy indisponível; usando comparação por conjuntos.", nivel="warning")
+        else:
+            return classificar_exames_colunar(exames_aghu, exames_epimed)
 
-        # === ETAPA 3: ADMISSOES NOVAS ===
-        registrar_log("=== ETAPA 3 — ADMISSÕES NOVAS ===")
-
-        chaves_admissoes_epimed = {
-            (
-                a["hospitaladmissionnumber"],
-                a["unitcode"],
-                a["bedcode"],
-                a["unitadmissiondatetime"].replace(tzinfo=None, microsecond=0)
-            )
-            for a in admissoes_epimed
-        }
-
-        novas_admissoes = [
-            a for a in admissoes_aghu
-            if (
-                a["hospitaladmissionnumber"],
-                a["unitcode"],
-                a["bedcode"],
-                a["unitadmissiondatetime"].replace(tzinfo=None, microsecond=0)
-            ) not in chaves_admissoes_epimed
-        ]
+    return classificar_exames(exames_aghu, exames_epimed)
 
-        registrar_log(
-            f"Novas admissões detectadas: {len(novas_admissoes)}"
+# =====================================================================
+# ROTINA PRINCIPAL
+# =====================================================================
+def executar_etapas(conn_epimed, ultima_data, contagem, indices=None, particao=None):
+    """Etapas 1 a 6 (para uma partição, se informada), acumulando as quantidades em contagem.
+
+    As quantidades são gravadas em contagem à medida que cada etapa termina,
+    para que a auditoria registre o que foi feito mesmo em caso de erro.
+    """
+    indices = indices or {}
+    rotulo = f" [partição {particao[0] + 1}/{particao[1]}]" if particao else ""
+
+    # === ETAPA 1: COLETA DE DADOS ===
+    # A coleta é feita junto com a comparação de cada etapa (em fluxo,
+    # no motor "ordenado"; em listas, no motor "conjunto")
+    registrar_log(f"=== ETAPA 1 — COLETA DE DADOS ==={rotulo}")
+    registrar_log(f"Obtendo dados atualizados desde {ultima_data} (motor de comparação: {MOTOR_DIFF})")
+
+    # === ETAPA 2: INTERNACOES NOVAS ===
+    registrar_log(f"=== ETAPA 2 — INTERNACOES NOVAS ==={rotulo}")
+
+    # Leitura anterior às gravações desta execução: conexão somente leitura
+    conn_leitura = banco.obter(somente_leitura=True)
+    try:
+        novas_internacoes = detectar_novos(
+            conn_leitura, obter_internacoes_aghu, obter_internacoes_baselocal, ultima_data, "Internações",
+            indices.get("internacoes"), particao
         )
 
-        # === ETAPA 4: EXAMES NOVOS ===
-        registrar_log("=== ETAPA 4 — EXAMES NOVOS ===")
-
-        chaves_exames_epimed = {
-            (e["adm_id"], e["idexame"], e["dthrcoleta"].replace(tzinfo=None, microsecond=0))
-            for e in exames_epimed
-        }
-
-        novos_exames = [
-            e for e in exames_aghu
-            if (e["adm_id"], e["idexame"], e["dthrcoleta"].replace(tzinfo=None, microsecond=0))
-            not in chaves_exames_epimed
-        ]
-
         registrar_log(
-            f"Novos exames detectados: {len(novos_exames)}"
+            f"Novas internações detectadas: {len(novas_internacoes)}"
         )
 
-        # === ETAPA 5: INSERÇÕES ===
-        registrar_log("=== ETAPA 5 — INSERÇÕES ===")
+        # === ETAPA 3: ADMISSOES NOVAS ===
+        registrar_log(f"=== ETAPA 3 — ADMISSÕES NOVAS ==={rotulo}")
 
-        with conn_epimed:
+        novas_admissoes = detectar_novos(
+            conn_leitura, obter_admissoes_aghu, obter_admissoes_baselocal, ultima_data, "Admissões",
+            indices.get("admissoes"), particao
+        )
+    finally:
+        banco.devolver(conn_leitura)
+
+    registrar_log(
+        f"Novas admissões detectadas: {len(novas_admissoes)}"
+    )
+
+    # === ETAPA 4: INSERÇÃO DE INTERNAÇÕES E ADMISSÕES ===
+    # Precisa ocorrer antes da busca de exames, que faz JOIN com exa.admissoes
+    registrar_log(f"=== ETAPA 4 — INSERÇÃO DE INTERNAÇÕES E ADMISSÕES ==={rotulo}")
+
+    novos_adm_ids = []
+    with conn_epimed:
+
+        # --- INTERNACOES ---
+        if novas_internacoes:
+            registrar_log(f"Inserindo {len(novas_internacoes)} novas internações…")
+            contagem["internacoes"] += inserir_internacoes(conn_epimed, novas_internacoes)
+            if indices:
+                indices["internacoes"].acrescentar(novas_internacoes)
+            registrar_log(f"Internações inseridas com sucesso: {contagem['internacoes']}.")
+        else:
+            registrar_log("Nenhuma nova internação para inserir.")
+
+        # --- ADMISSOES ---
+        if novas_admissoes:
+            registrar_log(f"Inserindo {len(novas_admissoes)} novas admissões…")
+            novos_adm_ids = inserir_admissoes(conn_epimed, novas_admissoes)
+            if indices:
+                indices["admissoes"].acrescentar(novas_admissoes)
+            contagem["admissoes"] += len(novos_adm_ids)
+            registrar_log(f"Admissões inseridas com sucesso: {len(novos_adm_ids)}.")
+        else:
+            registrar_log("Nenhuma nova admissão para inserir.")
+
+    # --- ALTAS ---
+    # Na execução particionada, o coordenador sincroniza as altas uma única vez
+    if particao is None:
+        sincronizar_altas(conn_epimed)
+
+    # === ETAPA 5: EXAMES NOVOS ===
+    # Na conexão de escrita: a busca faz JOIN com as admissões gravadas na etapa 4
+    registrar_log(f"=== ETAPA 5 — EXAMES NOVOS ==={rotulo}")
+
+    adm_ids_reconciliacao = obter_pendencias_reconciliacao(conn_epimed, particao)
+    if adm_ids_reconciliacao:
+        registrar_log(f"Admissões com exames pendentes da reconciliação: {len(adm_ids_reconciliacao)}")
+
+    novos_exames, exames_corrigidos, exames_anulados = detectar_exames(
+        conn_epimed, ultima_data, sorted(set(novos_adm_ids) | set(adm_ids_reconciliacao)),
+        indices.get("exames"), particao
+    )
+
+    registrar_log(
+        f"Novos exames detectados: {len(novos_exames)}"
+    )
+    registrar_log(
+        f"Exames com resultado corrigido: {len(exames_corrigidos)}; com laudo anulado: {len(exames_anulados)}"
+    )
+
+    # === ETAPA 6: ENVIO DE EXAMES ===
+    registrar_log(f"=== ETAPA 6 — ENVIO DE EXAMES ==={rotulo}")
+
+    qnt_exames, qnt_pendentes, exames_gravados = enviar_exames(
+        conn_epimed, novos_exames, exames_corrigidos, exames_anulados
+    )
+    contagem["exames"] += qnt_exames
+    contagem["pendentes"] += qnt_pendentes
+
+    if indices:
+        indices["exames"].acrescentar(exames_gravados)
+
+    if adm_ids_reconciliacao:
+        concluir_pendencias_reconciliacao(conn_epimed, adm_ids_reconciliacao)
+
+    return contagem
+
+def _nova_contagem():
+    return {"internacoes": 0, "admissoes": 0, "exames": 0, "pendentes": 0, "erro": None}
+
+def executar_particao(ultima_data, particao):
+    """Processo trabalhador da execução particionada: conexão e índices próprios."""
+    contagem = _nova_contagem()
+    conn_epimed = banco.obter()
+    indices = {}
+    try:
+        if MOTOR_DIFF == "indice":
+            indices = abrir_indices(conn_epimed)
+        executar_etapas(conn_epimed, ultima_data, contagem, indices, particao)
+    except Exception as e:
+        conn_epimed.rollback()
+        contagem["erro"] = f"partição {particao[0] + 1}/{particao[1]}: {e}"
+        registrar_log(f"Erro na {contagem['erro']}", nivel="error")
+    finally:
+        # A cauda dos índices é compartilhada pelos processos: só o coordenador compacta
+        for indice in indices.values():
+            indice.fechar(compactar=False)
+        log_envio.fechar_todos()
+        banco.devolver(conn_epimed)
+    return contagem
+
+def executar_particionado(conn_epimed, ultima_data, contagem, processos):
+    """Distribui as etapas entre processos por hash de hospitaladmissionnumber e soma as quantidades."""
+    registrar_log(f"Execução particionada em {processos} processos.")
+
+    # Índices criados antes dos processos (a construção não pode ocorrer em paralelo)
+    if MOTOR_DIFF == "indice":
+        for indice in abrir_indices(conn_epimed).values():
+            indice.fechar()
+
+    erros = []
+    for resultado in particionamento.executar(executar_particao, processos, ultima_data):
+        for campo in ("internacoes", "admissoes", "exames", "pendentes"):
+            contagem[campo] += resultado[campo]
+        if resultado["erro"]:
+            erros.append(resultado["erro"])
+
+    sincronizar_altas(conn_epimed)
+
+    if MOTOR_DIFF == "indice":
+        for indice in abrir_indices(conn_epimed).values():
+            indice.fechar()
+
+    if erros:
+        raise RuntimeError("; ".join(erros))
+    return contagem
+
+def verificar_e_enviar_exames(forcar=False, processos=None):
+    registrar_log("INICIANDO ROTINA DE VERIFICAÇÃO DE INTERNAÇÕES, ADMISSÕES E EXAMES.")
 
-            # --- INTERNACOES ---
-            if novas_internacoes:
-                registrar_log(f"Inserindo {len(novas_internacoes)} novas internações…")
-                inserir_internacoes(conn_epimed, novas_internacoes)
-                registrar_log("Internações inseridas com sucesso.")
-            else:
-                registrar_log("Nenhuma nova internação para inserir.")
+    processos = processos or particionamento.PROCESSOS
+    inicio_total = datetime.now()
+    conn_epimed = banco.obter()
 
-            # --- ADMISSOES ---
-            if novas_admissoes:
-                registrar_log(f"Inserindo {len(novas_admissoes)} novas admissões…")
-                inserir_admissoes(conn_epimed, novas_admissoes)
-                registrar_log("Admissões inseridas com sucesso.")
-            else:
-                registrar_log("Nenhuma nova admissão para inserir.")
+    contagem = _nova_contagem()
+    status_execucao = 'SUCESSO'
+    mensagem_execucao = None
 
-            # --- EXAMES ---
-            if novos_exames:
-                registrar_log(f"Processando {len(novos_exames)} novos exames…")
+    # === CONTROLE DE PROCESSAMENTO ===
+    registrar_log("Iniciando rotina de sincronização…")
 
-                for e in novos_exames:
-                    try:
-                        registrar_log(f"Gerando HL7 para exame {e['idexame']}…")
-                        mensagem = gerar_mensagem_hl7(e)
+    id_proc = None
+    indices = {}
+    try:
+        # Esquema: partições futuras, migrações pendentes, índices e planos das consultas quentes
+        preparar_esquema(conn_epimed, forcar)
 
-                        registrar_log("Enviando HL7…")
-                        ack = enviar_mensagem_hl7(mensagem)
+        ultima_data = obter_data_ultimo_processamento(conn_epimed)
 
-                        if ack == "AA":
-                            registrar_log(f"ACK=AA recebido. Inserindo exame {e['idexame']}…")
-                            inserir_exame(conn_epimed, e)
+        # Execução ociosa: origens inalteradas desde a última execução completa
+        desde_impressao, impressao_anterior = obter_impressao_anterior(conn_epimed, ultima_data)
+        impressao_origens = calcular_impressao_origens(conn_epimed, desde_impressao)
+        conn_epimed.commit()
+        if not forcar and impressao_origens == impressao_anterior:
+            registrar_log("Origens inalteradas desde a última execução; coleta e envio ignorados.")
+            mensagem_execucao = "Origens inalteradas; execução ignorada."
+            return
 
-                        else:
-                            registrar_log(
-                                f"Exame {e['idexame']} rejeitado (ACK={ack}).",
-                                nivel="error"
-                            )
+        registrar_log(f"Último processamento bem-sucedido em: {ultima_data}")
 
-                    except Exception as erro:
-                        registrar_log(
-                            f"Erro ao processar exame {e['idexame']}: {erro}",
-                            nivel="error"
-                        )
-                        raise
+        id_proc = registrar_inicio_processamento(conn_epimed)
+        data_inicio = datetime.now()
+        registrar_log(f"Novo processamento iniciado às: {data_inicio}")
 
-                registrar_log("Todos os exames processados.")
-            else:
-                registrar_log("Nenhum novo exame para inserir.")
+        if processos > 1:
+            executar_particionado(conn_epimed, ultima_data, contagem, processos)
+        else:
+            if MOTOR_DIFF == "indice":
+                indices = abrir_indices(conn_epimed)
+            executar_etapas(conn_epimed, ultima_data, contagem, indices)
 
         # === FINALIZAÇÃO ===
+        # Com pendências, a próxima execução não pode ser ignorada
+        if contagem["pendentes"] == 0:
+            estado_sincronizacao.salvar_estado(
+                conn_epimed, "exames.impressao_origens", f"{desde_impressao.isoformat()}|{impressao_origens}"
+            )
         registrar_fim_processamento(conn_epimed, id_proc, "SUCESSO")
         registrar_log("Rotina concluída com sucesso ✔️")
 
@@ -638,23 +1072,28 @@ def verificar_e_enviar_exames():
     finally:
         duracao_total = datetime.now() - inicio_total
 
-        # log de auditoria (mesmo que ocorra erro)
+        # log de auditoria (mesmo que ocorra erro); na execução particionada,
+        # uma única linha com a soma das partições
         try:
             with conn_epimed.cursor() as cur:
                 cur.execute("""
                     INSERT INTO exa.log_execucoes 
                     (data_execucao, novas_internacoes, novas_admissoes, novos_exames, duracao, status, mensagem)
                     VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, (datetime.now(), qnt_internacoes, qnt_admissoes, qnt_exames, duracao_total, status_execucao, mensagem_execucao))
+                """, (datetime.now(), contagem["internacoes"], contagem["admissoes"], contagem["exames"],
+                      duracao_total, status_execucao, mensagem_execucao))
             conn_epimed.commit()
             registrar_log("Log de auditoria registrado com sucesso.")
         except Exception as erro_auditoria:
             conn_epimed.rollback()
             registrar_log(f"Erro ao registrar log de auditoria: {erro_auditoria}", nivel="error")
 
-        conn_epimed.close()
-        conn_aghu.close()
-        registrar_log("CONEXÕES ENCERRADAS.")
+        for indice in indices.values():
+            indice.fechar()
+
+        log_envio.fechar_todos()
+        banco.devolver(conn_epimed)
+        registrar_log("CONEXÕES DEVOLVIDAS AO POOL.")
 
 # =====================================================================
 # EXECUÇÃO
@@ -1,38 +1,31 @@
 import os
-import psycopg2
-import requests
+import hashlib
 import logging
-import xml.etree.ElementTree as ET
-from datetime import datetime
-from dotenv import load_dotenv
-
-# Configurações do banco de dados
-load_dotenv()
-
-EPIMED_DB_CONFIG = {
-    'dbname': os.getenv("epimed_dbname"),
-    'user': os.getenv("epimed_user"),
-    'password': os.getenv("epimed_password"),
-    'host': os.getenv("epimed_host"),
-    'port': os.getenv("epimed_port")
-}
+from datetime import datetime, timedelta
+from psycopg2.extras import execute_values
 
-AGHU_DB_CONFIG = {
-    'dbname': os.getenv("aghu_dbname"),
-    'user': os.getenv("aghu_user"),
-    'password': os.getenv("aghu_password"),
-    'host': os.getenv("aghu_host"),
-    'port': os.getenv("aghu_port")
-}
+import banco
+import estado_sincronizacao
+import idempotencia_hl7
+import log_envio
+import log_rotativo
+import migracoes
+import particionamento
+import quarentena_hl7
+from registros import Leito, cursor_de
+
+# Log dos envios HL7 de leitos (gravado em lote por log_envio)
+TABELA_LOG_ENVIO = "public.log_envio_hl7"
 
-LOG_DIR = "/var/www/html/epimed/logs"
-os.makedirs(LOG_DIR, exist_ok=True)
+# Impressão das origens: após este prazo a rotina roda mesmo sem alterações
+VALIDADE_IMPRESSAO_ORIGENS = timedelta(hours=int(os.getenv("EPIMED_VALIDADE_IMPRESSAO_HORAS", "6")))
 
-data_hoje = datetime.now().strftime("%Y-%m-%d")
-LOG_NAME = f"sincronizar_leitos_{data_hoje}.log"
-LOG_PATH = os.path.join(LOG_DIR, LOG_NAME)
+LOG_DIR = os.getenv("EPIMED_LOG_DIR", "/var/www/html/epimed/logs")
 
-handler = logging.FileHandler(LOG_PATH, mode='a', encoding='utf-8')
+# Arquivo ativo de nome fixo, rotacionado por dia e por tamanho (log_rotativo)
+LOG_PATH = os.path.join(LOG_DIR, "sincronizar_leitos.log")
+
+handler = log_rotativo.ArquivoLogRotativo(LOG_PATH)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 
@@ -40,6 +33,8 @@ logger = logging.getLogger("leito_logger")
 logger.setLevel(logging.INFO)
 logger.addHandler(handler)
 logger.propagate = False
+# Falhas do gravador de logs de envio (log_envio) no mesmo arquivo
+logging.getLogger("log_envio").addHandler(handler)
 
 def registrar_log(mensagem, nivel="info"):
     if nivel == "info":
@@ -51,7 +46,7 @@ def registrar_log(mensagem, nivel="info"):
 
 def gerar_mensagem_hl7(unitcode, unitname, unittypecode, bedcode, bedname,
                        activebeddate, disablebeddate, updatetimestamp,
-                       clientid, typebedcode, bedstatus):
+                       clientid, typebedcode, bedstatus, controle_msh10=None):
 
     if activebeddate:
         dt = datetime.strptime(activebeddate, "%Y-%m-%d %H:%M:%S")
@@ -70,7 +65,10 @@ def gerar_mensagem_hl7(unitcode, unitname, unittypecode, bedcode, bedname,
 
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
 
-    msh = f"MSH|^~&|HUAP||EPIMED||{timestamp}||ORU^R01|20190409220503_ORU_65870_95936689|P|2.5||||||ASCII"
+    if not controle_msh10:
+        controle_msh10 = f"{timestamp}_ORU_{clientid}"
+
+    msh = f"MSH|^~&|HUAP||EPIMED||{timestamp}||ORU^R01|{controle_msh10}|P|2.5||||||ASCII"
     pid = f"PID|1||||||||||||||||||||||"
     pv1 = f"PV1|1||{unitcode}^^{unitname}||||||||||||||||||||||||||||||"
     obr = f"OBR|1|{clientid}|||||{updatetimestamp}||||||||||||||||||||||||||||"
@@ -81,7 +79,16 @@ def gerar_mensagem_hl7(unitcode, unitname, unittypecode, bedcode, bedname,
 
     return f"{msh}\n{pid}\n{pv1}\n{obr}\n{obx}"
 
-def enviar_mensagem_hl7(log_id, mensagem, conexao):
+def nova_sessao():
+    """Sessão HTTP do envio (requests só é importado por quem envia)."""
+    import requests
+
+    return requests.Session()
+
+def enviar_mensagem_hl7(log_id, mensagem, sessao=None):
+    import xml.etree.ElementTree as ET
+
+    import requests
 
     namespaces = {
     's': 'http://www.w3.org/2003/05/soap-envelope',
@@ -113,9 +120,11 @@ def enviar_mensagem_hl7(log_id, mensagem, conexao):
 
     try:
         ack_code = None
+        detalhes_erro = None
         response = None
+        hl7_resp = None
 
-        response = requests.post(
+        response = (sessao or requests).post(
             url,
             data=soap_body.encode("utf-8"),
             headers=headers,
@@ -145,13 +154,18 @@ def enviar_mensagem_hl7(log_id, mensagem, conexao):
             # Quebra em linhas HL7
             hl7_lines = hl7_resp.splitlines()
 
-            # Procura o segmento MSA e extrai o ACK code
+            # Procura o segmento MSA e extrai o ACK code; guarda MSA-3 e segmentos ERR
+            erros = []
             for line in hl7_lines:
                 if line.startswith("MSA"):
                     parts = line.split("|")
                     if len(parts) > 1:
                         ack_code = parts[1]
-                    break
+                    if len(parts) > 3 and parts[3]:
+                        erros.append(parts[3])
+                elif line.startswith("ERR"):
+                    erros.append(line)
+            detalhes_erro = "\n".join(erros) or None
 
             if ack_code == "AA":
                 print("✅ ACK recebido com sucesso (AA - Application Accept).")
@@ -167,7 +181,7 @@ def enviar_mensagem_hl7(log_id, mensagem, conexao):
         else:
             print("❌ Conteúdo HL7 não encontrado na resposta.")
 
-        salvar_log_resposta(log_id, mensagem, hl7_resp, conexao)
+        log_envio.gravador(TABELA_LOG_ENVIO).registrar_resposta(log_id, hl7_resp)
 
     except requests.exceptions.HTTPError as http_err:
         print("❌ Erro HTTP:", http_err)
@@ -178,13 +192,10 @@ def enviar_mensagem_hl7(log_id, mensagem, conexao):
         print("❌ Erro geral:", e)
         raise
 
-    return ack_code
-
-def conectar_db(config):
-    return psycopg2.connect(**config)
+    return ack_code, detalhes_erro
 
-def obter_leitos_aghu(conexao):
-    with conexao.cursor() as cursor:
+def obter_leitos_aghu(conexao, particao=None):
+    with conexao.cursor(cursor_factory=cursor_de(Leito)) as cursor:
         cursor.execute("""
             SELECT
                 unidades_funcionais.seq AS unitcode,
@@ -193,77 +204,89 @@ def obter_leitos_aghu(conexao):
                 leitos.lto_id AS bedcode,
                 leitos.lto_id AS bedname,
                 leitos.ind_leito_extra AS typebedcode,
-                leitos.ind_situacao
+                leitos.ind_situacao,
+                md5(concat_ws('|',
+                    unidades_funcionais.seq::text,
+                    coalesce(unidades_funcionais.descricao::text, ''),
+                    coalesce(unidades_funcionais.ind_unid_cti::text, ''),
+                    leitos.lto_id::text,
+                    coalesce(leitos.ind_leito_extra::text, ''),
+                    coalesce(leitos.ind_situacao::text, '')
+                )) AS impressao
             FROM AGH.AIN_LEITOS AS leitos
             INNER JOIN AGH.AGH_UNIDADES_FUNCIONAIS unidades_funcionais
                 ON leitos.unf_seq = unidades_funcionais.seq
         """)
-        return {row[3]: row[:] for row in cursor.fetchall()}  # bedname como chave
+        return {
+            leito.chave: leito for leito in cursor.fetchall()  # bedcode (lto_id) como chave
+            if particao is None or particionamento.pertence(leito.bedcode, particao)
+        }
 
-def obter_leitos_epimed(conexao):
-    with conexao.cursor() as cursor:
-        cursor.execute('SELECT clientid, bedcode, bedstatus FROM leitos')
-        return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+def calcular_impressao_origens(conn_aghu, conn_epimed):
+    """Impressão barata das origens da rotina de leitos, calculada nos servidores.
 
-def inserir_leito_epimed(conexao, leito_id, ind_situacao, activebeddate=None, disablebeddate=None):
-    try:
-        with conexao.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT INTO leitos (clientid, bedcode, bedstatus, activebeddate, disablebeddate)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (leito_id, leito_id, ind_situacao, activebeddate, disablebeddate)
+    AGHU: leitos e unidades (tabelas pequenas, agregadas por md5) e o maior
+    jn_date_time do journal de leitos. Epimed: quantidade de leitos locais e
+    liberações de quarentena.
+    """
+    with conn_aghu.cursor() as cursor:
+        cursor.execute("""
+            SELECT concat_ws('|',
+                (SELECT md5(string_agg(concat_ws(',', lto_id, unf_seq, ind_leito_extra, ind_situacao), ';' ORDER BY lto_id))
+                   FROM agh.ain_leitos),
+                (SELECT md5(string_agg(concat_ws(',', seq, descricao, ind_unid_cti), ';' ORDER BY seq))
+                   FROM agh.agh_unidades_funcionais),
+                (SELECT MAX(jn_date_time) FROM agh.ain_leitos_jn)
             )
+        """)
+        origem_aghu = cursor.fetchone()[0]
 
-        registrar_log(f"Leito {leito_id} inserido na base local.", nivel="info")
-
-    except Exception as e:
-        registrar_log(f"Erro ao inserir leito {leito_id} na base local: {e}", nivel="error")
-        raise
-
-def salvar_log_envio(leito_id, conexao):
-    try:
-        with conexao.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO log_envio_hl7 (lto_id, data_envio, status, id_log)
-                VALUES (%s, NOW(), 'pendente', 1)
-                RETURNING id
-            """, (leito_id,))
-            log_id = cursor.fetchone()[0]
-
-        registrar_log(f"Log de envio criado para leito {leito_id} com id {log_id}.", nivel="info")
+    with conn_epimed.cursor() as cursor:
+        cursor.execute("""
+            SELECT concat_ws('|',
+                (SELECT COUNT(*) FROM leitos),
+                (SELECT MAX(liberado_em) FROM quarentena_hl7 WHERE entidade = 'leito')
+            )
+        """)
+        origem_epimed = cursor.fetchone()[0]
 
-        return log_id
+    return hashlib.md5(f"{origem_aghu}|{origem_epimed}".encode("utf-8")).hexdigest()
 
-    except Exception as e:
-        registrar_log(f"Erro ao salvar log de envio para leito {leito_id}: {e}", nivel="error")
-        raise
+def obter_leitos_epimed(conexao, particao=None):
+    with conexao.cursor(cursor_factory=cursor_de(Leito)) as cursor:
+        cursor.execute('SELECT clientid, bedcode, bedstatus AS ind_situacao, impressao FROM leitos')
+        return {
+            leito.clientid: leito for leito in cursor.fetchall()
+            if particao is None or particionamento.pertence(leito.bedcode, particao)
+        }
 
-def salvar_log_resposta(log_id, mensagem, resposta, conexao):
+def inserir_leito_epimed(conexao, leito_id, ind_situacao, activebeddate=None, disablebeddate=None, impressao=None):
     try:
         with conexao.cursor() as cursor:
             cursor.execute(
                 """
-                UPDATE log_envio_hl7
-                SET mensagem = %s, resposta = %s, status = %s, id_log = %s
-                WHERE id = %s
+                INSERT INTO leitos (clientid, bedcode, bedstatus, activebeddate, disablebeddate, impressao)
+                VALUES (%s, %s, %s, %s, %s, %s)
                 """,
-                (mensagem, resposta, 'enviado', log_id, log_id)
+                (leito_id, leito_id, ind_situacao, activebeddate, disablebeddate, impressao)
             )
 
-        registrar_log(f"Log de resposta atualizado para id {log_id}.", nivel="info")
+        registrar_log(f"Leito {leito_id} inserido na base local.", nivel="info")
 
     except Exception as e:
-        registrar_log(f"Erro ao atualizar log de resposta para id {log_id}: {e}", nivel="error")
+        registrar_log(f"Erro ao inserir leito {leito_id} na base local: {e}", nivel="error")
         raise
-        
-def atualizar_status_leito(conexao, leito_id, nova_situacao, activebeddate=None, disablebeddate=None):
+
+def atualizar_status_leito(conexao, leito_id, nova_situacao, activebeddate=None, disablebeddate=None, impressao=None):
     try:
         with conexao.cursor() as cursor:
             campos = ["bedstatus = %s"]
             valores = [nova_situacao]
 
+            if impressao is not None:
+                campos.append("impressao = %s")
+                valores.append(impressao)
+
             if activebeddate is not None:
                 campos.append("activebeddate = %s")
                 valores.append(activebeddate)
@@ -283,6 +306,72 @@ def atualizar_status_leito(conexao, leito_id, nova_situacao, activebeddate=None,
         registrar_log(f"Erro ao atualizar status do leito {leito_id}: {e}", nivel="error")
         raise
 
+def registrar_impressoes_leitos(conexao, impressoes):
+    """Grava em lote a impressão atual dos leitos que ainda não a possuem (linha de base)."""
+    if not impressoes:
+        return 0
+    with conexao.cursor() as cursor:
+        execute_values(cursor, """
+            UPDATE leitos AS l
+            SET impressao = v.impressao
+            FROM (VALUES %s) AS v (clientid, impressao)
+            WHERE l.clientid = v.clientid
+              AND l.impressao IS NULL
+        """, list(impressoes.items()), page_size=len(impressoes))
+        return cursor.rowcount
+
+def enviar_leito_hl7(conexao, leito_id, leito, activebeddate, disablebeddate, sessao=None):
+    """Gera e envia a mensagem HL7 do leito, consultando o registro de idempotência.
+
+    Retorna o código do ACK ("AA" também quando o mesmo conteúdo já havia sido aceito).
+    """
+    status_map = {"A": "1", "I": "0"}
+    type_map = {"N": "1", "S": "2"}
+    unittype_map = {"N": "GS", "S": "GE"}
+
+    chave = idempotencia_hl7.chave_leito(leito_id)
+    hash_atual = idempotencia_hl7.hash_payload(
+        leito.unitcode, leito.unitname, unittype_map.get(leito.unittypecode), leito.bedcode, leito.bedname,
+        activebeddate, disablebeddate, type_map.get(leito.typebedcode), status_map.get(leito.ind_situacao)
+    )
+
+    if quarentena_hl7.em_quarentena(conexao, "leito", chave, hash_atual):
+        registrar_log(f"Leito {leito_id} em quarentena (rejeitado anteriormente com o mesmo conteúdo), envio suprimido.", nivel="warning")
+        return quarentena_hl7.EM_QUARENTENA
+
+    decisao, controle_msh10 = idempotencia_hl7.preparar_envio(conexao, "leito", chave, hash_atual)
+
+    if decisao == idempotencia_hl7.IGNORAR:
+        registrar_log(f"Leito {leito_id}: conteúdo já aceito pelo Epimed (MSH-10 {controle_msh10}), envio ignorado.", nivel="warning")
+        return "AA"
+
+    if decisao == idempotencia_hl7.REENVIAR:
+        registrar_log(f"Leito {leito_id}: reenviando conteúdo sem confirmação com o MSH-10 {controle_msh10}.", nivel="warning")
+
+    gravador_log = log_envio.gravador(TABELA_LOG_ENVIO)
+    log_id = gravador_log.reservar_id()
+    clientid = log_id
+    updatetimestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    mensagem = gerar_mensagem_hl7(
+        leito.unitcode, leito.unitname, unittype_map.get(leito.unittypecode), leito.bedcode, leito.bedname,
+        activebeddate, disablebeddate, updatetimestamp,
+        clientid, type_map.get(leito.typebedcode), status_map.get(leito.ind_situacao),
+        controle_msh10
+    )
+
+    gravador_log.registrar_envio(log_id, leito_id, mensagem)
+    resposta, detalhes_erro = enviar_mensagem_hl7(log_id, mensagem, sessao)
+
+    if resposta == "AA":
+        idempotencia_hl7.registrar_aceite(conexao, "leito", chave, controle_msh10)
+        quarentena_hl7.remover_quarentena(conexao, "leito", chave)
+    elif resposta in quarentena_hl7.CODIGOS_REJEICAO:
+        quarentena_hl7.registrar_rejeicao(conexao, "leito", chave, hash_atual, resposta, detalhes_erro)
+        registrar_log(f"Leito {leito_id} colocado em quarentena (ACK {resposta}): {detalhes_erro}", nivel="warning")
+
+    return resposta
+
 def obter_data_criacao(conexao, lto_id):
     with conexao.cursor() as cursor:
         cursor.execute('SELECT dthr_lancamento FROM "agh"."ain_extrato_leitos" WHERE lto_lto_id = %s ORDER BY dthr_lancamento ASC limit 1', (lto_id,))
@@ -301,225 +390,265 @@ def obter_data_inativacao(conexao, lto_id):
         row = cursor.fetchone()
         return row[0] if row else None
 
-def verificar_leitos_novos():
-    registrar_log("(1)-INICIANDO ROTINA DE VERIFICAÇÃO DE LEITOS NOVOS.")
+def classificar_leitos(leitos_epimed, leitos_aghu):
+    """Classifica os leitos do AGHU numa única passada.
 
-    conn_epimed = conectar_db(EPIMED_DB_CONFIG)
-    conn_aghu = conectar_db(AGHU_DB_CONFIG)
+    Retorna (novos, alteracoes, sem_impressao): alteracoes inclui mudanças de
+    situação e de qualquer atributo enviado (impressão diferente);
+    sem_impressao são leitos locais ainda sem impressão, que recebem a atual
+    como linha de base sem reenvio.
+    """
+    novos_leitos = {}
+    alteracoes = {}
+    sem_impressao = {}
 
-    try:
-        leitos_epimed = obter_leitos_epimed(conn_epimed)  
-        leitos_aghu = obter_leitos_aghu(conn_aghu)        
+    for leito_id, leito in leitos_aghu.items():
+        local = leitos_epimed.get(leito_id)
+        if local is None:
+            novos_leitos[leito_id] = leito
+        elif local.ind_situacao != leito.ind_situacao:
+            alteracoes[leito_id] = leito.ind_situacao
+        elif local.impressao is None:
+            sem_impressao[leito_id] = leito.impressao
+        elif local.impressao != leito.impressao:
+            registrar_log(f"Leito {leito_id}: atributos alterados no AGHU (unidade, nome ou tipo).")
+            alteracoes[leito_id] = leito.ind_situacao
 
-        novos_leitos = {
-            lid: info for lid, info in leitos_aghu.items()
-            if lid not in leitos_epimed
-        }
+    return novos_leitos, alteracoes, sem_impressao
 
-        if not novos_leitos:
-           registrar_log("Nenhum novo leito detectado.")
-           print("Nenhum novo leito detectado.")
-           print("Rotina de inclusão de leitos novos executada com sucesso!")
-           return
+def processar_leito_novo(conn_epimed, conn_aghu, leito_id, leito, sessao=None):
+    import requests
 
-        registrar_log(f"{len(novos_leitos)} novo(s) leito(s) detectado(s).")
-        print(f"Detectados {len(novos_leitos)} novo(s) leito(s).")
+    ind_situacao = leito.ind_situacao
 
-        for leito_id, info in novos_leitos.items():
-            unitcode, unitname, unittypecode, bedcode, bedname, typebedcode, ind_situacao = info
+    activebeddate = disablebeddate = None
+    status = "pendente"  
 
-            activebeddate = disablebeddate = None
-            updatetimestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            status = "pendente"  
+    #verifica se alguma vez esteve inativo
+    dti = None
+    dta = obter_data_ativacao(conn_aghu, leito_id)
+    if dta:
+        dti = obter_data_inativacao(conn_aghu, leito_id)
+    disablebeddate = dti.strftime("%Y-%m-%d %H:%M:%S") if dti else None
 
-            #verifica se alguma vez esteve inativo
-            dti = None
-            dta = obter_data_ativacao(conn_aghu, leito_id)
-            if dta:
-                dti = obter_data_inativacao(conn_aghu, leito_id)
-            disablebeddate = dti.strftime("%Y-%m-%d %H:%M:%S") if dti else None
+    if ind_situacao == "A":  
 
-            if ind_situacao == "A":  
+        dta = obter_data_ativacao(conn_aghu, leito_id)
+        if not dta:
+            dta = obter_data_criacao(conn_aghu, leito_id)
 
-                dta = obter_data_ativacao(conn_aghu, leito_id)
-                if not dta:
-                    dta = obter_data_criacao(conn_aghu, leito_id)
+        activebeddate = dta.strftime("%Y-%m-%d %H:%M:%S")
 
-                activebeddate = dta.strftime("%Y-%m-%d %H:%M:%S")
+        registrar_log(f"Leito {leito_id} está ATIVO desde {activebeddate}.")
+    else:
 
-                registrar_log(f"Leito {leito_id} está ATIVO desde {activebeddate}.")
-            else:
+        dti = obter_data_inativacao(conn_aghu, leito_id)
+        if dti:
+           disablebeddate = dti.strftime("%Y-%m-%d %H:%M:%S") if dti else None
+           registrar_log(f"Leito {leito_id} INATIVO, com data de inativação em {dti}", nivel="warning")
+        else:
+            dta = obter_data_criacao(conn_aghu, leito_id)
+            registrar_log(f"Leito {leito_id} INATIVO, com data de criação em {dta}", nivel="warning")
+
+    try:
+        resposta = None
+
+        with conn_epimed: #commit e rollback automáticos
 
-                dti = obter_data_inativacao(conn_aghu, leito_id)
-                if dti:
-                   disablebeddate = dti.strftime("%Y-%m-%d %H:%M:%S") if dti else None
-                   registrar_log(f"Leito {leito_id} INATIVO, com data de inativação em {dti}", nivel="warning")
+            if ind_situacao == "A":  #só envia leitos ativos
+            #if ind_situacao in ("A", "I") :  #carga inicial de leitos ativos e inativos
+
+                resposta = enviar_leito_hl7(conn_epimed, leito_id, leito, activebeddate, disablebeddate, sessao)
+                #resposta = 'AA' #carga inicial
+
+                if resposta == "AA":  # ACK de sucesso
+                    inserir_leito_epimed(conn_epimed, leito_id, ind_situacao, activebeddate, disablebeddate, leito.impressao)
+                    registrar_log(f"Leito {leito_id} recebido com sucesso!", nivel="info")
+                elif resposta == quarentena_hl7.EM_QUARENTENA:
+                    pass
                 else:
-                    dta = obter_data_criacao(conn_aghu, leito_id)
-                    registrar_log(f"Leito {leito_id} INATIVO, com data de criação em {dta}", nivel="warning")
-
-            try:
-                resposta = None
-
-                with conn_epimed: #commit e rollback automáticos
-
-                    if ind_situacao == "A":  #só envia leitos ativos
-                    #if ind_situacao in ("A", "I") :  #carga inicial de leitos ativos e inativos
-
-                        log_id = salvar_log_envio(leito_id, conn_epimed)
-                        clientid = log_id
-
-                        status_map = {"A": "1", "I": "0"}
-                        type_map = {"N": "1", "S": "2"}
-                        unittype_map = {"N": "GS", "S": "GE"}
-                        mensagem = gerar_mensagem_hl7(
-                            unitcode, unitname, unittype_map.get(unittypecode), bedcode, bedname,
-                            activebeddate, disablebeddate, updatetimestamp,
-                            clientid, type_map.get(typebedcode), status_map.get(ind_situacao)
-                        )
-
-                        resposta = enviar_mensagem_hl7(log_id, mensagem, conn_epimed)
-                        #resposta = 'AA' #carga inicial
-
-                        if resposta == "AA":  # ACK de sucesso
-                            inserir_leito_epimed(conn_epimed, leito_id, ind_situacao, activebeddate, disablebeddate)
-                            registrar_log(f"Leito {leito_id} recebido com sucesso!", nivel="info")
-                        else:
-                            msg = f"Erro ao enviar leito {leito_id}: ACK recebido com código {resposta}"
-                            registrar_log(msg, nivel="error")
-
-            except requests.RequestException as e:
-                resposta = str(e)
-                msg = f"Erro ao enviar leito {leito_id}: {resposta}"
-                registrar_log(msg, nivel="error")
+                    msg = f"Erro ao enviar leito {leito_id}: ACK recebido com código {resposta}"
+                    registrar_log(msg, nivel="error")
+                    return False
 
-        print("Rotina de inclusão de leitos novos executada com sucesso!")
+    except requests.RequestException as e:
+        resposta = str(e)
+        msg = f"Erro ao enviar leito {leito_id}: {resposta}"
+        registrar_log(msg, nivel="error")
+        return False
 
-    except Exception as e:
-        registrar_log(f"❌ Erro na rotina de inclusão de leitos novos: {str(e)}", nivel="error")
-        print(f"❌ Erro na rotina de inclusão de leitos novos: {str(e)}")
+    return True
 
-    finally:
-        conn_epimed.close()
-        conn_aghu.close()
-        registrar_log("Conexões com os bancos de dados encerradas.")
+def processar_alteracao_status(conn_epimed, conn_aghu, leito_id, novo_status, leito, sessao=None):
+    import requests
 
-def verificar_alteracoes_status():
-    registrar_log("(2)-INICIANDO ROTINA DE VERIFICAÇÃO DE MUDANÇA DE STATUS DO LEITO.")
+    activebeddate = disablebeddate = None
 
-    conn_epimed = conectar_db(EPIMED_DB_CONFIG)
-    conn_aghu = conectar_db(AGHU_DB_CONFIG)
+    if novo_status == "A":  # Ativo
 
-    try:
-        leitos_epimed = obter_leitos_epimed(conn_epimed)  
-        leitos_aghu = obter_leitos_aghu(conn_aghu)        
+        dta = obter_data_ativacao(conn_aghu, leito_id)
+        if not dta:
+            dta = obter_data_criacao(conn_aghu, leito_id)
 
-        alteracoes = {}
+        activebeddate = dta.strftime("%Y-%m-%d %H:%M:%S") if dta else None
 
-        for leito_id in leitos_epimed:
-            if leito_id in leitos_aghu:
-                _, bedstatus_epimed = leitos_epimed[leito_id]
-                *_, bedstatus_aghu = leitos_aghu[leito_id]
+        registrar_log(f"Leito {leito_id} está ATIVO desde {activebeddate}.")
 
-                if bedstatus_epimed != bedstatus_aghu:
-                    alteracoes[leito_id] = bedstatus_aghu
+    elif novo_status == "I":  # Inativo
 
-        if not alteracoes:
-           registrar_log("Nenhuma alteração de status detectada.")
-           print("Nenhuma alteração de status detectada.")
-           print("Rotina de verificação de alterações de status concluída com sucesso!")
-           return
+        dti = obter_data_inativacao(conn_aghu, leito_id)
 
-        registrar_log(f"{len(alteracoes)} leito(s) com alteração de situação detectado(s).")
-        print(f"Detectados {len(alteracoes)} leito(s) com alteração de situação.")
+        disablebeddate = dti.strftime("%Y-%m-%d %H:%M:%S") if dti else None
 
-        for leito_id, novo_status in alteracoes.items():
-            dados_leito = leitos_aghu[leito_id]
-            unitcode, unitname, unittypecode, bedcode, bedname, typebedcode, ind_situacao = dados_leito
+        # envia também a data de ativação anterior à desativação
+        dta = obter_data_ativacao(conn_aghu, leito_id)
+        if not dta:
+            dta = obter_data_criacao(conn_aghu, leito_id)
 
-            activebeddate = disablebeddate = None
+        activebeddate = dta.strftime("%Y-%m-%d %H:%M:%S") if dta else None
 
-            if novo_status == "A":  # Ativo
+        registrar_log(f"Leito {leito_id} INATIVO, desde {disablebeddate}")
 
-                dta = obter_data_ativacao(conn_aghu, leito_id)
-                if not dta:
-                    dta = obter_data_criacao(conn_aghu, leito_id)
+    registrar_log(f"Leito {leito_id}: novo status {novo_status}, gerando mensagem HL7.")
 
-                activebeddate = dta.strftime("%Y-%m-%d %H:%M:%S") if dta else None
+    try:
 
-                registrar_log(f"Leito {leito_id} está ATIVO desde {activebeddate}.")
+        resposta = None
 
-            elif novo_status == "I":  # Inativo
+        with conn_epimed: #commit e rollback automáticos
 
-                dti = obter_data_inativacao(conn_aghu, leito_id)
+            resposta = enviar_leito_hl7(conn_epimed, leito_id, leito, activebeddate, disablebeddate, sessao)
+            #resposta = "AA" #testes
 
-                disablebeddate = dti.strftime("%Y-%m-%d %H:%M:%S") if dti else None
+            if resposta == "AA":  # ACK de sucesso
+                atualizar_status_leito(conn_epimed, leito_id, novo_status, activebeddate, disablebeddate, leito.impressao)
+                registrar_log(f"Leito {leito_id} recebido com sucesso!", nivel="info")
+            elif resposta == quarentena_hl7.EM_QUARENTENA:
+                pass
+            else:
+                msg = f"Erro ao enviar leito {leito_id}: ACK recebido com código {resposta}"
+                registrar_log(msg, nivel="error")
+                return False
 
-                # envia também a data de ativação anterior à desativação
-                dta = obter_data_ativacao(conn_aghu, leito_id)
-                if not dta:
-                    dta = obter_data_criacao(conn_aghu, leito_id)
+    except requests.RequestException as e:
+        resposta = str(e)
+        msg = f"Erro ao enviar leito {leito_id}: {resposta}"
+        registrar_log(msg, nivel="error")
+        return False
 
-                activebeddate = dta.strftime("%Y-%m-%d %H:%M:%S") if dta else None
+    return True
 
-                registrar_log(f"Leito {leito_id} INATIVO, desde {disablebeddate}")
+def processar_leitos(conn_epimed, conn_aghu, sessao, particao=None):
+    """Lê os inventários (da partição, se informada), classifica e envia; retorna os leitos pendentes.
 
-            updatetimestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    O inventário local é lido na base principal: numa réplica atrasada, um
+    leito inserido na execução anterior pareceria novo e seria reenviado.
+    """
+    with conn_epimed:
+        leitos_epimed = obter_leitos_epimed(conn_epimed, particao)
+    leitos_aghu = obter_leitos_aghu(conn_aghu, particao)
 
-            registrar_log(f"Leito {leito_id}: novo status {novo_status}, gerando mensagem HL7.")
+    novos_leitos, alteracoes, sem_impressao = classificar_leitos(leitos_epimed, leitos_aghu)
 
-            try:
+    if sem_impressao:
+        with conn_epimed:
+            qtd = registrar_impressoes_leitos(conn_epimed, sem_impressao)
+        registrar_log(f"Impressão de linha de base gravada para {qtd} leito(s).")
 
-                resposta = None
+    rotulo = f" (partição {particao[0] + 1}/{particao[1]})" if particao else ""
+    registrar_log(f"{len(novos_leitos)} novo(s) leito(s) e {len(alteracoes)} leito(s) com alteração de situação detectado(s){rotulo}.")
+    print(f"Detectados {len(novos_leitos)} novo(s) leito(s) e {len(alteracoes)} leito(s) com alteração de situação{rotulo}.")
 
-                with conn_epimed: #commit e rollback automáticos
+    pendentes = 0
 
-                    log_id = salvar_log_envio(leito_id, conn_epimed)
-                    clientid = log_id  
+    for leito_id, leito in novos_leitos.items():
+        if not processar_leito_novo(conn_epimed, conn_aghu, leito_id, leito, sessao):
+            pendentes += 1
 
-                    status_map = {"A": "1", "I": "0"}
-                    type_map = {"N": "1", "S": "2"}
-                    unittype_map = {"N": "GS", "S": "GE"}
-                    mensagem = gerar_mensagem_hl7(
-                        unitcode, unitname, unittype_map.get(unittypecode), bedcode, bedname,
-                        activebeddate, disablebeddate, updatetimestamp,
-                        clientid, type_map.get(typebedcode), status_map.get(ind_situacao)
-                    )
+    for leito_id, novo_status in alteracoes.items():
+        if not processar_alteracao_status(conn_epimed, conn_aghu, leito_id, novo_status, leitos_aghu[leito_id], sessao):
+            pendentes += 1
 
-                    resposta = enviar_mensagem_hl7(log_id, mensagem, conn_epimed)
-                    #resposta = "AA" #testes
+    return pendentes
 
-                    if resposta == "AA":  # ACK de sucesso
-                        atualizar_status_leito(conn_epimed, leito_id, novo_status, activebeddate, disablebeddate)
-                        registrar_log(f"Leito {leito_id} recebido com sucesso!", nivel="info")
-                    else:
-                        msg = f"Erro ao enviar leito {leito_id}: ACK recebido com código {resposta}"
-                        registrar_log(msg, nivel="error")
+def processar_particao_leitos(particao):
+    """Processo trabalhador da execução particionada: conexões e sessão HTTP próprias."""
+    conn_epimed = banco.obter()
+    conn_aghu = banco.obter("aghu", somente_leitura=True)
+    sessao = nova_sessao()
+    try:
+        return processar_leitos(conn_epimed, conn_aghu, sessao, particao)
+    finally:
+        log_envio.fechar_todos()
+        sessao.close()
+        banco.devolver(conn_epimed)
+        banco.devolver(conn_aghu)
 
-            except requests.RequestException as e:
-                resposta = str(e)
-                msg = f"Erro ao enviar leito {leito_id}: {resposta}"
-                registrar_log(msg, nivel="error")
+def sincronizar_leitos(forcar=False, processos=None):
+    """Rotina única: um par de conexões, uma leitura de cada inventário e uma sessão HTTP.
+
+    Com processos > 1 (ou EPIMED_PROCESSOS), cada processo trata os leitos da
+    sua partição de lto_id, com conexões e sessão próprias.
+    """
+    registrar_log("INICIANDO ROTINA DE SINCRONIZAÇÃO DE LEITOS (NOVOS E ALTERAÇÕES DE STATUS).")
 
-        print("Rotina de verificação de alterações de status concluída com sucesso!")
+    processos = processos or particionamento.PROCESSOS
+    conn_epimed = banco.obter()
+    conn_aghu = banco.obter("aghu", somente_leitura=True)
+    sessao = None
+
+    try:
+        # Índices e planos das consultas ao journal de leitos do AGHU
+        for alerta in migracoes.verificar_aghu(conn_aghu):
+            registrar_log(alerta, nivel="warning")
+
+        # Execução ociosa: origens inalteradas desde a última execução completa
+        impressao_origens = calcular_impressao_origens(conn_aghu, conn_epimed)
+        impressao_anterior = estado_sincronizacao.obter_estado(
+            conn_epimed, "leitos.impressao_origens", VALIDADE_IMPRESSAO_ORIGENS
+        )
+        conn_epimed.commit()
+        if not forcar and impressao_origens == impressao_anterior:
+            registrar_log("Origens inalteradas desde a última execução; leitura e envio ignorados.")
+            print("Origens inalteradas desde a última execução; nada a fazer.")
+            return
+
+        if processos > 1:
+            registrar_log(f"Execução particionada em {processos} processos.")
+            pendentes = sum(particionamento.executar(processar_particao_leitos, processos))
+        else:
+            sessao = nova_sessao()
+            pendentes = processar_leitos(conn_epimed, conn_aghu, sessao)
+
+        # Com pendências, a próxima execução não pode ser ignorada
+        if pendentes == 0:
+            with conn_epimed:
+                estado_sincronizacao.salvar_estado(conn_epimed, "leitos.impressao_origens", impressao_origens)
+        else:
+            registrar_log(f"{pendentes} leito(s) pendente(s) de envio.", nivel="warning")
+
+        print("Rotina de sincronização de leitos concluída com sucesso!")
 
     except Exception as e:
-        registrar_log(f"❌ Erro na rotina de verificação de alterações de status: {str(e)}", nivel="error")
-        print(f"❌ Erro na rotina de verificação de alterações de status: {str(e)}")
+        registrar_log(f"❌ Erro na rotina de sincronização de leitos: {str(e)}", nivel="error")
+        print(f"❌ Erro na rotina de sincronização de leitos: {str(e)}")
 
     finally:
-        conn_epimed.close()
-        conn_aghu.close()
-        registrar_log("Conexões com os bancos de dados encerradas.")
+        log_envio.fechar_todos()
+        if sessao is not None:
+            sessao.close()
+        banco.devolver(conn_epimed)
+        banco.devolver(conn_aghu)
+        registrar_log("Conexões devolvidas ao pool.")
 
 #-----------------------------------------------------------------------------------------------#
 # Main                                                                                          #
 #                                                                                               #
 # Informa somente leitos novos ativos                                                           #
 # Recupera sempre as datas mais recentes de alterações de status dos leitos                     #
+# Leitos novos e alterações de status são tratados numa única leitura dos inventários           #
 #                                                                                               #
 #-----------------------------------------------------------------------------------------------#
 if __name__ == "__main__":
-    verificar_leitos_novos()
-    verificar_alteracoes_status()
-#-----------------------------------------------------------------------------------------------#
\ No newline at end of file
+    sincronizar_leitos()
+#-----------------------------------------------------------------------------------------------#